@@ -10,7 +10,7 @@
 from functools import reduce
 from typing import OrderedDict, List
 from django.core.cache import cache
-from django.db.models import fields, Q
+from django.db.models import fields, Q, Manager, Max
 from rest_framework import serializers
 from rest_framework.utils import html, model_meta
 from django.db import transaction
@@ -18,6 +18,7 @@ from elasticsearch_dsl import Q as EQ
 
 from dbapp.models import *
 from common.ext_fun import get_datadict, get_deploy_image_list
+from common.variables import CI_LATEST_KEY
 from dbapp.model.model_deploy import BuildJob, BuildJobResult, DeployJob, DockerImage
 
 from common.extends.serializers import ModelSerializer
@@ -325,6 +326,20 @@ class KubernetesDeploySerializers(ModelSerializer):
         fields = '__all__'
 
 
+class AppInfoJobListSerializer(serializers.ListSerializer):
+    """
+    列表序列化前批量预取当前页应用模块的最近构建/发布记录
+    """
+
+    def to_representation(self, data):
+        iterable = list(data.all() if isinstance(data, Manager) else data)
+        self.child.prefetch(iterable)
+        try:
+            return [self.child.to_representation(item) for item in iterable]
+        finally:
+            self.child.prefetched = None
+
+
 class AppInfoListForCiSerializers(ModelSerializer):
     app = serializers.SerializerMethodField()
     last_build = serializers.SerializerMethodField()
@@ -332,6 +347,42 @@ class AppInfoListForCiSerializers(ModelSerializer):
     namespace = serializers.SerializerMethodField()
     kubernetes_info = serializers.SerializerMethodField()
 
+    # 批量预取数据, 未预取时逐行查询
+    prefetched = None
+
+    @staticmethod
+    def latest_jobs(model, appinfo_ids):
+        """
+        按应用模块分组获取最近一次任务, 以及存在执行中任务的批次
+        """
+        last_ids = model.objects.filter(appinfo_id__in=appinfo_ids).order_by().values(
+            'appinfo_id').annotate(last_id=Max('id')).values_list('last_id', flat=True)
+        jobs = {i.appinfo_id: i for i in model.objects.filter(
+            id__in=list(last_ids)).select_related('deployer')}
+        running = set(model.objects.filter(appinfo_id__in=appinfo_ids, status=3).values_list(
+            'appinfo_id', 'batch_uuid'))
+        return jobs, running
+
+    def prefetch(self, instances):
+        appinfo_ids = [i.id for i in instances]
+        builds, builds_running = self.latest_jobs(BuildJob, appinfo_ids)
+        deploys, deploys_running = self.latest_jobs(DeployJob, appinfo_ids)
+        build_results = {}
+        for i in BuildJobResult.objects.defer('console_output').filter(
+                job_id__in=[j.id for j in builds.values() if j.status != 3]):
+            build_results.setdefault(i.job_id, i.result)
+        kubernetes = {}
+        for i in KubernetesDeploy.objects.filter(appinfo_id__in=appinfo_ids).select_related('kubernetes'):
+            kubernetes.setdefault(i.appinfo_id, []).append(i)
+        cache.set_many({f"{CI_LATEST_KEY}{k}": v for k,
+                       v in builds.items()}, None)
+        cache.set_many({f"{CD_LATEST_KEY}{k}": v for k,
+                       v in deploys.items()}, None)
+        self.prefetched = {
+            'builds': builds, 'builds_running': builds_running, 'build_results': build_results,
+            'deploys': deploys, 'deploys_running': deploys_running, 'kubernetes': kubernetes
+        }
+
     def get_namespace(self, instance):
         return instance.namespace
 
@@ -344,19 +395,30 @@ class AppInfoListForCiSerializers(ModelSerializer):
                 'is_k8s': instance.app.is_k8s,
                 'modules': instance.app.modules}
 
+    @staticmethod
+    def deployer_info(build):
+        return {'id': build.deployer.id, 'username': build.deployer.username,
+                'first_name': build.deployer.first_name, 'position': build.deployer.position}
+
     def get_last_build(self, instance):
-        objs = BuildJob.objects.filter(appinfo_id=instance.id)
-        build = objs.first()
+        if self.prefetched is not None:
+            build = self.prefetched['builds'].get(instance.id)
+            running = build and (
+                instance.id, build.batch_uuid) in self.prefetched['builds_running']
+        else:
+            objs = BuildJob.objects.filter(appinfo_id=instance.id)
+            build = objs.first()
+            if build:
+                objs = objs.filter(batch_uuid=build.batch_uuid)
+                running = 3 in [i.status for i in objs]
+                cache.set(f"{CI_LATEST_KEY}{instance.id}", build, None)
         job = {}
         if build:
-            objs = objs.filter(batch_uuid=build.batch_uuid)
-            batch_status = [i.status for i in objs]
-            cache.set(f"{CI_LATEST_KEY}{instance.id}", build, None)
             _fields = ('created_time', 'id', 'order_id', 'status',
                        'build_number', 'commit_tag', 'commits', 'image')
             for f in _fields:
                 job[f] = build.__dict__.get(f)
-            if 3 in batch_status:
+            if running:
                 job['status'] = 3
             job['type'] = 'ci'
             job['result'] = {}
@@ -365,8 +427,12 @@ class AppInfoListForCiSerializers(ModelSerializer):
                     # 构建中
                     pass
                 else:
-                    job['result'] = BuildJobResult.objects.defer(
-                        'console_output').filter(job_id=build.id).first().result
+                    if self.prefetched is not None:
+                        job['result'] = self.prefetched['build_results'].get(
+                            build.id) or {}
+                    else:
+                        job['result'] = BuildJobResult.objects.defer(
+                            'console_output').filter(job_id=build.id).first().result
                     if isinstance(job['result'], (str, )):
                         job['result'] = json.loads(job['result'])
             except BaseException as e:
@@ -374,37 +440,44 @@ class AppInfoListForCiSerializers(ModelSerializer):
             job['deployer'] = {}
             try:
                 if build.deployer:
-                    job['deployer'] = {'id': build.deployer.id, 'username': build.deployer.username,
-                                       'first_name': build.deployer.first_name, 'position': build.deployer.position}
+                    job['deployer'] = self.deployer_info(build)
             except BaseException as e:
                 logger.debug(f"查询deployer失败, 原因: {e}")
         return job
 
     def get_last_deploy(self, instance):
-        objs = DeployJob.objects.filter(appinfo_id=instance.id)
-        build = objs.first()
+        if self.prefetched is not None:
+            build = self.prefetched['deploys'].get(instance.id)
+            running = build and (
+                instance.id, build.batch_uuid) in self.prefetched['deploys_running']
+        else:
+            objs = DeployJob.objects.filter(appinfo_id=instance.id)
+            build = objs.first()
+            if build:
+                objs = objs.filter(batch_uuid=build.batch_uuid)
+                running = 3 in [i.status for i in objs]
+                cache.set(f"{CD_LATEST_KEY}{instance.id}", build, None)
         job = {}
         if build:
-            objs = objs.filter(batch_uuid=build.batch_uuid)
-            batch_status = [i.status for i in objs]
-            cache.set(f"{CD_LATEST_KEY}{instance.id}", build, None)
             _fields = ('created_time', 'id', 'order_id',
                        'status', 'image', 'batch_uuid')
             for f in _fields:
                 job[f] = build.__dict__.get(f)
-            if 3 in batch_status:
+            if running:
                 job['status'] = 3
             job['type'] = 'cd'
             job['deployer'] = {}
             try:
                 if build.deployer:
-                    job['deployer'] = {'id': build.deployer.id, 'username': build.deployer.username,
-                                       'first_name': build.deployer.first_name, 'position': build.deployer.position}
+                    job['deployer'] = self.deployer_info(build)
             except BaseException as e:
                 logger.exception(f"查询deployer异常, 原因: {e}")
         return job
 
     def get_kubernetes_info(self, instance):
+        if self.prefetched is not None:
+            return KubernetesDeploySerializers(
+                self.prefetched['kubernetes'].get(instance.id, []), many=True).data
         serializer = KubernetesDeploySerializers(
             data=KubernetesDeploy.objects.filter(appinfo=instance.id), many=True)
         serializer.is_valid()
@@ -413,40 +486,14 @@ class AppInfoListForCiSerializers(ModelSerializer):
     class Meta:
         model = AppInfo
         exclude = ('template', 'can_edit', 'build_command')
+        list_serializer_class = AppInfoJobListSerializer
 
 
 class AppInfoListForCdSerializers(AppInfoListForCiSerializers):
     kubernetes_info = serializers.SerializerMethodField()
 
     def get_last_build(self, instance):
-        objs = DeployJob.objects.filter(appinfo_id=instance.id)
-        build = objs.first()
-        job = {}
-        if build:
-            objs = objs.filter(batch_uuid=build.batch_uuid)
-            batch_status = [i.status for i in objs]
-            cache.set(f"{CD_LATEST_KEY}{instance.id}", build, None)
-            _fields = ('created_time', 'id', 'order_id',
-                       'status', 'image', 'batch_uuid')
-            for f in _fields:
-                job[f] = build.__dict__.get(f)
-            if 3 in batch_status:
-                job['status'] = 3
-            job['type'] = 'cd'
-            job['deployer'] = {}
-            try:
-                if build.deployer:
-                    job['deployer'] = {'id': build.deployer.id, 'username': build.deployer.username,
-                                       'first_name': build.deployer.first_name, 'position': build.deployer.position}
-            except BaseException as e:
-                logger.exception(f"查询deployer异常, 原因: {e}")
-        return job
-
-    def get_kubernetes_info(self, instance):
-        serializer = KubernetesDeploySerializers(
-            data=KubernetesDeploy.objects.filter(appinfo=instance.id), many=True)
-        serializer.is_valid()
-        return serializer.data
+        return self.get_last_deploy(instance)
 
 
 class AppInfoListForOrderSerializers(AppInfoListForCdSerializers):
@@ -1,3 +1,87 @@
-from django.test import TestCase
+from types import SimpleNamespace
 
-# Create your tests here.
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from cmdb.serializer.serializer_cmdb import AppInfoListForCdSerializers, AppInfoListForCiSerializers
+from cmdb.view.view_cmdb import AppInfoViewSet
+from common.extends.pagination import CustomCursorPagination
+from dbapp.model.model_cmdb import AppInfo, Environment, KubernetesCluster, KubernetesDeploy, MicroApp, Product, \
+    Project
+from dbapp.model.model_deploy import BuildJob, DeployJob
+
+LOCMEM_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class AppInfoJobListQueryTest(TestCase):
+    """
+    CI/CD应用列表的查询次数不随当前页应用数量增长
+    """
+    APPS = 6
+
+    @classmethod
+    def setUpTestData(cls):
+        product = Product.objects.create(name='bench-product')
+        project = Project.objects.create(
+            projectid='bench-project', name='bench-project', product=product)
+        environment = Environment.objects.create(name='dev')
+        kubernetes = KubernetesCluster.objects.create(name='bench-k8s')
+        cls.appinfo_ids = []
+        for i in range(cls.APPS):
+            app = MicroApp.objects.create(appid=f'bench.app{i}', name=f'app{i}', project=project,
+                                          category='category.server')
+            appinfo = AppInfo.objects.create(
+                uniq_tag=f'bench.app{i}.dev', app=app, environment=environment)
+            KubernetesDeploy.objects.create(appinfo=appinfo, kubernetes=kubernetes)
+            for n in range(2):
+                BuildJob.objects.create(appinfo_id=appinfo.id, status=1)
+                DeployJob.objects.create(
+                    uniq_id=f'bench-{i}-{n}', appinfo_id=appinfo.id, status=1)
+            cls.appinfo_ids.append(appinfo.id)
+
+    def serialize(self, action, serializer_class, appinfo_ids):
+        view = AppInfoViewSet()
+        view.action = action
+        view.request = SimpleNamespace(query_params={})
+        queryset = view.extend_filter(
+            AppInfo.objects.filter(id__in=appinfo_ids).order_by('id'))
+        return serializer_class(queryset, many=True).data
+
+    def assert_constant_queries(self, action, serializer_class):
+        with CaptureQueriesContext(connection) as queries:
+            data = self.serialize(action, serializer_class, self.appinfo_ids[:2])
+        self.assertEqual(len(data), 2)
+        with self.assertNumQueries(len(queries.captured_queries)):
+            data = self.serialize(action, serializer_class, self.appinfo_ids)
+        self.assertEqual(len(data), self.APPS)
+        self.assertTrue(all(i['last_build'] and i['kubernetes_info'] for i in data))
+
+    def test_ci_list_queries(self):
+        self.assert_constant_queries('service_for_ci', AppInfoListForCiSerializers)
+
+    def test_cd_list_queries(self):
+        self.assert_constant_queries('service_for_cd', AppInfoListForCdSerializers)
+
+
+class CursorPaginationOrderingTest(TestCase):
+    """
+    升序排序的游标分页逐页读取, 记录不重复不遗漏
+    """
+
+    def test_ascending_pages(self):
+        for index, alias in enumerate(['a', 'a', 'b', 'b', 'c']):
+            Environment.objects.create(name=f'bench-{index}', alias=alias)
+        view = SimpleNamespace(keyset_ordering=('alias',))
+        queryset = Environment.objects.all()
+        url, seen = '/api/environment/?page_size=2', []
+        while url:
+            paginator = CustomCursorPagination()
+            page = paginator.paginate_queryset(queryset, Request(APIRequestFactory().get(url)), view=view)
+            seen.extend(i.id for i in page)
+            url = paginator.get_next_link()
+        self.assertEqual(paginator.get_ordering(None, queryset, view), ('alias', 'id'))
+        self.assertEqual(seen, list(queryset.order_by('alias', 'id').values_list('id', flat=True)))
@@ -47,6 +47,7 @@ from dbapp.model.model_ucenter import Menu, SystemConfig
 from common.extends.viewsets import CustomModelViewSet, CustomModelParentViewSet
 from common.extends.permissions import RbacPermission, AppPermission, AppInfoPermission
 from common.extends.filters import CustomSearchFilter
+from common.extends.search import NgramSearchBackend
 from common.extends.handler import log_audit
 
 from common.utils.ElasticSearchAPI import Search
@@ -55,6 +56,7 @@ from common.utils.GitLabAPI import GitLabAPI
 from common.utils.HarborAPI import HarborAPI
 from common.custom_format import convert_xml_to_str_with_pipeline
 from common.utils.RedisAPI import RedisManage
+from common.kubernetes_utils import K8sResourceCache
 from common.ext_fun import get_datadict, get_permission_from_role, get_redis_data, gitlab_cli, k8s_cli, set_redis_data, \
     template_generate, devlanguage_template_manage, get_project_mergerequest
 
@@ -349,33 +351,19 @@ class KubernetesClusterViewSet(CustomModelViewSet):
                 ret = cli.get_pods(namespaces[0], **selectd)
                 ret = ret['message']
             elif info_type == 'pods':
-                ret = {'items': [], 'metadata': {}}
-                ns_continue = []
-                for ns in namespaces:
-                    r = cli.get_pods(ns, **kw)
-                    r = r['message']
-                    if r['metadata'].get('continue', None):
-                        ns_continue.append(r['metadata']['continue'])
-                    try:
-                        ret['items'].extend(r['items'])
-                    except BaseException as e:
-                        print('except: ', str(e))
-                if ns_continue:
-                    ret['metadata']['continue'] = ns_continue[0]
+                ret = cli.get_pods_batch(namespaces, **kw)
             elif info_type == 'configmap':
                 ret = cli.get_configmaps(namespaces[0], **kw)
         try:
             if ret.get('items'):
-                for i in ret['items']:
-                    logger.debug(f'name == {i["metadata"]["name"]}')
-                items = []
-                for i in ret['items']:
-                    name = i["metadata"]["name"]
-                    if cache.get(f'wait-delete-k8s-resource:{info_type}:{name}') or cache.get(
-                            f'wait-delete-k8s-resource:{info_type[0:-1]}:{name}'):
-                        continue
-                    items.append(i)
-                ret['items'] = items
+                # 待删除资源标记一次批量获取
+                keys = {i["metadata"]["name"]: (f'wait-delete-k8s-resource:{info_type}:{i["metadata"]["name"]}',
+                                                f'wait-delete-k8s-resource:{info_type[0:-1]}:{i["metadata"]["name"]}')
+                        for i in ret['items']}
+                marked = cache.get_many(
+                    [k for pair in keys.values() for k in pair])
+                ret['items'] = [i for i in ret['items'] if not any(
+                    marked.get(k) for k in keys[i["metadata"]["name"]])]
             return Response({'data': ret, 'status': 'success', 'code': 20000})
         except BaseException as e:
             logger.info(f'获取资源失败，返回内容{ret}，原因：{e}')
@@ -400,8 +388,13 @@ class KubernetesClusterViewSet(CustomModelViewSet):
             return Response({'message': '未获取到配置', 'status': 'failed', 'code': 50000})
 
         ret = {'error': 1}
+        if resource in ['deployment', 'service', 'services']:
+            # 手动创建的Service与部署下发内容不一致, 清理缓存
+            K8sResourceCache.invalidate(
+                queryset.id, 'service', namespace, name)
         if resource == 'namespace':
             ret = cli.create_namespace(name)
+            K8sResourceCache.add_namespace(queryset.id, name)
         elif resource == 'deployment':
             image = request.data.get('image', None)
             port = request.data.get('port')
@@ -803,6 +796,7 @@ class MicroAppViewSet(CustomModelViewSet):
     filter_fields = ('category', 'name', 'alias',
                      'project__product_id', 'project_id')
     search_fields = ('category', 'name', 'alias', 'language', 'appid')
+    search_backend = NgramSearchBackend
 
     def create(self, request, *args, **kwargs):
         """
@@ -1251,6 +1245,10 @@ class AppInfoViewSet(CustomModelViewSet):
         return queryset
 
     def extend_filter(self, queryset):
+        if self.action in ['service_for_cd', 'service_for_ci']:
+            # 列表字段用到的关联对象随查询一并加载
+            queryset = queryset.select_related(
+                'app__project__product', 'environment').prefetch_related('kubernetes')
         return self.extra_select(queryset)
 
     def get_serializer_class(self):
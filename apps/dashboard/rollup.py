@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+'''
+@Author  :    Charles Lai
+@Contact :    qqing_lai@hotmail.com
+@Time    :    2023/05/19 15:20
+@FileName:    rollup.py
+@Blog    :    https://imaojia.com
+'''
+
+from collections import defaultdict
+
+from django.apps import apps
+from django.db.models import Count
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from common.utils.RedisAPI import RedisManage
+from common.variables import DASHBOARD_ROLLUP_KEY, DASHBOARD_ROLLUP_MODELS
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class DashboardRollup(object):
+    """
+    资产按天汇总计数
+    由模型新增/删除信号增量维护, 需先执行 manage.py dashboard_rollup 回填, 回填前读取返回None由调用方回退查库
+    """
+    TOTAL = 'total'
+    READY = 'ready'
+    # 支持的报表时间粒度, 按日期字符串截取长度汇总
+    PERIODS = {'years': 4, 'months': 7, 'days': 10}
+
+    def __init__(self, name):
+        self.name = name
+        self.model = apps.get_model('dbapp', name)
+        self.region_field = DASHBOARD_ROLLUP_MODELS[name]
+        self.key = f"{DASHBOARD_ROLLUP_KEY}{name}"
+
+    @classmethod
+    def get(cls, name):
+        if name not in DASHBOARD_ROLLUP_MODELS:
+            return None
+        return cls(name)
+
+    @staticmethod
+    def day(created_time):
+        if created_time is None:
+            return None
+        if timezone.is_aware(created_time):
+            created_time = timezone.localtime(created_time)
+        return created_time.strftime('%Y-%m-%d')
+
+    def fields(self, region, day):
+        fields = [f'|{self.TOTAL}']
+        if day:
+            fields.append(f'|{day}')
+        if region:
+            fields.extend([f'{region}|{i.split("|")[1]}' for i in fields])
+        return fields
+
+    def region_of(self, pk):
+        return self.model.objects.filter(pk=pk).values_list(self.region_field, flat=True).first()
+
+    def incr(self, region, created_time, amount=1):
+        pipe = RedisManage().conn().pipeline(transaction=False)
+        for field in self.fields(region, self.day(created_time)):
+            pipe.hincrby(self.key, field, amount)
+        pipe.execute()
+
+    def compute(self):
+        """
+        从数据库统计汇总数据
+        """
+        data = defaultdict(int)
+        queryset = self.model.objects.annotate(day=TruncDate('created_time')).values(
+            self.region_field, 'day').annotate(count=Count('pk')).order_by()
+        for i in queryset:
+            day = i['day'] and i['day'].strftime('%Y-%m-%d')
+            for field in self.fields(i[self.region_field], day):
+                data[field] += i['count']
+        return dict(data)
+
+    def backfill(self):
+        data = self.compute()
+        data[self.READY] = 1
+        pipe = RedisManage().conn().pipeline(transaction=True)
+        pipe.delete(self.key)
+        pipe.hset(self.key, mapping=data)
+        pipe.execute()
+        return data
+
+    def load(self):
+        data = RedisManage().conn().hgetall(self.key)
+        if not data.pop(self.READY, None):
+            return None
+        return {k: int(v) for k, v in data.items()}
+
+    def check(self):
+        """
+        一致性检查
+        :return: {字段: (数据库计数, 汇总计数)}, 汇总未回填时返回None
+        """
+        current = self.load()
+        if current is None:
+            return None
+        expected = self.compute()
+        return {k: (expected.get(k, 0), current.get(k, 0)) for k in set(expected) | set(current)
+                if expected.get(k, 0) != current.get(k, 0)}
+
+    def total(self, region=None):
+        conn = RedisManage().conn()
+        ready, count = conn.hmget(
+            self.key, self.READY, f'{region or ""}|{self.TOTAL}')
+        if not ready:
+            return None
+        return int(count or 0)
+
+    def series(self, period, region=None):
+        """
+        按报表时间粒度汇总, 返回格式同 DashBoardViewSet.get_model_queryset
+        边界日期按整天统计
+        """
+        if period['name'] not in self.PERIODS:
+            return None
+        data = self.load()
+        if data is None:
+            return None
+        region = region or ''
+        start = period['start_time'].strftime('%Y-%m-%d')
+        end = period['end_time'].strftime('%Y-%m-%d')
+        size = self.PERIODS[period['name']]
+        ret = defaultdict(int)
+        for field, count in data.items():
+            _region, day = field.rsplit('|', 1)
+            if _region != region or day == self.TOTAL or not start <= day <= end:
+                continue
+            ret[day[:size]] += count
+        return dict(ret)
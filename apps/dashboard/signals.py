@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+'''
+@Author  :    Charles Lai
+@Contact :    qqing_lai@hotmail.com
+@Time    :    2023/05/19 15:48
+@FileName:    signals.py
+@Blog    :    https://imaojia.com
+'''
+
+from django.apps import apps
+from django.db import transaction
+from django.db.models.signals import post_save, pre_delete, post_delete
+
+from dashboard.rollup import DashboardRollup
+from common.variables import DASHBOARD_ROLLUP_MODELS
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def rollup_incr(rollup, region, created_time, amount):
+    def incr():
+        try:
+            rollup.incr(region, created_time, amount)
+        except BaseException as e:
+            logger.error(f'更新资产汇总[{rollup.name}]失败，原因：{e}')
+    # 事务提交后更新计数
+    transaction.on_commit(incr)
+
+
+def rollup_created(sender, instance, created, **kwargs):
+    if not created or kwargs.get('raw', False):
+        return
+    rollup = DashboardRollup(sender._meta.model_name)
+    rollup_incr(rollup, rollup.region_of(instance.pk),
+                instance.created_time, 1)
+
+
+def rollup_pre_delete(sender, instance, **kwargs):
+    # 删除后无法再关联查询区域, 删除前记录
+    instance._rollup_region = DashboardRollup(
+        sender._meta.model_name).region_of(instance.pk)
+
+
+def rollup_deleted(sender, instance, **kwargs):
+    rollup_incr(DashboardRollup(sender._meta.model_name), getattr(instance, '_rollup_region', None),
+                instance.created_time, -1)
+
+
+for name in DASHBOARD_ROLLUP_MODELS:
+    model = apps.get_model('dbapp', name)
+    post_save.connect(rollup_created, sender=model,
+                      dispatch_uid=f'dashboard_rollup_save_{name}')
+    pre_delete.connect(rollup_pre_delete, sender=model,
+                       dispatch_uid=f'dashboard_rollup_predelete_{name}')
+    post_delete.connect(rollup_deleted, sender=model,
+                        dispatch_uid=f'dashboard_rollup_delete_{name}')
@@ -9,12 +9,15 @@
 '''
 
 import random
+import hashlib
 from functools import reduce
 import operator
+from urllib.parse import urlencode
 from jira import Project
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.decorators import action
+from django.core.cache import cache
 from django.db.models import Q, Count, Sum, Avg
 from django.db.models.query import QuerySet
 from django.apps import apps
@@ -29,10 +32,12 @@ from common.ext_fun import get_datadict, get_time_range
 from common.extends.viewsets import CustomModelViewSet
 
 import logging
-from common.variables import CMDB_RELATED_TYPE, DASHBOARD_CONFIG, DASHBOARD_TIME_FORMAT_T, DASHBOARD_TIME_FORMAT_T_ES
+from common.variables import CMDB_RELATED_TYPE, DASHBOARD_CONFIG, DASHBOARD_TIME_FORMAT_T, DASHBOARD_TIME_FORMAT_T_ES, \
+    DASHBOARD_CACHE_KEY, DASHBOARD_CACHE_TTL
 
 from dbapp.model.model_dashboard import DashBoard
 from dashboard.serializers import DashBoardSerializers
+from dashboard.rollup import DashboardRollup
 from dbapp.model.model_deploy import BuildJob
 
 logger = logging.getLogger(__name__)
@@ -77,6 +82,8 @@ class DashBoardViewSet(CustomModelViewSet):
     model_project = Project
     model_microapp = MicroApp
     model_deploy = BuildJob
+    # 本次报表统计是否出现异常, 异常时结果不缓存
+    chart_degraded = False
     # 图表颜色
     success_color = ['#91cc75', '#759aa0', '#8dc1a9', '#73a373', '#7289ab', '#37A2DA', '#32C5E9', '#67E0E3', '#9FE6B8',
                      '#9d96f5', '#8378EA', '#96BFFF']
@@ -84,7 +91,8 @@ class DashBoardViewSet(CustomModelViewSet):
                     '#f49f42', '#FFDB5C', '#eedd78']
 
     def get_es_queryset(self, model, period, time_field=None, filter_field=None, conditions=None, filter_conditions=None, count_only=False,
-                        group_by=False, size=None, metric=False, disable_region=False, disable_env=False, disable_product=False, *args, **kwargs):
+                        group_by=False, size=None, metric=False, disable_region=False, disable_env=False, disable_product=False,
+                        sub_field=None, include=None, *args, **kwargs):
         """
         :param model: ES Search实例
         :param period: 时间区间
@@ -98,6 +106,8 @@ class DashBoardViewSet(CustomModelViewSet):
         :param disable_region: 不区分地区
         :param disable_env: 不区分环境
         :param disable_product: 不区分产品
+        :param sub_field: 分组统计时的二级分组字段
+        :param include: 分组统计时只返回这些值的分组
         :param size:
         """
         if not size:
@@ -141,12 +151,18 @@ class DashBoardViewSet(CustomModelViewSet):
                                                                                                          'top_hits',
                                                                                                          size=1)
             else:
-                model.aggs.bucket(
-                    'app', 'terms', field=filter_field, min_doc_count=0, size=size)
+                terms = {'include': include} if include else {}
+                bucket = model.aggs.bucket(
+                    'app', 'terms', field=filter_field, min_doc_count=0, size=size, **terms)
+                if sub_field:
+                    bucket.bucket('sub', 'terms',
+                                  field=sub_field, min_doc_count=0)
             try:
                 return model.execute().aggregations.app.buckets
             except BaseException as e:
+                # 由调用方回退聚合字段, 不再返回按时间统计的结果
                 logger.exception(f'获取app bucket异常，{e}')
+                raise
         model.aggs.bucket('count', 'date_histogram', field=time_field, min_doc_count=0,
                           extended_bounds={'min': start_time, 'max': end_time}, format=date_format,
                           time_zone='Asia/Shanghai', interval=period['name'].rstrip('s'))
@@ -154,6 +170,7 @@ class DashBoardViewSet(CustomModelViewSet):
             return model.execute().aggregations.count.buckets
         except BaseException as e:
             logger.exception(f'获取count bucket异常，{e}')
+            self.chart_degraded = True
             return []
 
     @staticmethod
@@ -226,6 +243,53 @@ class DashBoardViewSet(CustomModelViewSet):
                 config = []
         return config
 
+    def get_chart_cache(self, chart, func):
+        """
+        报表数据缓存, 按用户及查询参数区分, 过期自动失效
+        """
+        query = urlencode(sorted(self.request.query_params.lists()), doseq=True)
+        cache_key = f"{DASHBOARD_CACHE_KEY}{chart}:{self.request.user.username}:{hashlib.md5(query.encode('utf-8')).hexdigest()}"
+        data = cache.get(cache_key)
+        if data is None:
+            self.chart_degraded = False
+            data = func()
+            if not self.chart_degraded:
+                # 统计异常时的不完整结果不缓存
+                cache.set(cache_key, data, DASHBOARD_CACHE_TTL)
+        return data
+
+    def get_app_status_count(self, queryset, period, appids, filter_conditions=None):
+        """
+        单次聚合统计各应用不同状态的数量
+
+        :return: {appid: {status: count}}
+        """
+        if not appids:
+            return {}
+        buckets = []
+        conditions = reduce(operator.or_, [
+                            EQ('match_phrase', appid=i) for i in appids])
+        # appid为text类型时回退为keyword子字段聚合
+        for field in ['appid', 'appid.keyword']:
+            try:
+                buckets = self.get_es_queryset(queryset, period, time_field='created_time', filter_field=field,
+                                               sub_field='status', conditions=conditions,
+                                               filter_conditions=filter_conditions, group_by=True, size=len(appids),
+                                               include=list(appids))
+                break
+            except BaseException as e:
+                logger.debug(f"应用状态统计[{field}]异常, 原因: {e}")
+        else:
+            self.chart_degraded = True
+        data = {}
+        for bucket in buckets or []:
+            try:
+                data[bucket.key] = {
+                    i.key: i.doc_count for i in bucket.sub.buckets}
+            except AttributeError:
+                continue
+        return data
+
     @staticmethod
     def get_random_app(region=None):
         if region:
@@ -318,13 +382,17 @@ class DashBoardViewSet(CustomModelViewSet):
         数量统计
         """
         panels = self.get_dashboard_config('cmdb')
+        region = request.query_params.get('region', None)
         data = []
         for model in panels:
             count = 0
             if model['type'] == 'rds':
-                # 关系型数据库表
-                count = self.get_model_ext(model['value'].split(
-                    '.')[0], model['value'].split('.')[1]).count()
+                # 关系型数据库表, 优先读取日汇总计数
+                module, name = model['value'].split('.')[0:2]
+                rollup = DashboardRollup.get(name)
+                count = rollup and rollup.total(region)
+                if count is None:
+                    count = self.get_model_ext(module, name).count()
             data.append(
                 {'name': model['value'], 'alias': model['key'], 'count': count, 'icon': model.get('icon', 'nested')})
         return Response({'code': 20000, 'data': data})
@@ -340,13 +408,17 @@ class DashBoardViewSet(CustomModelViewSet):
         period = period_time[0]
         time_line = period_time[1]
         panels = self.get_dashboard_config('cmdb')
+        region = request.query_params.get('region', None)
         series = []
         for model in panels:
             data = []
             if model['type'] == 'rds':
-                queryset = self.get_model_ext(model['value'].split('.')[
-                                              0], model['value'].split('.')[1])
-                qs = self.get_model_queryset(queryset, period)
+                module, name = model['value'].split('.')[0:2]
+                rollup = DashboardRollup.get(name)
+                qs = rollup and rollup.series(period, region)
+                if qs is None:
+                    queryset = self.get_model_ext(module, name)
+                    qs = self.get_model_queryset(queryset, period)
                 data = [qs.get(i, 0) for i in time_line]
             series.append(
                 {'name': model['key'], 'type': 'line', 'smooth': True, 'data': data})
@@ -374,6 +446,10 @@ class DashBoardViewSet(CustomModelViewSet):
 
         柱状图&饼图 构建发布/时间
         """
+        return Response({'code': 20000, 'data': self.get_chart_cache('cicd_bar_pie_time', self.cicd_bar_pie_time_data)})
+
+    def cicd_bar_pie_time_data(self):
+        request = self.request
         app_ids = request.query_params.getlist('app_ids[]', [])
         if len(app_ids) == 0:
             app_ids = [i['id'] for i in self.get_dashboard_config('deploy')]
@@ -434,6 +510,7 @@ class DashBoardViewSet(CustomModelViewSet):
                  'tooltip': {'trigger': 'item', 'formatter': '{b} : {c} ({d}%)'}, 'data': pie_data})
         except BaseException as e:
             logger.debug(f"饼图生成异常, 原因: {e}")
+            self.chart_degraded = True
         data = {
             'title': [{'text': '构建发布/时间'}, {'left': '70%', 'text': '应用发布'}],
             'tooltip': {'trigger': 'axis'},
@@ -450,7 +527,7 @@ class DashBoardViewSet(CustomModelViewSet):
             'yAxis': [{'type': 'value'}, {'gridIndex': 1, 'type': 'value', 'show': False}],
             'series': series
         }
-        return Response({'code': 20000, 'data': data})
+        return data
 
     @action(methods=['GET'], detail=False, url_path='cicd/bar_pie/app')
     def cicd_bar_pie_app(self, request):
@@ -459,6 +536,10 @@ class DashBoardViewSet(CustomModelViewSet):
 
         柱状图&饼图 构建发布/应用
         """
+        return Response({'code': 20000, 'data': self.get_chart_cache('cicd_bar_pie_app', self.cicd_bar_pie_app_data)})
+
+    def cicd_bar_pie_app_data(self):
+        request = self.request
         app_ids = request.query_params.getlist('app_ids[]', [])
         period_time = get_time_range(request)
         period = period_time[0]
@@ -479,23 +560,16 @@ class DashBoardViewSet(CustomModelViewSet):
         status_map = [{'status': 1, 'label': '成功', 'color': self.success_color},
                       {'status': 2, 'label': '失败', 'color': self.failed_color}]
         filter_field = []
+        appids = [i['key'] for i in app_ids]
         for index, model in enumerate(panels):
-            # 构建/发布统计
+            # 构建/发布统计, 每个模型一次聚合查询
             queryset = self.get_es_ext(model['value'])
+            app_status_count = self.get_app_status_count(
+                queryset, period, appids,
+                filter_conditions=reduce(operator.and_, filter_field) if filter_field else None)
             for stat in status_map:
-                data = []
-                for appid in app_ids:
-                    if filter_field:
-                        qs = self.get_es_queryset(queryset, period, time_field='created_time',
-                                                  conditions=EQ('match_phrase', appid=appid['key']), count_only=True,
-                                                  filter_conditions=reduce(
-                                                      operator.and_, filter_field),
-                                                  status=stat['status'])
-                    else:
-                        qs = self.get_es_queryset(queryset, period, time_field='created_time',
-                                                  conditions=EQ('match_phrase', appid=appid['key']), count_only=True,
-                                                  status=stat['status'])
-                    data.append(qs)
+                data = [app_status_count.get(appid, {}).get(
+                    stat['status'], 0) for appid in appids]
                 # 柱状图
                 series.append(
                     {'name': f"{model['key'][2:]}{stat['label']}", 'type': 'bar', 'barMaxWidth': '60',
@@ -524,6 +598,7 @@ class DashBoardViewSet(CustomModelViewSet):
                      'tooltip': {'trigger': 'item', 'formatter': '{a} <br/>{b} : {c} ({d}%)'}, 'data': pie_data})
         except BaseException as e:
             logger.debug(f"饼图生成异常, 原因: {e}")
+            self.chart_degraded = True
         data = {
             'title': [{'text': '构建发布/应用'}, {'left': '70%', 'text': '产品项目'}],
             'tooltip': {'trigger': 'axis'},
@@ -542,4 +617,4 @@ class DashBoardViewSet(CustomModelViewSet):
             'yAxis': [{'type': 'value'}, {'gridIndex': 1, 'type': 'value', 'show': False}],
             'series': series
         }
-        return Response({'code': 20000, 'data': data})
+        return data
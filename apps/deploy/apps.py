@@ -5,4 +5,4 @@ class DeployConfig(AppConfig):
     name = 'deploy'
 
     def ready(self):
-        import deploy.signals
+        import deploy.signals  # noqa: F401
@@ -8,24 +8,30 @@
 @Blog    : https://blog.imaojia.com
 """
 
+import asyncio
 import json
 import time
 import os
 import signal
+from urllib.parse import parse_qs
 from ruamel import yaml
-from channels.generic.websocket import WebsocketConsumer
-from asgiref.sync import async_to_sync
+import aioredis
+from channels.generic.websocket import WebsocketConsumer, AsyncWebsocketConsumer
+from channels.db import database_sync_to_async
+from asgiref.sync import async_to_sync, sync_to_async
 
 from kubernetes import client, config, watch
 from kubernetes.client import ApiClient
 
 from django.core.cache import caches
-from dbapp.models import BuildJob
+from dbapp.models import BuildJob, DeployJob
 from dbapp.models import KubernetesCluster, AppInfo
 
 from common.utils.JenkinsAPI import GlueJenkins
 from common.utils.RedisAPI import RedisManage
 from common.ext_fun import get_redis_data, k8s_cli
+from common.deploy_stage import DeployStageWriter
+from common.variables import CD_STAGE_CHANNEL, CD_STAGE_WAIT_INTERVAL
 from common.utils.AesCipher import AesCipher
 from celery_tasks.tasks import watch_k8s_deployment, watch_k8s_pod, tail_k8s_log, jenkins_log_stage, jenkins_log_console
 from threading import Thread
@@ -47,35 +53,114 @@ class CustomWebsocketConsumer(WebsocketConsumer):
             pass
 
 
-class WatchK8sDeployment(CustomWebsocketConsumer):
+class WatchK8sDeployment(AsyncWebsocketConsumer):
+    """
+    应用部署进度推送
+    订阅部署进度频道, 连接时先回放已有进度, 再按增量推送完整进度
+    """
 
-    def connect(self):
+    async def connect(self):
         self.job_id = self.scope['url_route']['kwargs']['job_id']
         self.app_id = self.scope['url_route']['kwargs']['app_id']
-        self.result = watch_k8s_deployment.apply_async(
-            [self.channel_name, self.job_id, self.app_id], countdown=1)
-        self.accept()
+        self.result = None
+        self.progress = {}
+        await self.accept()
+        self.task = asyncio.ensure_future(self.watch_progress())
 
-    def disconnect(self, code):
-        self.close()
+    async def disconnect(self, code):
+        self.task.cancel()
+        if self.result:
+            self.result.revoke()
 
-    def receive(self, text_data=None, bytes_data=None):
+    async def receive(self, text_data=None, bytes_data=None):
         text_data_json = json.loads(text_data)
         if text_data_json.get('message', None) == 'abort':
-            self.disconnect(0)
+            await self.close()
+            return
         if text_data_json.get('heart', None) == 1:
-            self.send(text_data=json.dumps(
+            await self.send(text_data=json.dumps(
                 {'message': {'status': 9, 'data': 'pong'}}
             ))
 
-    def send_message(self, event):
+    @staticmethod
+    def job_pending(job_id):
+        """
+        K8S部署任务是否仍在排队或启动中, 尚未写入进度
+        """
+        job = DeployJob.objects.filter(id=job_id).values(
+            'status', 'appinfo_id').first()
+        if not job or job['status'] not in [0, 3]:
+            return False
+        return AppInfo.objects.filter(id=job['appinfo_id'], app__is_k8s='k8s',
+                                      app__category__endswith='.server').exists()
+
+    async def watch_progress(self):
+        redis = None
+        try:
+            node = RedisManage.pubsub_node()
+            redis = await aioredis.create_redis(
+                (node['host'], node['port']), db=node['db'], password=node['password'] or None)
+            # 先订阅再读取快照, 订阅之后的增量在快照基础上重放
+            channel, = await redis.subscribe(f"{CD_STAGE_CHANNEL}{self.job_id}")
+            snapshot = await sync_to_async(DeployStageWriter.load_fields)(self.job_id)
+            while not snapshot:
+                if not await database_sync_to_async(self.job_pending)(self.job_id):
+                    # 非K8S部署或进度已过期, 回退为轮询任务
+                    self.result = watch_k8s_deployment.apply_async(
+                        [self.channel_name, self.job_id, self.app_id], countdown=1)
+                    return
+                # 任务排队中, 等待部署开始时写入的完整进度
+                try:
+                    msg = await asyncio.wait_for(channel.get(encoding='utf-8'), CD_STAGE_WAIT_INTERVAL)
+                except asyncio.TimeoutError:
+                    snapshot = await sync_to_async(DeployStageWriter.load_fields)(self.job_id)
+                    continue
+                if msg is None:
+                    return
+                payload = json.loads(msg)
+                if payload.get('reset'):
+                    snapshot = payload['data']
+            self.progress.update(snapshot)
+            if await self.send_progress():
+                return
+            async for msg in channel.iter(encoding='utf-8'):
+                payload = json.loads(msg)
+                if payload.get('reset'):
+                    self.progress = {}
+                self.progress.update(payload['data'])
+                if await self.send_progress():
+                    return
+        except asyncio.CancelledError:
+            raise
+        except BaseException as e:
+            logger.error(f'订阅部署任务[{self.job_id}]进度异常, 原因: {e}')
+        finally:
+            if redis:
+                redis.close()
+                await redis.wait_closed()
+
+    async def send_progress(self):
+        """
+        :return: 部署是否已结束
+        """
+        await self.send(text_data=json.dumps({
+            'message': {'status': 0, 'data': json.dumps(DeployStageWriter.unflatten(self.progress))}
+        }))
+        if not self.progress.get('done'):
+            return False
+        await self.send(text_data=json.dumps({
+            'message': {'status': 0, 'data': 'devops-done'}
+        }))
+        await self.close()
+        return True
+
+    async def send_message(self, event):
         msg = event['message']
-        if msg == 'devops-done':
-            print('task end')
-            self.disconnect(0)
-        self.send(text_data=json.dumps({
+        await self.send(text_data=json.dumps({
             'message': {'status': 0, 'data': msg}
         }))
+        if msg == 'devops-done':
+            await self.close()
 
 
 class WatchK8s(WebsocketConsumer):
@@ -165,6 +250,76 @@ class WatchK8sLog(CustomWebsocketConsumer):
         }))
 
 
+class AsyncWatchK8sLog(AsyncWebsocketConsumer):
+    """
+    Pod日志异步推送
+    在事件循环中直接读取日志流, 不占用任务队列worker
+    """
+    # 日志缓冲行数, 缓冲满时暂停读取日志流
+    LOG_BUFFER = 500
+    # 单次连接最多推送行数
+    LOG_MAX_LINES = 3600
+
+    async def connect(self):
+        self.cluster_id = self.scope['url_route']['kwargs']['cluster_id']
+        self.namespace = self.scope['url_route']['kwargs']['namespace']
+        self.pod = self.scope['url_route']['kwargs']['pod']
+        lines = self.scope['query_string'].decode('utf-8').split('=')[-1]
+        self.lines = int(lines) if lines.isdigit() else 100
+        self.queue = asyncio.Queue(maxsize=self.LOG_BUFFER)
+        await self.accept()
+        self.tasks = [asyncio.ensure_future(self.read_log()),
+                      asyncio.ensure_future(self.send_log())]
+
+    async def disconnect(self, code):
+        for task in getattr(self, 'tasks', []):
+            task.cancel()
+
+    async def receive(self, text_data=None, bytes_data=None):
+        text_data_json = json.loads(text_data)
+        if text_data_json.get('message', None) == 'abort':
+            await self.close()
+            return
+        if text_data_json.get('heart', None) == 1:
+            await self.send(text_data=json.dumps(
+                {'message': {'status': 9, 'data': 'pong'}}
+            ))
+
+    def get_k8s_cli(self):
+        k8s = KubernetesCluster.objects.get(id=self.cluster_id)
+        return k8s_cli(k8s, json.loads(k8s.config))
+
+    async def read_log(self):
+        try:
+            cli = await database_sync_to_async(self.get_k8s_cli)()
+            if not cli[0]:
+                await self.queue.put('Kubernetes配置异常，请联系运维！')
+            else:
+                count = 0
+                async for line in cli[1].stream_pod_log(self.pod, self.namespace, tail_lines=self.lines):
+                    # 队列满时挂起, 推送跟不上时不再继续读取日志
+                    await self.queue.put(line)
+                    count += 1
+                    if count >= self.LOG_MAX_LINES:
+                        break
+        except asyncio.CancelledError:
+            raise
+        except BaseException as e:
+            logger.error(f'获取Pod {self.pod} 日志异常, 原因: {e}')
+            await self.queue.put(f'获取日志异常: {e}')
+        await self.queue.put('devops-done')
+
+    async def send_log(self):
+        while True:
+            msg = await self.queue.get()
+            if msg == 'devops-done':
+                await self.close()
+                break
+            await self.send(text_data=json.dumps({
+                'message': {'status': 0, 'data': msg}
+            }))
+
+
 class BuildJobConsoleOutput(CustomWebsocketConsumer):
 
     def connect(self):
@@ -173,6 +328,11 @@ class BuildJobConsoleOutput(CustomWebsocketConsumer):
         self.job_id = self.scope['url_route']['kwargs']['job_id']
         self.job_type = self.scope['url_route']['kwargs'].get(
             'job_type', 'app')
+        # delta=1 时只推送新增日志, 否则推送累计的完整日志
+        self.delta = parse_qs(self.scope['query_string'].decode(
+            'utf-8')).get('delta', ['0'])[0] == '1'
+        self.console = ''
+        self.console_size = 0
         self.result = jenkins_log_console.delay(
             self.channel_name, self.job_id, self.appinfo_id, self.job_type)
         self.accept()
@@ -190,15 +350,19 @@ class BuildJobConsoleOutput(CustomWebsocketConsumer):
                 {'message': {'status': 9, 'data': 'pong'}}
             ))
 
-    def send_message(self, event):
+    def send_console(self, event):
         msg = event['message']
-        if msg == 'devops-done':
-            print('task end')
-            self.disconnect(0)
+        if msg['offset'] == self.console_size:
+            # 偏移量连续才追加, 避免重复推送的日志片段
+            self.console += msg['data']
+            self.console_size += len(msg['data'].encode('utf-8'))
+        if not self.delta:
+            msg = {'status': msg['status'], 'data': self.console}
         self.send(text_data=json.dumps({
             'message': msg
         }))
 
+    def send_message(self, event):
         msg = event['message']
         if msg == 'devops-done':
             print('task end')
@@ -83,8 +83,12 @@ class BuildJobDocument(CustomDocument):
         serializer = BuildJobEsListSerializer
         fields = '__all__'
 
+    @classmethod
+    def write_index(cls):
+        return f"{ELASTICSEARCH_PREFIX}buildjob-{datetime.datetime.now().strftime('%Y')}"
+
     def save(self, **kwargs):
-        kwargs['index'] = f"{ELASTICSEARCH_PREFIX}buildjob-{datetime.datetime.now().strftime('%Y')}"
+        kwargs['index'] = self.write_index()
         return super().save(**kwargs)
 
 
@@ -110,6 +114,10 @@ class DeployJobDocument(CustomDocument):
         fields_remap = {'kubernetes': Text(), 'result': Text()}  # 定义需要重新映射的字段
         fields = '__all__'
 
+    @classmethod
+    def write_index(cls):
+        return f"{ELASTICSEARCH_PREFIX}deployjob-{datetime.datetime.now().strftime('%Y')}"
+
     def save(self, **kwargs):
-        kwargs['index'] = f"{ELASTICSEARCH_PREFIX}deployjob-{datetime.datetime.now().strftime('%Y')}"
+        kwargs['index'] = self.write_index()
         return super().save(**kwargs)
@@ -38,6 +38,10 @@ class PublishAppDocument(CustomDocument):
         serializer = PublishAppEsListSerializer
         fields = '__all__'
 
+    @classmethod
+    def write_index(cls):
+        return f"{ELASTICSEARCH_PREFIX}publishapp-{datetime.datetime.now().strftime('%Y')}"
+
     def save(self, **kwargs):
-        kwargs['index'] = f"{ELASTICSEARCH_PREFIX}publishapp-{datetime.datetime.now().strftime('%Y')}"
+        kwargs['index'] = self.write_index()
         return super().save(**kwargs)
@@ -8,7 +8,18 @@
 '''
 
 # here put the import lib
-def rds_transfer_es(document, instance):
+import time
+import logging
+
+from django.db import close_old_connections
+from django.utils.module_loading import import_string
+
+from common.durable_queue import DurableQueue
+
+logger = logging.getLogger('elasticsearch')
+
+
+def rds_transfer_data(document, instance):
     document_serializer = getattr(document.Django, "serializer", None)
     if document_serializer:
         serializer = document_serializer(instance)
@@ -26,6 +37,61 @@ def rds_transfer_es(document, instance):
         data = _data
     for i in model_field_exclude:
         data.pop(i, None)
+    return data
+
+
+def rds_transfer_es(document, instance):
+    data = rds_transfer_data(document, instance)
     data['_id'] = data['id']
     docu = document(**data)
     docu.save(skip_empty=False)
+
+
+class EsBulkIndexer(object):
+    """
+    模型批量转存ES
+
+    待同步的(文档类型, 主键)写入redis队列, 达到批量大小或间隔时间后由后台线程取出,
+    同一主键只同步一次, 重新读取模型数据后通过bulk_save批量写入, 失败按指数退避重试;
+    重试仍失败或进程被回收时记录保留在队列中.
+    """
+
+    def __init__(self, batch_size=200, interval=2, retry=3):
+        self.retry = retry
+        self.queue = DurableQueue('es-bulk-indexer', self.write, batch_size=batch_size, interval=interval)
+
+    def add(self, document, instance):
+        self.queue.put({'document': f"{document.__module__}.{document.__name__}", 'pk': instance.pk})
+
+    def flush(self):
+        return self.queue.flush()
+
+    def write(self, batch):
+        pending = {}
+        for i in batch:
+            pending.setdefault(i['document'], {})[i['pk']] = None
+        close_old_connections()
+        for document, pks in pending.items():
+            self._flush_document(import_string(document), list(pks))
+
+    def _flush_document(self, document, pks):
+        for attempt in range(self.retry):
+            try:
+                data = []
+                for instance in document.Django.model.objects.filter(pk__in=pks):
+                    docu = document(
+                        **rds_transfer_data(document, instance))
+                    _data = docu.to_dict(skip_empty=False)
+                    _data['_id'] = _data['id']
+                    data.append(_data)
+                if data:
+                    document.bulk_save(data, index=document.write_index())
+                return
+            except BaseException as e:
+                logger.warning(
+                    f'模型批量转存ES失败，第{attempt + 1}次，原因：{e}')
+                time.sleep(2 ** attempt)
+        raise Exception(f'模型批量转存ES失败，文档：{document.__name__}，ID：{pks}')
+
+
+es_bulk_indexer = EsBulkIndexer()
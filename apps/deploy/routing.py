@@ -10,7 +10,7 @@
 
 from django.urls import re_path
 
-from deploy.consumers import BuildJobStageOutput, BuildJobConsoleOutput, WatchK8s, WatchK8sLog, \
+from deploy.consumers import BuildJobStageOutput, BuildJobConsoleOutput, WatchK8s, AsyncWatchK8sLog, \
     WatchK8sDeployment
 
 websocket_urlpatterns = [
@@ -21,7 +21,7 @@ websocket_urlpatterns = [
     re_path(
         'ws/kubernetes/(?P<cluster_id>[0-9]+)/(?P<namespace>[^/]+)/(?P<service>[^/]+)/watch/$', WatchK8s.as_asgi()),
     re_path(
-        'ws/kubernetes/(?P<cluster_id>[0-9]+)/(?P<namespace>[^/]+)/(?P<pod>[^/]+)/log/$', WatchK8sLog.as_asgi()),
+        'ws/kubernetes/(?P<cluster_id>[0-9]+)/(?P<namespace>[^/]+)/(?P<pod>[^/]+)/log/$', AsyncWatchK8sLog.as_asgi()),
     re_path(
         'ws/kubernetes/(?P<job_id>[0-9]+)/(?P<app_id>[^/]+)/deployment/$', WatchK8sDeployment.as_asgi()),
 ]
@@ -8,11 +8,15 @@
 '''
 
 # here put the import lib
+from django.db import transaction
 from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
 
-from dbapp.model.model_deploy import BuildJob, DeployJob, PublishApp
-from deploy.rds_transfer import rds_transfer_es
+from dbapp.model.model_deploy import BuildJob, DeployJob, PublishApp, PublishOrder
+from deploy.rds_transfer import es_bulk_indexer
+from common.job_wait import notify_job
+from common.notify_queue import NotifyQueue
+from common.variables import MSG_KEY
 from devops_backend import documents
 
 
@@ -28,6 +32,23 @@ def save_es_record(sender, instance, created, **kwargs):
     if created is False or sender._meta.object_name == 'PublishApp':
         document = getattr(documents, f"{sender._meta.object_name}Document")
         try:
-            rds_transfer_es(document, instance)
+            # 事务提交后加入批量转存队列, 不阻塞当前请求
+            transaction.on_commit(
+                lambda: es_bulk_indexer.add(document, instance))
         except BaseException as e:
             logger.error(f'模型转存ES失败，原因：{e}')
+
+
+@receiver(post_save, sender=DeployJob, dispatch_uid='deployjob_ready')
+def notify_job_ready(sender, instance, created, **kwargs):
+    if created:
+        # 事务提交后唤醒等待该任务的部署进程
+        transaction.on_commit(lambda: notify_job('deployjob', instance.id))
+
+
+@receiver(post_save, sender=PublishOrder, dispatch_uid='publishorder_notify')
+def expedite_order_notify(sender, instance, created, **kwargs):
+    if instance.status in [1, 2, 4]:
+        # 工单结束, 待发送的部署通知立即到期
+        transaction.on_commit(
+            lambda: NotifyQueue.expedite(f"{MSG_KEY}{instance.order_id}"))
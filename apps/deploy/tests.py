@@ -1,3 +1,642 @@
-from django.test import TestCase
+import json
+import pickle
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import fakeredis
+from channels.testing import WebsocketCommunicator
+from django.core.cache import cache as django_cache
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from fakeredis import aioredis as fake_aioredis
+from django.test.utils import CaptureQueriesContext
+
+from common.deploy_stage import DeployStageWriter
+from common.extends.search import NgramSearchIndex
+from common.kubernetes_utils import DeploymentWatchCheck
+from common.utils.K8sAPI import K8sAPI
+from dbapp.model.model_deploy import DeployJob, PublishOrder
+from dbapp.model.model_ucenter import SystemConfig, UserProfile
+from deploy.consumers import WatchK8sDeployment
+from deploy.rds_transfer import EsBulkIndexer
+from devops_backend.documents import DeployJobDocument
+from qtasks.tasks_deploy import K8sDeploy, K8sDeploys
+
+# 基准部署: 单集群三个步骤, 每个步骤日志约3KB
+BENCH_CLUSTER = 'k8s-bench'
+BENCH_STAGES = ['镜像同步', '应用部署', '状态检测']
+BENCH_LOGS = {'message': {'items': ['x' * 64] * 48}}
+LOCMEM_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+def fake_redis():
+    return fakeredis.FakeStrictRedis(decode_responses=True)
+
+
+class RecordingCache(object):
+    """
+    记录django缓存写入字节数
+    """
+
+    def __init__(self):
+        self.bytes = 0
+
+    def set(self, key, value, *args, **kwargs):
+        self.bytes += len(pickle.dumps(value))
+
+
+class RecordingStageWriter(DeployStageWriter):
+    """
+    记录部署进度写入Redis的字节数
+    """
+
+    def __init__(self, job_id, redis):
+        with mock.patch('common.deploy_stage.RedisManage.conn', return_value=redis):
+            super().__init__(job_id)
+        self.bytes = 0
+
+    def write(self, mapping, reset=False):
+        self.bytes += sum(len(str(k)) + len(str(v)) for k, v in mapping.items())
+        super().write(mapping, reset=reset)
+
+
+def db_writes(queries):
+    writes = [i['sql'] for i in queries.captured_queries
+              if i['sql'].lstrip().upper().startswith(('INSERT', 'UPDATE'))]
+    return len(writes), sum(len(i.encode('utf-8')) for i in writes)
+
+
+class DeployStageWriteBenchmarkTest(TestCase):
+    """
+    单次部署的数据库写入次数及写入字节数: 改造前(每次步骤变化写完整结果并保存整行) / 改造后(进度增量写Redis, 步骤结束才写库)
+    """
+
+    def setUp(self):
+        self.job = DeployJob.objects.create(uniq_id='bench-job', appinfo_id=0)
+
+    def init_result(self):
+        return {'status': 3, 'col_active': '', 'worker': 'bench',
+                BENCH_CLUSTER: {'stages': [], 'status': 0}}
+
+    def stage_result(self, name):
+        return {'name': name, 'status': 1, 'msg': 'ok', 'logs': json.dumps(BENCH_LOGS['message'])}
+
+    def legacy_deploy(self, cache):
+        cd_result = self.init_result()
+        cd_result[BENCH_CLUSTER]['status'] = 3
+        cache.set(f'appdeploy:{self.job.id}', cd_result)
+        self.job.save()
+        for index, name in enumerate(BENCH_STAGES):
+            cd_result[BENCH_CLUSTER]['stages'].append(
+                {'name': name, 'status': 0, 'msg': '', 'logs': ''})
+            cache.set(f'appdeploy:{self.job.id}', cd_result)
+            self.job.save()
+            cd_result[BENCH_CLUSTER]['stages'][index] = self.stage_result(name)
+            cache.set(f'stage:{index}', cd_result[BENCH_CLUSTER]['stages'][index])
+            cache.set(f'appdeploy:{self.job.id}', cd_result)
+            self.job.save()
+        cd_result[BENCH_CLUSTER]['status'] = 1
+        self.job.save()
+
+    def coalesced_deploy(self, writer):
+        k8s = SimpleNamespace(id=1, name=BENCH_CLUSTER, version={'apiversion': 'apps/v1'})
+        deploy = K8sDeploy(k8s, self.job, None, 'default', {'yaml': {'metadata': {'name': 'bench'}}},
+                           self.init_result(), 'harbor/bench:1', 'bench:1', 'default/bench', '1',
+                           stage_writer=writer)
+        deploy.init_status()
+        for name in BENCH_STAGES:
+            deploy.init_stage(name)
+            deploy.save_stage_result(1, 'ok', BENCH_LOGS)
+        deploy.generate_deploy_status()
+        return deploy
+
+    def test_stage_write_benchmark(self):
+        legacy_cache = RecordingCache()
+        with CaptureQueriesContext(connection) as queries:
+            self.legacy_deploy(legacy_cache)
+        legacy_count, legacy_bytes = db_writes(queries)
+
+        redis = fake_redis()
+        cache = RecordingCache()
+        writer = RecordingStageWriter(self.job.id, redis)
+        with mock.patch('qtasks.tasks_deploy.cache', cache), \
+                CaptureQueriesContext(connection) as queries:
+            deploy = self.coalesced_deploy(writer)
+        count, db_bytes = db_writes(queries)
+
+        print(f'\n{"":<8}{"DB写入次数":>12}{"DB写入字节":>12}{"缓存/Redis字节":>16}')
+        print(f'{"改造前":<8}{legacy_count:>12}{legacy_bytes:>12}{legacy_cache.bytes:>16}')
+        print(f'{"改造后":<8}{count:>12}{db_bytes:>12}{cache.bytes + writer.bytes:>16}')
+
+        self.assertLess(count, legacy_count)
+        self.assertLess(db_bytes + cache.bytes + writer.bytes,
+                        legacy_bytes + legacy_cache.bytes)
+        # 进度哈希可还原完整部署结果
+        with mock.patch('common.deploy_stage.RedisManage.conn', return_value=redis):
+            self.assertEqual(DeployStageWriter.load(self.job.id)[BENCH_CLUSTER],
+                             deploy.cd_result[BENCH_CLUSTER])
+
+    def test_stage_save_touches_update_time(self):
+        update_time = self.job.update_time
+        writer = RecordingStageWriter(self.job.id, fake_redis())
+        with mock.patch('qtasks.tasks_deploy.cache', RecordingCache()):
+            self.coalesced_deploy(writer)
+        self.job.refresh_from_db()
+        self.assertGreater(self.job.update_time, update_time)
+
+
+class StubClusterDeploy(object):
+    """
+    模拟单个集群部署, latency 为集群接口的人为延迟, hang 为True时阻塞直至测试结束
+    """
+
+    def __init__(self, name, latency, hang=False):
+        self.k8s_obj = name
+        self.latency = latency
+        self.hang = hang
+        self.started = None
+        self.timed_out = False
+
+    def mark_timeout(self, timeout):
+        self.timed_out = True
+
+
+class StubK8sDeploys(K8sDeploys):
+    """
+    只保留多集群调度逻辑, 集群部署替换为延迟模拟
+    """
+
+    def __init__(self):
+        self.appinfo_obj = SimpleNamespace(uniq_tag='bench')
+        self.release = threading.Event()
+
+    def deploy_cluster(self, k8s_deploy):
+        k8s_deploy.started = time.time()
+        if k8s_deploy.hang:
+            self.release.wait()
+        else:
+            time.sleep(k8s_deploy.latency)
+
+
+class DeployClustersLatencyTest(TestCase):
+    """
+    多集群部署耗时: 改造前逐个集群部署 / 改造后并发部署, 及集群请求卡住时的超时返回
+    """
+    CLUSTERS = 4
+    LATENCY = 0.5
+
+    def test_concurrent_latency(self):
+        deploys = StubK8sDeploys()
+        clusters = [StubClusterDeploy(f'k8s-{i}', self.LATENCY) for i in range(self.CLUSTERS)]
+        start = time.time()
+        for i in clusters:
+            deploys.deploy_cluster(i)
+        sequential = time.time() - start
+
+        clusters = [StubClusterDeploy(f'k8s-{i}', self.LATENCY) for i in range(self.CLUSTERS)]
+        start = time.time()
+        deploys.deploy_clusters(clusters, workers=self.CLUSTERS, timeout=10)
+        concurrent = time.time() - start
+
+        print(f'\n{self.CLUSTERS}个集群, 单集群延迟{self.LATENCY}秒: '
+              f'逐个部署 {sequential:.2f}秒, 并发部署 {concurrent:.2f}秒')
+        self.assertLess(concurrent, sequential / 2)
+        self.assertFalse(any(i.timed_out for i in clusters))
+
+    def test_hung_cluster_does_not_block(self):
+        deploys = StubK8sDeploys()
+        hung = StubClusterDeploy('k8s-hung', 0, hang=True)
+        clusters = [StubClusterDeploy('k8s-ok', self.LATENCY), hung]
+        start = time.time()
+        try:
+            deploys.deploy_clusters(clusters, workers=2, timeout=1)
+            elapsed = time.time() - start
+        finally:
+            deploys.release.set()
+        # 超时判定按1秒间隔检查
+        self.assertLess(elapsed, 3)
+        self.assertTrue(hung.timed_out)
+        self.assertFalse(clusters[0].timed_out)
+
+
+class WatchK8sDeploymentPushTest(SimpleTestCase):
+    """
+    部署进度经Redis发布订阅推送: 无需轮询任务, 最终推送结果与进度哈希一致
+    """
+    JOB_ID = 1
+
+    def setUp(self):
+        self.server = fakeredis.FakeServer()
+        self.redis = fakeredis.FakeStrictRedis(server=self.server, decode_responses=True)
+        patches = [
+            mock.patch('common.deploy_stage.RedisManage.conn', return_value=self.redis),
+            mock.patch('deploy.consumers.aioredis.create_redis',
+                       side_effect=lambda *args, **kwargs: fake_aioredis.create_redis_pool(self.server)),
+            mock.patch('deploy.consumers.watch_k8s_deployment'),
+        ]
+        mocks = [i.start() for i in patches]
+        self.watch_task = mocks[-1]
+        for i in patches:
+            self.addCleanup(i.stop)
+        self.writer = DeployStageWriter(self.JOB_ID)
+        self.cd_result = {'status': 3, 'col_active': BENCH_CLUSTER, 'worker': 'bench',
+                          BENCH_CLUSTER: {'stages': [], 'status': 3}}
+
+    def communicator(self):
+        communicator = WebsocketCommunicator(
+            WatchK8sDeployment.as_asgi(), f'/ws/deploy/{self.JOB_ID}/1/')
+        communicator.scope['url_route'] = {
+            'kwargs': {'job_id': self.JOB_ID, 'app_id': 1}}
+        return communicator
+
+    async def receive_progress(self, communicator):
+        message = json.loads(await communicator.receive_from(timeout=3))['message']
+        return json.loads(message['data'])
+
+    async def run_deploy(self, communicator):
+        stage = {'name': BENCH_STAGES[0], 'status': 0, 'msg': '', 'logs': ''}
+        self.cd_result[BENCH_CLUSTER]['stages'].append(stage)
+        self.writer.set_stage(BENCH_CLUSTER, 0, stage, self.cd_result)
+        progress = await self.receive_progress(communicator)
+        self.assertEqual(progress[BENCH_CLUSTER]['stages'], [stage])
+
+        self.cd_result[BENCH_CLUSTER]['stages'][0] = dict(stage, status=1, msg='ok')
+        self.writer.set_stage(BENCH_CLUSTER, 0, self.cd_result[BENCH_CLUSTER]['stages'][0])
+        self.writer.set_status(BENCH_CLUSTER, 1)
+        await self.receive_progress(communicator)
+        await self.receive_progress(communicator)
+        self.writer.finish()
+        progress = await self.receive_progress(communicator)
+        done = json.loads(await communicator.receive_from(timeout=3))
+        self.assertEqual(done['message']['data'], 'devops-done')
+        return progress
+
+    async def test_push_progress(self):
+        self.writer.reset(self.cd_result)
+        communicator = self.communicator()
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        snapshot = await self.receive_progress(communicator)
+        self.assertEqual(snapshot[BENCH_CLUSTER], self.cd_result[BENCH_CLUSTER])
+
+        progress = await self.run_deploy(communicator)
+        self.assertEqual(progress, DeployStageWriter.load(self.JOB_ID))
+        self.assertEqual(progress[BENCH_CLUSTER]['status'], 1)
+        self.watch_task.apply_async.assert_not_called()
+        await communicator.disconnect()
+
+    async def test_wait_for_queued_job(self):
+        # 任务排队中尚未写入进度, 等待部署开始时的完整进度
+        with mock.patch.object(WatchK8sDeployment, 'job_pending', return_value=True):
+            communicator = self.communicator()
+            await communicator.connect()
+            self.assertTrue(await communicator.receive_nothing(timeout=0.5))
+            self.writer.reset(self.cd_result)
+            snapshot = await self.receive_progress(communicator)
+            self.assertEqual(snapshot[BENCH_CLUSTER], self.cd_result[BENCH_CLUSTER])
+            progress = await self.run_deploy(communicator)
+        self.assertEqual(progress, DeployStageWriter.load(self.JOB_ID))
+        self.watch_task.apply_async.assert_not_called()
+        await communicator.disconnect()
+
+    async def test_fallback_without_progress(self):
+        # 非K8S部署不写进度, 回退为轮询任务
+        with mock.patch.object(WatchK8sDeployment, 'job_pending', return_value=False):
+            communicator = self.communicator()
+            await communicator.connect()
+            await communicator.receive_nothing(timeout=0.5)
+        self.watch_task.apply_async.assert_called_once()
+        await communicator.disconnect()
+
+
+class FakeKubeAPIServer(object):
+    """
+    K8S API模拟服务, 记录收到的请求, 按路径保存下发的对象
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.objects = {}
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server.handle(self)
+
+            do_POST = do_PUT = do_PATCH = do_GET
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    @property
+    def kubeconfig(self):
+        return {'apiVersion': 'v1', 'kind': 'Config', 'current-context': 'bench',
+                'clusters': [{'name': 'bench', 'cluster': {'server': f'http://127.0.0.1:{self.httpd.server_port}'}}],
+                'users': [{'name': 'bench', 'user': {'token': 'bench'}}],
+                'contexts': [{'name': 'bench', 'context': {'cluster': 'bench', 'user': 'bench'}}]}
+
+    def handle(self, handler):
+        method = handler.command
+        path = handler.path.split('?')[0]
+        self.requests.append((method, path))
+        length = int(handler.headers.get('Content-Length') or 0)
+        body = json.loads(handler.rfile.read(length) or b'{}')
+        status, data = 404, {'kind': 'Status', 'apiVersion': 'v1', 'status': 'Failure', 'reason': 'NotFound',
+                             'code': 404}
+        if method == 'GET' and path == '/api/v1/namespaces':
+            status, data = 200, {'kind': 'NamespaceList', 'apiVersion': 'v1', 'metadata': {},
+                                 'items': [v for k, v in self.objects.items() if k.count('/') == 4]}
+        elif method == 'GET' and path in self.objects:
+            status, data = 200, self.objects[path]
+        elif method == 'POST':
+            self.objects[f"{path}/{body['metadata']['name']}"] = body
+            status, data = 201, body
+        elif method in ['PUT', 'PATCH'] and path in self.objects:
+            self.objects[path] = body
+            status, data = 200, body
+        payload = json.dumps(data).encode('utf-8')
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(payload)))
+        handler.end_headers()
+        handler.wfile.write(payload)
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class K8sResourceCacheApplyTest(TestCase):
+    """
+    重复发布时Service/Secret内容不变则不再请求K8S API, 内容变化仍会下发
+    """
+    NAMESPACE = 'dev-bench'
+    SECRET = 'harbor-bench'
+
+    def setUp(self):
+        django_cache.clear()
+        self.server = FakeKubeAPIServer()
+        self.addCleanup(self.server.close)
+        self.harbor = SystemConfig.objects.create(name='harbor-bench', type='cicd-harbor', config=json.dumps(
+            {'url': 'harbor.bench', 'user': 'bench', 'password': 'bench'}))
+        self.svc_yaml = {'apiVersion': 'v1', 'kind': 'Service', 'metadata': {'name': 'bench'},
+                         'spec': {'selector': {'app': 'bench'}, 'ports': [{'port': 8080, 'protocol': 'TCP'}]}}
+        patches = [mock.patch('qtasks.tasks_deploy.HARBOR_SECRET', self.SECRET),
+                   mock.patch('qtasks.tasks_deploy.template_svc_generate',
+                              side_effect=lambda appinfo_obj: (True, self.svc_yaml))]
+        for i in patches:
+            i.start()
+            self.addCleanup(i.stop)
+
+    def deploy(self):
+        """
+        一次发布的命名空间/Secret/Service检查
+        :return: 本次发布的K8S API请求
+        """
+        k8s = SimpleNamespace(id=1, name=BENCH_CLUSTER, version={'apiversion': 'apps/v1'},
+                              idc=SimpleNamespace(repo=self.harbor.id))
+        appinfo = SimpleNamespace(uniq_tag='bench.dev', app=SimpleNamespace(name='bench'))
+        job = SimpleNamespace(id=1, order_id=None)
+        deploy = K8sDeploy(k8s, job, appinfo, self.NAMESPACE, {'yaml': {'metadata': {'name': 'bench'}}},
+                           self.init_result(), 'harbor/bench:1', 'bench:1', 'default/bench', '1',
+                           stage_writer=mock.Mock())
+        deploy.k8s_cli = K8sAPI(k8s_config=self.server.kubeconfig)
+        start = len(self.server.requests)
+        deploy.check_namespace()
+        deploy.check_svc()
+        return self.server.requests[start:]
+
+    @staticmethod
+    def init_result():
+        return {BENCH_CLUSTER: {'stages': [], 'status': 0}}
+
+    def test_unchanged_resources_skip_requests(self):
+        secret = f'/api/v1/namespaces/{self.NAMESPACE}/secrets'
+        service = f'/api/v1/namespaces/{self.NAMESPACE}/services'
+        first = self.deploy()
+        self.assertIn(('POST', '/api/v1/namespaces'), first)
+        self.assertIn(('PUT', f'{secret}/{self.SECRET}'), first)
+        self.assertIn(('POST', secret), first)
+        self.assertIn(('POST', service), first)
+        self.assertIn(f'{service}/bench', self.server.objects)
+
+        # 内容未变更, 不再请求
+        self.assertEqual(self.deploy(), [])
+        self.assertEqual(self.deploy(), [])
+
+        # Service变更仍会下发, Secret未变跳过
+        self.svc_yaml['spec']['ports'][0]['port'] = 9090
+        self.assertEqual(self.deploy(), [('GET', f'{service}/bench'), ('PUT', f'{service}/bench')])
+        self.assertEqual(
+            self.server.objects[f'{service}/bench']['spec']['ports'][0]['port'], 9090)
+
+        # Secret变更重新下发
+        self.harbor.config = json.dumps(
+            {'url': 'harbor.bench', 'user': 'bench', 'password': 'changed'})
+        self.harbor.save()
+        self.assertEqual(self.deploy(), [('PUT', f'{secret}/{self.SECRET}')])
+
+        print(f'\n首次发布 {len(first)} 次请求, 内容未变的重复发布 0 次请求')
+
+
+def rollout_objects(revision, image, ready, generation=2, observed=2, conditions=None):
+    """
+    生成一次发布对应的Deployment/ReplicaSet/Pod
+    """
+    labels = {'status-app-name-for-ops-platform': 'bench'}
+    annotations = {DeploymentWatchCheck.REVISION_KEY: str(revision)}
+    rs_name = f'bench-{revision}'
+    deployment = {'metadata': {'name': 'bench', 'generation': generation, 'annotations': annotations},
+                  'spec': {'selector': {'matchLabels': labels}, 'template': {'metadata': {'labels': labels}}},
+                  'status': {'observedGeneration': observed, 'conditions': conditions or []}}
+    replicaset = {'metadata': {'name': rs_name, 'annotations': annotations, 'labels': labels},
+                  'spec': {'selector': {'matchLabels': labels},
+                           'template': {'spec': {'containers': [{'name': 'bench', 'image': image}]}}},
+                  'status': {'availableReplicas': int(ready), 'fullyLabeledReplicas': 1,
+                             'readyReplicas': int(ready)}}
+    pod = {'metadata': {'name': f'{rs_name}-x1', 'ownerReferences': [{'kind': 'ReplicaSet', 'name': rs_name}]},
+           'status': {'phase': 'Running' if ready else 'Pending',
+                      'containerStatuses': [{'ready': ready,
+                                             'state': {'running': {}} if ready else {'waiting': {}}}]}}
+    return deployment, replicaset, pod
+
+
+def recorded_rollout():
+    """
+    录制的滚动发布事件流: 旧版本(revision 1)已就绪, 新版本(revision 2)从创建到就绪
+    上一次发布遗留的ProgressDeadlineExceeded条件在控制器处理本次发布前不应判定失败
+    """
+    stale_condition = [{'type': 'Progressing', 'reason': 'ProgressDeadlineExceeded', 'message': 'stale'}]
+    _, old_rs, old_pod = rollout_objects(1, 'harbor/bench:1', True)
+    pending_deploy, new_rs, new_pod = rollout_objects(2, 'harbor/bench:2', False, observed=1,
+                                                      conditions=stale_condition)
+    deployment, ready_rs, ready_pod = rollout_objects(2, 'harbor/bench:2', True)
+    return [
+        ('replica_set', 'ADDED', old_rs),
+        ('pod', 'ADDED', old_pod),
+        ('deployment', 'ADDED', pending_deploy),
+        ('replica_set', 'ADDED', new_rs),
+        ('pod', 'ADDED', new_pod),
+        ('deployment', 'MODIFIED', deployment),
+        ('pod', 'MODIFIED', ready_pod),
+        ('replica_set', 'MODIFIED', ready_rs),
+        ('pod', 'DELETED', old_pod),
+    ]
+
+
+class ReplayK8sCli(object):
+    """
+    按资源类型回放录制的watch事件, 同时提供轮询检测使用的查询接口
+    """
+
+    def __init__(self, events, watch_error=None):
+        self.events = events
+        self.watch_error = watch_error
+        self.replayed = set()
+        self.calls = []
+
+    def watch_resource(self, kind, namespace='default', api_version='apps/v1', timeout_seconds=60, **kwargs):
+        self.calls.append(('watch', kind))
+        if self.watch_error:
+            raise self.watch_error
+        if kind not in self.replayed:
+            self.replayed.add(kind)
+            for i_kind, event_type, obj in self.events:
+                if i_kind == kind:
+                    yield event_type, obj
+        time.sleep(0.05)
+
+    def latest(self, kind):
+        objs = {}
+        for i_kind, event_type, obj in self.events:
+            if i_kind == kind:
+                if event_type == 'DELETED':
+                    objs.pop(obj['metadata']['name'], None)
+                else:
+                    objs[obj['metadata']['name']] = obj
+        return list(objs.values())
+
+    def fetch_deployment(self, name, namespace, api_version='apps/v1'):
+        self.calls.append(('fetch', 'deployment'))
+        return {'ecode': 200, 'message': self.latest('deployment')[0]}
+
+    def get_replica(self, namespace, api_version='apps/v1', **kwargs):
+        self.calls.append(('fetch', 'replica_set'))
+        return {'ecode': 200, 'message': {'items': self.latest('replica_set')}}
+
+    def get_pods(self, namespace=None, **kwargs):
+        self.calls.append(('fetch', 'pod'))
+        return {'ecode': 200, 'message': {'items': self.latest('pod')}}
+
+
+class DeploymentWatchCheckReplayTest(SimpleTestCase):
+    """
+    回放录制的事件流, 验证watch检测结果与轮询检测一致
+    """
+
+    def setUp(self):
+        patcher = mock.patch('common.kubernetes_utils.get_datadict',
+                             return_value={'count': 3, 'interval': 1})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def check(self, cli, tag='2'):
+        appinfo = SimpleNamespace(namespace='dev-bench', app=SimpleNamespace(name='bench', alias='bench'))
+        k8s = SimpleNamespace(name=BENCH_CLUSTER, version={'apiversion': 'apps/v1'})
+        return DeploymentWatchCheck(cli, appinfo, k8s, tag=tag, app_deploy_name='bench')
+
+    def test_replay_success(self):
+        events = recorded_rollout()
+        dc = self.check(ReplayK8sCli(events))
+        results = [dc.feed(*i) for i in events]
+        # 旧版本就绪及新版本未就绪期间不得出结论, 新版本副本集和Pod就绪后才判定成功
+        self.assertEqual(results[:-2], [None] * (len(events) - 2))
+        self.assertTrue(results[-2][0])
+        self.assertIn('bench-2-x1', results[-2][1])
+
+    def test_stale_revision_replicaset(self):
+        events = recorded_rollout()
+        dc = self.check(ReplayK8sCli(events))
+        # 新版本副本集尚未出现, 仅有已就绪的旧版本副本集
+        for i in events[:3] + [events[5]]:
+            self.assertIsNone(dc.feed(*i))
+        self.assertNotIn('bench-2', dc.replicasets)
+
+    def test_failed_condition_after_observed(self):
+        deployment, _, _ = rollout_objects(2, 'harbor/bench:2', False, conditions=[
+            {'type': 'Progressing', 'reason': 'ProgressDeadlineExceeded', 'message': 'deadline'}])
+        is_ok, desc, _ = self.check(ReplayK8sCli([])).feed('deployment', 'MODIFIED', deployment)
+        self.assertFalse(is_ok)
+        self.assertIn('deadline', desc)
+
+    def test_run_with_watch(self):
+        cli = ReplayK8sCli(recorded_rollout())
+        ret = self.check(cli).run()
+        self.assertEqual(ret['status'], 1)
+        self.assertNotIn(('fetch', 'deployment'), cli.calls)
+
+    def test_fallback_to_polling(self):
+        cli = ReplayK8sCli(recorded_rollout(), watch_error=RuntimeError('watch unavailable'))
+        ret = self.check(cli).run()
+        self.assertEqual(ret['status'], 1)
+        self.assertIn(('fetch', 'deployment'), cli.calls)
+        self.assertIn(('fetch', 'pod'), cli.calls)
+
+
+class EsBulkIndexerDurableTest(SimpleTestCase):
+    """
+    转存ES失败时待同步记录保留在redis队列, 恢复后按主键去重写入
+    """
+
+    def setUp(self):
+        self.server = fakeredis.FakeServer()
+        patcher = mock.patch('common.durable_queue.RedisManage.conn',
+                             side_effect=lambda: fakeredis.FakeStrictRedis(server=self.server))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.indexer = EsBulkIndexer(interval=3600)
+        self.addCleanup(setattr, self.indexer.queue, '_closed', True)
+
+    def test_failed_flush_keeps_records(self):
+        for pk in [1, 2, 1]:
+            self.indexer.add(DeployJobDocument, SimpleNamespace(pk=pk))
+        with mock.patch.object(EsBulkIndexer, '_flush_document', side_effect=RuntimeError('es down')):
+            self.assertFalse(self.indexer.flush())
+        self.assertEqual(fakeredis.FakeStrictRedis(server=self.server).llen(self.indexer.queue.key), 3)
+
+        with mock.patch.object(EsBulkIndexer, '_flush_document') as flush_document:
+            self.assertTrue(self.indexer.flush())
+        flush_document.assert_called_once_with(DeployJobDocument, [1, 2])
+
+
+class SearchIndexRelatedDeleteTest(TestCase):
+    """
+    跨关联索引字段所在对象删除后, 引用它的文档索引同步更新
+    """
+
+    def setUp(self):
+        self.server = fakeredis.FakeServer()
+        patcher = mock.patch('common.extends.search.RedisManage.conn',
+                             side_effect=lambda: fakeredis.FakeStrictRedis(server=self.server,
+                                                                          decode_responses=True))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.index = NgramSearchIndex('publishorder')
+
+    def test_creator_deleted(self):
+        user = UserProfile.objects.create(username='bench', first_name='基准用户')
+        order = PublishOrder.objects.create(order_id='bench-1', title='发布', creator=user)
+        self.index.rebuild()
+        self.assertEqual(self.index.search('基准用户'), {str(order.pk)})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            user.delete()
+        self.assertEqual(self.index.search('基准用户'), set())
+        self.assertEqual(self.index.search('发布'), {str(order.pk)})
@@ -43,6 +43,7 @@ from common.variables import *
 from common.extends.permissions import AppDeployPermission
 from common.extends.viewsets import CustomModelViewSet
 from common.extends.filters import CustomSearchFilter
+from common.extends.search import NgramSearchBackend
 from common.extends.handler import log_audit
 from common.utils.JenkinsAPI import GlueJenkins
 from common.utils.AesCipher import AesCipher
@@ -155,6 +156,7 @@ class PublishOrderViewSet(CustomModelViewSet):
     }
     search_fields = ('order_id', 'dingtalk_tid', 'title',
                      'content', 'effect', 'creator__first_name')
+    search_backend = NgramSearchBackend
     ordering_fields = ['update_time', 'created_time', 'status', 'category']
     ordering = ['-id', '-update_time']
 
@@ -250,6 +252,7 @@ class DeployJobViewSet(CustomModelViewSet):
                        CustomSearchFilter)
     filter_fields = ('appinfo_id', 'deployer', 'status', 'order_id', 'modules')
     search_fields = ('uniq_id', 'image')
+    search_backend = NgramSearchBackend
     ordering_fields = ['update_time', 'created_time', 'status', 'deploy_type']
     ordering = ['-update_time']
     custom_action = ['list', 'retrieve', 'deploy_history', 'deploy_result', 'cicd_dashboard_app_rollback',
@@ -515,6 +518,7 @@ class BuildJobViewSet(CustomModelViewSet):
     document_result = BuildJobResultDocument
     queryset = BuildJob.objects.all()
     queryset_result = BuildJobResult.objects.all()
+    approximate_count = True
     serializer_class = BuildJobListSerializer
     serializer_result_class = BuildJobResultSerializer
     filter_backends = (django_filters.rest_framework.DjangoFilterBackend,
@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class UcenterConfig(AppConfig):
     name = 'ucenter'
+
+    def ready(self):
+        import ucenter.signals  # noqa: F401
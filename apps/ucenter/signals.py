@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+'''
+@author  :   Charles Lai
+@file    :   signals.py
+@time    :   2023/05/10 10:21
+@contact :   qqing_lai@hotmail.com
+'''
+
+# here put the import lib
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from dbapp.model.model_ucenter import Permission, Role, UserProfile, DataDict
+from common.extends.permissions import bump_rbac_version
+from common.datadict_cache import DataDictCache
+
+
+import logging
+
+logger = logging.getLogger('api')
+
+
+@receiver(post_save, sender=Permission, dispatch_uid='permission_save_rbac')
+@receiver(post_delete, sender=Permission, dispatch_uid='permission_delete_rbac')
+@receiver(post_save, sender=Role, dispatch_uid='role_save_rbac')
+@receiver(post_delete, sender=Role, dispatch_uid='role_delete_rbac')
+@receiver(m2m_changed, sender=Role.permissions.through, dispatch_uid='role_permissions_rbac')
+@receiver(m2m_changed, sender=UserProfile.roles.through, dispatch_uid='user_roles_rbac')
+def rbac_changed(sender, **kwargs):
+    if kwargs.get('action', 'post_').startswith('pre_'):
+        return
+    try:
+        # 事务提交后递增权限版本号, 使权限快照失效
+        transaction.on_commit(bump_rbac_version)
+    except BaseException as e:
+        logger.error(f'更新权限版本号失败，原因：{e}')
+
+
+@receiver(pre_save, sender=DataDict, dispatch_uid='datadict_presave_cache')
+def datadict_presave(sender, instance, **kwargs):
+    # 记录修改前的key, 改名时旧key缓存一并失效
+    instance._origin_key = None
+    if instance.pk:
+        instance._origin_key = DataDict.objects.filter(
+            pk=instance.pk).values_list('key', flat=True).first()
+
+
+@receiver(post_save, sender=DataDict, dispatch_uid='datadict_save_cache')
+@receiver(post_delete, sender=DataDict, dispatch_uid='datadict_delete_cache')
+def datadict_changed(sender, instance, **kwargs):
+    names = [i for i in [instance.key, getattr(
+        instance, '_origin_key', None)] if i]
+
+    def invalidate():
+        try:
+            DataDictCache.invalidate(*names)
+        except BaseException as e:
+            logger.error(f'数据字典缓存失效通知失败，原因：{e}')
+    # 事务提交后删除缓存并通知各进程
+    transaction.on_commit(invalidate)
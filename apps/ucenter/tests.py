@@ -1,3 +1,172 @@
-from django.test import TestCase
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+import fakeredis
+from cachetools import TTLCache
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+from common.datadict_cache import DataDictCache
+from common.extends.handler import AuditLogSink
+from common.extends.permissions import RbacSnapshot, bump_rbac_version
+from common.variables import DATADICT_CACHE_KEY, DATADICT_CHANNEL, DATADICT_LOCAL_CACHE
+from dbapp.model.model_ucenter import AuditLog, DataDict
+
+LOCMEM_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+def process_cache(name):
+    """
+    模拟一个进程的数据字典缓存, 进程内状态各自独立
+    """
+    return type(name, (DataDictCache,), {'_local': TTLCache(**DATADICT_LOCAL_CACHE), '_lock': threading.Lock(),
+                                         '_pid': None, '_ready': False, '_generation': 0})
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class DataDictCacheConsistencyTest(TestCase):
+    """
+    两个进程各自持有本地缓存, 一个进程更新字典后另一个进程在失效窗口内读到新值
+    """
+    # 失效通知送达的最长等待时间(秒)
+    INVALIDATE_WINDOW = 1
+
+    def setUp(self):
+        self.server = fakeredis.FakeServer()
+        patches = [
+            mock.patch('common.datadict_cache.RedisManage.conn',
+                       side_effect=lambda: fakeredis.FakeStrictRedis(server=self.server)),
+            mock.patch('common.datadict_cache.RedisManage.get_pubsub',
+                       side_effect=lambda: fakeredis.FakeStrictRedis(server=self.server).pubsub(
+                           ignore_subscribe_messages=True)),
+        ]
+        for i in patches:
+            i.start()
+            self.addCleanup(i.stop)
+        self.processes = [process_cache('ProcessA'), process_cache('ProcessB')]
+        self.addCleanup(self.stop_listeners)
+        DataDict.objects.create(key='bench.key', value='v1')
+
+    def stop_listeners(self):
+        for i in self.processes:
+            i._pid = None
+        # 唤醒阻塞在订阅上的线程使其退出
+        fakeredis.FakeStrictRedis(server=self.server).publish(DATADICT_CHANNEL, '')
+
+    def wait_until(self, func, timeout):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if func():
+                return True
+            time.sleep(0.01)
+        return func()
+
+    def warm_up(self, process):
+        process.get('bench.key')
+        self.assertTrue(self.wait_until(lambda: process._ready, 2))
+        process.get('bench.key')
+        self.assertIn('bench.key', process._local)
+
+    def test_update_visible_in_other_process(self):
+        process_a, process_b = self.processes
+        for i in self.processes:
+            self.warm_up(i)
+            self.assertEqual(i.get('bench.key')['value'], 'v1')
+
+        # 进程A中修改字典, 提交后发布失效通知
+        with self.captureOnCommitCallbacks(execute=True):
+            row = DataDict.objects.get(key='bench.key')
+            row.value = 'v2'
+            row.save()
+
+        self.assertTrue(self.wait_until(
+            lambda: process_b.get('bench.key')['value'] == 'v2', self.INVALIDATE_WINDOW))
+        self.assertEqual(process_a.get('bench.key')['value'], 'v2')
+
+    def test_not_ready_skips_local_cache(self):
+        process_b = self.processes[1]
+        self.warm_up(process_b)
+        with process_b._lock:
+            # 订阅断开期间
+            process_b._ready = False
+        # 失效通知未送达, 仅redis缓存已删除
+        DataDict.objects.filter(key='bench.key').update(value='v2')
+        cache.delete(f"{DATADICT_CACHE_KEY}bench.key")
+        self.assertEqual(process_b.get('bench.key')['value'], 'v2')
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class RbacSnapshotSharedTest(TestCase):
+    """
+    权限版本号及平台白名单在进程内缓存, 重复的权限检查不访问共享缓存
+    """
+
+    def setUp(self):
+        cache.clear()
+        RbacSnapshot.refresh()
+        self.addCleanup(RbacSnapshot.refresh)
+
+    def test_repeated_checks_stay_local(self):
+        platform = {'whitelist': [{'url': '/api/bench/'}]}
+        with mock.patch('common.extends.permissions.get_redis_data', return_value=platform) as get_redis_data, \
+                mock.patch('common.extends.permissions.get_rbac_version', return_value=1) as get_rbac_version:
+            for _ in range(10):
+                self.assertIn('/api/bench/', RbacSnapshot.whitelist())
+                self.assertEqual(RbacSnapshot.version(), 1)
+        self.assertEqual(get_redis_data.call_count, 1)
+        self.assertEqual(get_rbac_version.call_count, 1)
+
+    def test_bump_version_visible_in_process(self):
+        version = RbacSnapshot.version()
+        self.assertEqual(bump_rbac_version(), version + 1)
+        self.assertEqual(RbacSnapshot.version(), version + 1)
+
+
+class AuditLogSinkDurableTest(TestCase):
+    """
+    审计日志写入redis队列, 写库失败或处理进程被回收时不丢失
+    """
+
+    def setUp(self):
+        self.server = fakeredis.FakeServer()
+        patcher = mock.patch('common.durable_queue.RedisManage.conn',
+                             side_effect=lambda: fakeredis.FakeStrictRedis(server=self.server))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def sink(self):
+        # 不启动定时处理, 由用例显式flush
+        sink = AuditLogSink(batch_size=10, interval=3600)
+        self.addCleanup(setattr, sink.queue, '_closed', True)
+        return sink
+
+    def put(self, sink, count):
+        for i in range(count):
+            sink.put(user='bench', type='', action=f'操作{i}', action_ip='127.0.0.1', content='', data='',
+                     old_data='')
+
+    def test_write_failure_keeps_records(self):
+        sink = self.sink()
+        self.put(sink, 3)
+        with mock.patch.object(AuditLog.objects, 'bulk_create', side_effect=RuntimeError('db down')):
+            self.assertFalse(sink.flush())
+        self.assertEqual(AuditLog.objects.count(), 0)
+        self.assertTrue(sink.flush())
+        self.assertEqual(list(AuditLog.objects.order_by('id').values_list('action', flat=True)),
+                         ['操作0', '操作1', '操作2'])
+
+    def test_killed_worker_batch_recovered(self):
+        killed, sink = self.sink(), self.sink()
+        self.put(killed, 3)
+        conn = fakeredis.FakeStrictRedis(server=self.server)
+        # 模拟进程取出批次后被SIGKILL: 批次停留在处理中列表, 租约已过期
+        processing = f"{killed.queue.key}:processing:killed"
+        for _ in range(2):
+            conn.rpoplpush(killed.queue.key, processing)
+        self.assertTrue(sink.flush())
+        self.assertEqual(AuditLog.objects.count(), 1)
+        sink.queue.recover()
+        self.assertTrue(sink.flush())
+        self.assertEqual(AuditLog.objects.count(), 3)
+        self.assertFalse(conn.exists(processing))
@@ -151,6 +151,7 @@ class AuditLogViewSet(CustomModelViewSet):
     )
     queryset = AuditLog.objects.all()
     serializer_class = AuditLogSerializers
+    approximate_count = True
     filter_backends = (django_filters.rest_framework.DjangoFilterBackend,
                        CustomSearchFilter, OrderingFilter)
     filter_class = AuditLogFilter
@@ -40,6 +40,7 @@ from common.utils.AesCipher import AesCipher
 from common.MailSend import OmsMail
 from common.ext_fun import get_datadict, get_redis_data, k8s_cli, set_redis_data, template_svc_generate
 from common.custom_format import convert_xml_to_str_with_pipeline
+from common.deploy_stage import get_deploy_result
 from common.variables import *
 
 from config import FEISHU_URL, MEDIA_ROOT, SOCIAL_AUTH_FEISHU_KEY, SOCIAL_AUTH_FEISHU_SECRET, SOCIAL_AUTH_GITLAB_API_URL
@@ -76,7 +77,7 @@ def watch_k8s_deployment(*args):
     count = 0
     while _flag:
         app_deploy_stat = cache.get(f'appdeploy:stat:{job.id}')
-        msg = cache.get(f'appdeploy:{job.id}')
+        msg = get_deploy_result(job.id)
         if not app_deploy_stat:
             async_to_sync(channel_layer.send)(
                 channel_name,
@@ -110,6 +111,7 @@ def watch_k8s_deployment(*args):
             if DeployJob.objects.get(id=job_id).status != 3:
                 cache.delete(f'appdeploy:{job.id}')
                 redis_conn.delete(job.id)
+                redis_conn.delete(f"{CD_STAGE_HASH_KEY}{job.id}")
 
 
 @app.task
@@ -284,6 +286,7 @@ def jenkins_log_console(*arg, **kwargs):
     jbuild = JenkinsBuild(JENKINS_CONFIG['url'], username=JENKINS_CONFIG['user'],
                           password=JENKINS_CONFIG['password'], job_id=job_id, appinfo_id=appinfo_id, job_type=job_type)
     count = 0
+    offset = 0
     _flag = True
     while _flag:
         time.sleep(0.1)
@@ -293,16 +296,18 @@ def jenkins_log_console(*arg, **kwargs):
             if job_name and job:
                 if job.build_number == 0:
                     continue
-            ok, message = jbuild.log_console()
+            # 基于progressiveText偏移量只获取新增日志
+            ok, message, offset = jbuild.log_console_progressive(offset)
             if ok:
                 _flag = False
-            async_to_sync(channel_layer.send)(
-                channel_name,
-                {
-                    "type": "send.message",
-                    "message": message
-                }
-            )
+            if message['data'] or ok:
+                async_to_sync(channel_layer.send)(
+                    channel_name,
+                    {
+                        "type": "send.console",
+                        "message": message
+                    }
+                )
             if count > 600 or _flag is False:
                 async_to_sync(channel_layer.send)(
                     channel_name,
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Author : Charles Lai
+@Contact : qqing_lai@hotmail.com
+@Time : 2023/05/19 上午10:12
+@FileName: datadict_cache.py
+@Blog ：https://imaojia.com
+"""
+
+import os
+import time
+import threading
+
+from cachetools import TTLCache
+from django.core.cache import cache
+
+from dbapp.models import DataDict
+from common.utils.RedisAPI import RedisManage
+from common.variables import DATADICT_CACHE_KEY, DATADICT_CACHE_TTL, DATADICT_CHANNEL, DATADICT_LOCAL_CACHE
+import logging
+
+logger = logging.getLogger(__name__)
+
+_MISS = object()
+
+
+class DataDictCache(object):
+    """
+    数据字典两级缓存: 进程内LRU -> redis -> 数据库
+    字典变更时删除redis缓存并发布失效通知, 各进程订阅后淘汰本地缓存;
+    订阅未就绪或断开期间不使用本地缓存
+    """
+    _local = TTLCache(**DATADICT_LOCAL_CACHE)
+    _lock = threading.Lock()
+    _pid = None
+    _ready = False
+    # 失效计数, 读取期间发生失效则不回填本地缓存
+    _generation = 0
+
+    @classmethod
+    def get(cls, name):
+        """
+        :return: 字典数据, 不存在时返回空字典
+        """
+        cls._ensure_listener()
+        with cls._lock:
+            row = cls._local.get(name, _MISS) if cls._ready else _MISS
+            generation = cls._generation
+        if row is not _MISS:
+            return row
+        row = cache.get(f"{DATADICT_CACHE_KEY}{name}")
+        if row is None:
+            row = cls.load(name)
+            cache.set(f"{DATADICT_CACHE_KEY}{name}", row, DATADICT_CACHE_TTL)
+        with cls._lock:
+            if cls._ready and cls._generation == generation:
+                cls._local[name] = row
+        return row
+
+    @staticmethod
+    def load(name):
+        try:
+            qs = DataDict.objects.get(key=name)
+        except DataDict.DoesNotExist:
+            return {}
+        return {'id': qs.id, 'key': qs.key, 'value': qs.value, 'desc': qs.desc, 'extra': qs.extra}
+
+    @staticmethod
+    def invalidate(*names):
+        """
+        删除redis缓存并通知所有进程淘汰本地缓存
+        """
+        conn = RedisManage().conn()
+        for name in set(names):
+            cache.delete(f"{DATADICT_CACHE_KEY}{name}")
+            conn.publish(DATADICT_CHANNEL, name)
+
+    @classmethod
+    def evict(cls, name=None):
+        with cls._lock:
+            if name is None:
+                cls._local.clear()
+            else:
+                cls._local.pop(name, None)
+            cls._generation += 1
+
+    @classmethod
+    def _ensure_listener(cls):
+        if cls._pid == os.getpid():
+            return
+        with cls._lock:
+            if cls._pid == os.getpid():
+                return
+            # 首次调用或fork后的新进程, 重新订阅
+            cls._pid = os.getpid()
+            cls._ready = False
+            cls._local.clear()
+            cls._generation += 1
+        threading.Thread(target=cls._listen, args=(cls._pid,),
+                         name='datadict-invalidate', daemon=True).start()
+
+    @classmethod
+    def _listen(cls, pid):
+        while cls._pid == pid:
+            pubsub = None
+            try:
+                pubsub = RedisManage.get_pubsub()
+                pubsub.subscribe(DATADICT_CHANNEL)
+                cls.evict()
+                with cls._lock:
+                    cls._ready = True
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        cls.evict(message['data'].decode())
+            except BaseException as e:
+                logger.warning(f'数据字典失效订阅异常，原因：{e}')
+            finally:
+                with cls._lock:
+                    cls._ready = False
+                cls.evict()
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except BaseException:
+                        pass
+            time.sleep(1)
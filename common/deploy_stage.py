@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Author : Charles Lai
+@Contact : qqing_lai@hotmail.com
+@Time : 2023/05/12 下午3:18
+@FileName: deploy_stage.py
+@Blog ：https://imaojia.com
+"""
+
+import json
+import logging
+
+from django.core.cache import cache
+
+from common.utils.RedisAPI import RedisManage
+from common.variables import CD_STAGE_HASH_KEY, CD_STAGE_CHANNEL
+
+logger = logging.getLogger(__name__)
+
+# 部署结果中的非集群字段
+META_FIELDS = ['status', 'col_active', 'worker']
+
+
+class DeployStageWriter(object):
+    """
+    部署进度写入
+    进度按字段增量写入Redis哈希: meta / {集群}::status / {集群}::stage::{序号} / done
+    每次写入的字段同时发布到 {CD_STAGE_CHANNEL}{job.id}, 供前端订阅
+    """
+
+    def __init__(self, job_id, expire=60 * 30):
+        self.key = f"{CD_STAGE_HASH_KEY}{job_id}"
+        self.channel = f"{CD_STAGE_CHANNEL}{job_id}"
+        self.expire = expire
+        self.redis = RedisManage().conn()
+
+    @staticmethod
+    def flatten(cd_result, meta=True):
+        mapping = {}
+        if meta:
+            mapping['meta'] = json.dumps(
+                {k: cd_result.get(k) for k in META_FIELDS})
+        for cluster, v in cd_result.items():
+            if cluster in META_FIELDS or not isinstance(v, dict):
+                continue
+            mapping[f'{cluster}::status'] = v.get('status', 0)
+            for index, stage in enumerate(v.get('stages', [])):
+                mapping[f'{cluster}::stage::{index}'] = json.dumps(stage)
+        return mapping
+
+    def write(self, mapping, reset=False):
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.hset(self.key, mapping=mapping)
+            pipe.expire(self.key, self.expire)
+            pipe.execute()
+            self.redis.publish(self.channel, json.dumps(
+                {'reset': reset, 'data': mapping}))
+        except BaseException as e:
+            logger.error(f'写入部署进度 {self.key} 失败, 原因: {e}')
+
+    def reset(self, cd_result):
+        """
+        写入完整部署结果
+        """
+        try:
+            self.redis.delete(self.key)
+        except BaseException as e:
+            logger.error(f'清理部署进度 {self.key} 失败, 原因: {e}')
+        self.write(self.flatten(cd_result), reset=True)
+
+    def finish(self):
+        """
+        标记部署结束
+        """
+        self.write({'done': 1})
+
+    def set_meta(self, cd_result):
+        self.write({'meta': json.dumps(
+            {k: cd_result.get(k) for k in META_FIELDS})})
+
+    def set_status(self, cluster, status):
+        self.write({f'{cluster}::status': status})
+
+    def set_stage(self, cluster, index, stage, cd_result=None):
+        mapping = {f'{cluster}::stage::{index}': json.dumps(stage)}
+        if cd_result is not None:
+            mapping['meta'] = json.dumps(
+                {k: cd_result.get(k) for k in META_FIELDS})
+        self.write(mapping)
+
+    @staticmethod
+    def load_fields(job_id):
+        try:
+            return RedisManage().conn().hgetall(f"{CD_STAGE_HASH_KEY}{job_id}")
+        except BaseException as e:
+            logger.error(f'读取部署进度 {job_id} 失败, 原因: {e}')
+            return None
+
+    @classmethod
+    def load(cls, job_id):
+        """
+        从哈希还原部署结果
+        """
+        data = cls.load_fields(job_id)
+        if not data:
+            return None
+        return cls.unflatten(data)
+
+    @staticmethod
+    def unflatten(data):
+        data = dict(data)
+        data.pop('done', None)
+        cd_result = json.loads(data.pop('meta', '{}'))
+        stages = {}
+        for field, value in data.items():
+            cluster, _, name = field.partition('::')
+            cd_result.setdefault(cluster, {'stages': [], 'status': 0})
+            if name == 'status':
+                cd_result[cluster]['status'] = int(value)
+            elif name.startswith('stage::'):
+                stages.setdefault(cluster, {})[int(
+                    name.split('::')[-1])] = json.loads(value)
+        for cluster, items in stages.items():
+            cd_result[cluster]['stages'] = [items[i] for i in sorted(items)]
+        return cd_result
+
+
+def get_deploy_result(job_id):
+    """
+    获取部署进度, 非K8S部署仍从缓存读取
+    """
+    return DeployStageWriter.load(job_id) or cache.get(f'appdeploy:{job_id}')
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Author : Charles Lai
+@Contact : qqing_lai@hotmail.com
+@Time : 2023/05/26 上午10:12
+@FileName: durable_queue.py
+@Blog ：https://imaojia.com
+"""
+
+import atexit
+import json
+import os
+import threading
+import time
+import uuid
+import logging
+
+import redis
+
+from common.utils.RedisAPI import RedisManage
+from common.variables import DURABLE_QUEUE_KEY, DURABLE_QUEUE_LEASE
+
+logger = logging.getLogger(__name__)
+
+
+class DurableQueue(object):
+    """
+    基于Redis列表的批量处理队列
+
+    put写入Redis列表 {DURABLE_QUEUE_KEY}{name}, 进程内后台线程定时或攒够一批后取出交给handler处理;
+    取出的批次先转存到处理中列表并持有租约, 处理成功后删除, 失败放回队列重试;
+    进程被回收(SIGTERM/SIGKILL/max-tasks)时租约过期, 由任一进程的后台线程放回队列, 记录不会丢失.
+    Redis不可用时put直接调用handler同步处理.
+    """
+
+    def __init__(self, name, handler, batch_size=100, interval=1, lease=DURABLE_QUEUE_LEASE):
+        """
+        :param handler: 批量处理函数, 参数为记录列表, 抛出异常时整批放回队列
+        :param lease: 处理中批次的租约时长(秒), 需大于单批处理耗时
+        """
+        self.name = name
+        self.key = f"{DURABLE_QUEUE_KEY}{name}"
+        self.handler = handler
+        self.batch_size = batch_size
+        self.interval = interval
+        self.lease = lease
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._event = threading.Event()
+        self._pid = None
+        self._closed = False
+        self._recovered = 0
+        atexit.register(self.close)
+
+    @staticmethod
+    def conn():
+        return RedisManage().conn()
+
+    def _ensure_worker(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        threading.Thread(target=self._run, args=(self._pid,),
+                         name=f'durable-queue-{self.name}', daemon=True).start()
+
+    def put(self, item):
+        if not self._closed:
+            self._ensure_worker()
+        try:
+            size = self.conn().lpush(self.key, json.dumps(item, default=str))
+        except BaseException as e:
+            logger.warning(f'队列[{self.name}]写入redis失败, 直接处理, 原因: {e}')
+            self.handler([item])
+            return
+        if size >= self.batch_size:
+            self._event.set()
+
+    def _run(self, pid):
+        while self._pid == pid and not self._closed:
+            self._event.wait(self.interval)
+            self._event.clear()
+            try:
+                if time.time() - self._recovered > self.lease:
+                    self.recover()
+                self.flush()
+            except BaseException as e:
+                logger.error(f'队列[{self.name}]处理异常, 原因: {e}')
+
+    def _restore(self, conn, processing):
+        """
+        处理中批次放回队列待处理一端
+        """
+        with conn.pipeline() as pipe:
+            try:
+                pipe.watch(processing)
+                items = pipe.lrange(processing, 0, -1)
+                pipe.multi()
+                if items:
+                    pipe.rpush(self.key, *items)
+                pipe.delete(processing)
+                pipe.execute()
+            except redis.WatchError:
+                # 已被其他进程放回
+                pass
+
+    def recover(self):
+        """
+        放回租约已过期(处理进程已退出)的批次
+        """
+        self._recovered = time.time()
+        conn = self.conn()
+        for processing in conn.scan_iter(f"{self.key}:processing:*"):
+            if isinstance(processing, bytes):
+                processing = processing.decode('utf-8')
+            token = processing.rsplit(':', 1)[-1]
+            if conn.exists(f"{self.key}:lease:{token}"):
+                continue
+            logger.warning(f'队列[{self.name}]批次{token}租约已过期, 放回队列')
+            self._restore(conn, processing)
+
+    def flush(self):
+        """
+        :return: 队列是否已全部处理
+        """
+        conn = self.conn()
+        with self._flush_lock:
+            while True:
+                token = uuid.uuid4().hex
+                processing = f"{self.key}:processing:{token}"
+                lease = f"{self.key}:lease:{token}"
+                conn.set(lease, os.getpid(), ex=self.lease)
+                # 自最早写入的一端取出, 逐条原子转存到处理中列表
+                pipe = conn.pipeline(transaction=False)
+                for _ in range(self.batch_size):
+                    pipe.rpoplpush(self.key, processing)
+                items = [i for i in pipe.execute() if i is not None]
+                if not items:
+                    conn.delete(lease)
+                    return True
+                try:
+                    self.handler([json.loads(i) for i in items])
+                except BaseException as e:
+                    logger.error(f'队列[{self.name}]批量处理失败, 放回队列, 原因: {e}')
+                    self._restore(conn, processing)
+                    conn.delete(lease)
+                    return False
+                conn.delete(processing, lease)
+
+    def close(self):
+        self._closed = True
+        try:
+            self.flush()
+        except BaseException as e:
+            logger.error(f'队列[{self.name}]退出前处理失败, 记录保留在redis, 原因: {e}')
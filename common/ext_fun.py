@@ -9,6 +9,7 @@
 """
 from gitlab.exceptions import GitlabGetError
 import copy
+import hashlib
 from functools import reduce
 import operator
 
@@ -17,21 +18,22 @@ from common.utils.GitLabAPI import GitLabAPI
 from common.utils.HarborAPI import HarborAPI
 from common.utils.JenkinsAPI import GlueJenkins
 from common.custom_format import convert_xml_to_str_with_pipeline
+from common.datadict_cache import DataDictCache
 from common.variables import DASHBOARD_TIME_FORMAT, DASHBOARD_TIME_FORMAT_T, DASHBOARD_TIME_FREQNAMES, \
     DASHBOARD_TIME_FREQNAMES_T, SENSITIVE_KEYS, JENKINS_CALLBACK_KEY, \
-    JENKINS_STATUS_MAP, DEV_LANGUAGE_KEY
+    JENKINS_STATUS_MAP, DEV_LANGUAGE_KEY, TEMPLATE_CACHE_KEY, TEMPLATE_CACHE_TTL
 from dbapp.models import AppInfo, Product, KubernetesCluster, KubernetesDeploy, MicroApp, Project, ProjectConfig, DevLanguage, BuildJob, UserProfile, SystemConfig, Role, Permission, Menu, DataDict
 
 from django.conf import settings
 from django.core.cache import cache
 from django.utils import timezone
-from django.db.models import Q
+from django.db.models import Q, OuterRef, Subquery
 from social_django.utils import load_strategy
 from rest_framework.utils.serializer_helpers import ReturnDict
 
 from config import SOCIAL_AUTH_GITLAB_API_URL, GITLAB_ADMIN_TOKEN
 
-from common.utils.K8sAPI import K8sAPI
+from common.utils.K8sAPI import K8sAPI, k8s_client_pool
 
 from urllib.parse import urlparse, quote_plus
 from dateutil.relativedelta import relativedelta
@@ -94,14 +96,17 @@ def get_datadict(name, config=0, default_value=None):
     从数据字典获取数据
     """
     try:
-        qs = DataDict.objects.get(key=name)
+        qs = DataDictCache.get(name)
     except BaseException as e:
+        logger.warning(f'获取数据字典{name}失败，原因：{e}')
+        return default_value
+    if not qs:
         return default_value
     if config:
-        ret = json.loads(qs.extra)
+        ret = json.loads(qs['extra'])
     else:
-        ret = {'id': qs.id, 'key': qs.key,
-               'value': qs.value, 'desc': qs.desc}
+        ret = {'id': qs['id'], 'key': qs['key'],
+               'value': qs['value'], 'desc': qs['desc']}
     return ret
 
 
@@ -188,27 +193,81 @@ def harbor_cli(namespace, **filters):
 
 
 def k8s_cli(k8s, k8s_config):
-    try:
-        if k8s_config['type'] == 'basic':
+    """
+    获取集群K8sAPI实例, 同一集群在配置未变更时复用连接池中的实例
+    """
+    def _build():
+        _config = dict(k8s_config)
+        if _config['type'] == 'basic':
             # basic auth or token auth
-            k8s_config.pop('config', None)
-            k8s_config.pop('type', None)
-            cli = K8sAPI(**k8s_config)
-        else:
-            eks = None
-            eks_token = None
-            k8s_config = yaml.safe_load(k8s_config['config'])
+            _config.pop('config', None)
+            _config.pop('type', None)
+            return K8sAPI(**_config)
+        eks = None
+        eks_token = None
+        return K8sAPI(k8s_config=yaml.safe_load(_config['config']), api_key=eks_token, eks=eks)
+
+    try:
+        if k8s_config['type'] != 'basic':
             if k8s.idc.type == 1 and k8s.idc.supplier.split('.')[-1] == 'aws':
                 return False, 'not support.'
-            cli = K8sAPI(k8s_config=k8s_config, api_key=eks_token, eks=eks)
+        cli = k8s_client_pool.get(k8s.id, k8s_config, _build)
         return True, cli
     except BaseException as e:
         return False, str(e)
 
 
+def template_version(appinfo_obj: AppInfo):
+    """
+    获取模板各层的更新时间, 作为模板编译缓存的版本
+    应用模块 / 应用 / 项目 / 产品 / 区域 / 环境 / 项目环境配置 / 开发语言
+    应用模块每次发布都会更新版本号, 不使用其更新时间, 改为取参与模板编译的字段
+    """
+    project_config = ProjectConfig.objects.filter(project_id=OuterRef('app__project_id'),
+                                                  environment_id=OuterRef('environment_id')).values('update_time')[:1]
+    language = DevLanguage.objects.filter(
+        name=OuterRef('app__language')).values('update_time')[:1]
+    return AppInfo.objects.filter(id=appinfo_obj.id).annotate(
+        project_config_time=Subquery(project_config), language_time=Subquery(language)
+    ).values_list('app_id', 'environment_id', 'template', 'app__update_time', 'app__project__update_time',
+                  'app__project__product__update_time', 'app__project__product__region__update_time',
+                  'environment__update_time', 'project_config_time', 'language_time').first()
+
+
 def template_generate(appinfo_obj: AppInfo, image=None, partial_deploy_replicas: int = 0):
     """
     生成Kubernetes Deployment Yaml
+    编译结果按模板各层更新时间缓存, 命中时只替换镜像及重启标记
+    """
+    harbor_config = get_redis_data('cicd-harbor')
+    harbor_url = harbor_config['url'].split('://')[1]
+    image = f"{harbor_url}/{image}"
+
+    cache_key = None
+    version = template_version(appinfo_obj)
+    if version:
+        cache_key = f"{TEMPLATE_CACHE_KEY}{appinfo_obj.id}:{hashlib.md5(str(version).encode('utf-8')).hexdigest()}"
+    ret = cache_key and cache.get(cache_key)
+    if not ret:
+        ret = template_compile(appinfo_obj)
+        if ret['ecode'] != 200:
+            return ret
+        if cache_key:
+            cache.set(cache_key, ret, TEMPLATE_CACHE_TTL)
+    ret = copy.deepcopy(ret)
+    container = ret['yaml']['spec']['template']['spec']['containers'][0]
+    container['image'] = image
+    for i in container['env']:
+        if i['name'] == '_RESTART':
+            # _RESTART变量用于强制更新deployment
+            i['value'] = datetime.now().strftime('%Y%m%d%H%M%S')
+    ret['image'] = image
+    return ret
+
+
+def template_compile(appinfo_obj: AppInfo):
+    """
+    合并各层模板, 编译Deployment Yaml(不含镜像)
     """
 
     def health_lifecycle_generate(item, enable=True):
@@ -245,9 +304,6 @@ def template_generate(appinfo_obj: AppInfo, image=None, partial_deploy_replicas:
     project_config = ProjectConfig.objects.filter(project_id=appinfo_obj.app.project.id,
                                                   environment_id=appinfo_obj.environment.id)
     namespace = appinfo_obj.namespace
-    harbor_config = get_redis_data('cicd-harbor')
-    harbor_url = harbor_config['url'].split('://')[1]
-    image = f"{harbor_url}/{image}"
 
     template = {}
     # 模板优先级
@@ -312,7 +368,7 @@ def template_generate(appinfo_obj: AppInfo, image=None, partial_deploy_replicas:
         yaml_template['metadata']['name'] = appinfo_obj.app.name
         yaml_template['metadata']['namespace'] = namespace
         yaml_template['spec']['template']['spec']['containers'][0]['name'] = appinfo_obj.app.name
-        yaml_template['spec']['template']['spec']['containers'][0]['image'] = image
+        yaml_template['spec']['template']['spec']['containers'][0]['image'] = None
         command = appinfo_obj.app.template.get(
             'command', None) or language_obj.labels.get('command', None)
         if command:
@@ -445,7 +501,7 @@ def template_generate(appinfo_obj: AppInfo, image=None, partial_deploy_replicas:
         containers = container_generate(
             project_config.first().template.get('containers', []))
     yaml_template['spec']['template']['spec']['containers'].extend(containers)
-    ret = {'ecode': 200, 'image': image, 'yaml': yaml_template}
+    ret = {'ecode': 200, 'yaml': yaml_template}
 
     if partial_deploy_yaml_template:
         ret['partial_deploy_yaml'] = partial_deploy_yaml_template
@@ -157,6 +157,13 @@ class CustomSearchFilter(SearchFilter):
         ]
 
         base = queryset
+        # 搜索后端先通过索引缩小范围, 再以原条件校验
+        backend = getattr(view, 'search_backend', None)
+        if backend is not None:
+            candidates = backend().candidates(
+                queryset.model, search_fields, search_terms, search_condition)
+            if candidates is not None:
+                queryset = queryset.filter(pk__in=candidates)
         conditions = []
         for search_term in search_terms:
             queries = [
@@ -8,18 +8,50 @@
 @Blog ：https://imaojia.com
 """
 
+from django.db import close_old_connections
+
 from dbapp.models import AuditLog
 
+from common.durable_queue import DurableQueue
 from common.get_ip import user_ip
 from common.ext_fun import mask_sensitive_data
+from common.variables import AUDIT_LOG_BATCH_SIZE, AUDIT_LOG_FLUSH_INTERVAL
+import logging
+
+logger = logging.getLogger('api')
+
+
+class AuditLogSink(object):
+    """
+    审计日志异步批量写入
+    请求线程只写入redis队列, 后台线程定时或攒够一批后bulk_create;
+    写库失败或进程被回收时记录保留在队列中重试
+    """
+
+    def __init__(self, batch_size=AUDIT_LOG_BATCH_SIZE, interval=AUDIT_LOG_FLUSH_INTERVAL):
+        self.queue = DurableQueue('auditlog', self.write, batch_size=batch_size, interval=interval)
+
+    @staticmethod
+    def write(batch):
+        close_old_connections()
+        AuditLog.objects.bulk_create([AuditLog(**i) for i in batch])
+
+    def put(self, **kwargs):
+        self.queue.put(kwargs)
+
+    def flush(self):
+        return self.queue.flush()
+
+
+audit_sink = AuditLogSink()
 
 
 def log_audit(request, action_type, action, content=None, data=None, old_data=None, user=None):
     if user is None:
         user = request.user.first_name or request.user.username
 
-    AuditLog.objects.create(user=user, type=action_type, action=action,
-                            action_ip=user_ip(request),
-                            content=f"{mask_sensitive_data(content)}\n请求方法：{request.method}，请求路径：{request.path}，UserAgent：{request.META['HTTP_USER_AGENT']}",
-                            data=mask_sensitive_data(data),
-                            old_data=mask_sensitive_data(old_data))
+    audit_sink.put(user=user, type=action_type, action=action,
+                   action_ip=user_ip(request),
+                   content=f"{mask_sensitive_data(content)}\n请求方法：{request.method}，请求路径：{request.path}，UserAgent：{request.META['HTTP_USER_AGENT']}",
+                   data=mask_sensitive_data(data),
+                   old_data=mask_sensitive_data(old_data))
@@ -8,11 +8,98 @@
 @Blog ：https://imaojia.com
 """
 
-from rest_framework.pagination import PageNumberPagination, LimitOffsetPagination
+import hashlib
+
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+from rest_framework.pagination import PageNumberPagination, LimitOffsetPagination, CursorPagination
 from rest_framework.response import Response
 
+from common.variables import PAGINATION_COUNT_KEY, PAGINATION_COUNT_TTL, PAGINATION_APPROXIMATE_MIN
+import logging
+
+logger = logging.getLogger('api')
+
+
+def has_join(queryset):
+    query = queryset.query
+    return any(alias != query.base_table and count for alias, count in query.alias_refcount.items())
+
+
+def drop_redundant_distinct(queryset):
+    """
+    单表查询去掉多余的distinct
+    """
+    query = getattr(queryset, 'query', None)
+    if query is None or not query.distinct or query.distinct_fields or has_join(queryset):
+        return queryset
+    queryset = queryset.all()
+    queryset.query.distinct = False
+    return queryset
+
+
+def table_rows(queryset):
+    """
+    mysql表统计信息中的估算行数
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'mysql':
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() "
+                       "AND TABLE_NAME = %s", [queryset.model._meta.db_table])
+        row = cursor.fetchone()
+    return row and row[0]
+
+
+def approximate_count(queryset):
+    """
+    大表估算总数, 仅用于展示(游标分页的total)
+    无过滤条件时使用表统计行数, 否则精确计数并短时缓存
+    """
+    query = queryset.query
+    if not query.where and not has_join(queryset):
+        try:
+            rows = table_rows(queryset)
+            if rows and rows >= PAGINATION_APPROXIMATE_MIN:
+                return rows
+        except BaseException as e:
+            logger.warning(f'获取表统计行数失败，原因：{e}')
+    return cached_count(queryset)
+
+
+def cached_count(queryset):
+    """
+    精确计数并短时缓存
+    """
+    sql, params = queryset.query.sql_with_params()
+    key = f"{PAGINATION_COUNT_KEY}{hashlib.md5(repr((sql, params)).encode()).hexdigest()}"
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count, PAGINATION_COUNT_TTL)
+    return count
+
+
+class CachedCountPaginator(Paginator):
+    """
+    页码分页使用精确计数(短时缓存), 估算值可能小于实际数量导致末页无法访问
+    """
+
+    @cached_property
+    def count(self):
+        return cached_count(self.object_list)
+
 
 class CustomPagination(PageNumberPagination):
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if getattr(view, 'approximate_count', False):
+            self.django_paginator_class = CachedCountPaginator
+        return super().paginate_queryset(queryset, request, view=view)
+
     def get_paginated_response(self, data):
         return Response({
             'data': {'items': data, 'total': self.page.paginator.count},
@@ -20,3 +107,35 @@ class CustomPagination(PageNumberPagination):
             'next': self.get_next_link(),
             'previous': self.get_previous_link()
         })
+
+
+class CustomCursorPagination(CursorPagination):
+    """
+    游标(keyset)分页, 不统计总数, 不随页码增大而变慢
+    默认按 -id 排序, 视图可通过 keyset_ordering 指定, 如 ('-created_time', '-id');
+    忽略请求中的ordering参数, 排序始终以唯一的id结尾, id的方向与第一个排序字段一致
+    """
+    ordering = ('-id',)
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+    def get_ordering(self, request, queryset, view):
+        keyset_ordering = getattr(view, 'keyset_ordering', None) or self.ordering
+        ordering = [i for i in keyset_ordering if i.lstrip('-') not in ('id', 'pk')]
+        # 以id作为最后的排序字段, 保证游标位置唯一; 游标分页按第一个字段的方向比较, 各字段方向需一致
+        tiebreaker = '-id' if keyset_ordering[0].startswith('-') else 'id'
+        return tuple(ordering) + (tiebreaker,)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.total = None
+        if getattr(view, 'approximate_count', False):
+            self.total = approximate_count(queryset)
+        return super().paginate_queryset(queryset, request, view=view)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'data': {'items': data, 'total': self.total},
+            'code': 20000,
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link()
+        })
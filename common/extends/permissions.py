@@ -8,15 +8,116 @@
 @Blog ：https://imaojia.com
 """
 
-from rest_framework.permissions import BasePermission
-from dbapp.models import AuditLog
+import time
+from threading import Lock
 
+from cachetools import TTLCache
+from django.core.cache import cache
+from rest_framework.permissions import BasePermission
 from common.get_ip import user_ip
+from common.extends.handler import audit_sink
 from common.ext_fun import get_redis_data, get_members
+from common.variables import RBAC_VERSION_KEY, RBAC_SNAPSHOT_CACHE, RBAC_SHARED_TTL
 import logging
 
 logger = logging.getLogger('api')
 
+# 内置白名单
+URL_WHITELIST = [{'url': '/api/login/feishu/'}, {'url': '/api/login/gitlab/'}]
+
+
+def get_rbac_version():
+    """
+    获取当前权限版本号
+    """
+    version = cache.get(RBAC_VERSION_KEY)
+    if version is None:
+        # 以时间戳初始化, 避免版本号丢失后与旧快照重复
+        cache.add(RBAC_VERSION_KEY, int(time.time() * 1000), None)
+        version = cache.get(RBAC_VERSION_KEY)
+    return version
+
+
+def bump_rbac_version():
+    """
+    递增权限版本号, 使所有用户的权限快照失效
+    """
+    try:
+        version = cache.incr(RBAC_VERSION_KEY)
+    except ValueError:
+        get_rbac_version()
+        version = cache.incr(RBAC_VERSION_KEY)
+    # 当前进程立即生效, 其他进程在本地缓存过期后生效
+    RbacSnapshot.refresh()
+    return version
+
+
+class RbacSnapshot:
+    """
+    用户权限快照, 按(权限版本号, 用户)缓存于进程内存
+    权限版本号及平台白名单在进程内短时缓存, 权限检查不再每次请求redis
+    """
+    _cache = TTLCache(**RBAC_SNAPSHOT_CACHE)
+    _shared = TTLCache(maxsize=8, ttl=RBAC_SHARED_TTL)
+    _lock = Lock()
+
+    @classmethod
+    def shared(cls, name, loader):
+        with cls._lock:
+            value = cls._shared.get(name)
+        if value is None:
+            value = loader()
+            with cls._lock:
+                cls._shared[name] = value
+        return value
+
+    @classmethod
+    def version(cls):
+        return cls.shared('version', get_rbac_version)
+
+    @classmethod
+    def whitelist(cls):
+        """
+        :return: 平台白名单及内置白名单的url列表
+        """
+        def loader():
+            platform = get_redis_data('platform')
+            return tuple(item['url'] for item in (platform['whitelist'] if platform else []) + URL_WHITELIST)
+
+        return cls.shared('whitelist', loader)
+
+    @classmethod
+    def refresh(cls):
+        with cls._lock:
+            cls._shared.clear()
+
+    @classmethod
+    def get(cls, user):
+        """
+        :return: (是否管理员, 权限集合)
+        """
+        if not getattr(user, 'is_authenticated', False):
+            return False, frozenset()
+        key = (cls.version(), user.id)
+        with cls._lock:
+            snapshot = cls._cache.get(key)
+        if snapshot is None:
+            snapshot = cls.load(user)
+            with cls._lock:
+                cls._cache[key] = snapshot
+        return snapshot
+
+    @classmethod
+    def load(cls, user):
+        perms = set()
+        is_admin = False
+        for role in user.roles.values('name', 'permissions__method'):
+            if role['name'] == '管理员':
+                is_admin = True
+            if role['permissions__method']:
+                perms.add(role['permissions__method'])
+        return is_admin, frozenset(perms)
+
 
 class RbacPermission(BasePermission):
     """
@@ -25,15 +126,12 @@ class RbacPermission(BasePermission):
 
     @classmethod
     def check_is_admin(cls, request):
-        return request.user.is_authenticated and request.user.roles.filter(name='管理员').count() > 0
+        return RbacSnapshot.get(request.user)[0]
 
     @classmethod
     def get_permission_from_role(cls, request):
         try:
-            perms = request.user.roles.values(
-                'permissions__method',
-            ).distinct()
-            return [p['permissions__method'] for p in perms]
+            return list(RbacSnapshot.get(request.user)[1])
         except AttributeError:
             return []
 
@@ -42,13 +140,8 @@ class RbacPermission(BasePermission):
         :return:
         """
         _method = request._request.method.lower()
-        platform = get_redis_data('platform')
-        url_whitelist = platform['whitelist'] if platform else []
-        url_whitelist.extend(
-            [{'url': '/api/login/feishu/'}, {'url': '/api/login/gitlab/'}])
         path_info = request.path_info
-        for item in url_whitelist:
-            url = item['url']
+        for url in RbacSnapshot.whitelist():
             if url in path_info:
                 logger.debug(f'请求地址 {path_info} 命中白名单 {url}， 放行')
                 return True
@@ -61,8 +154,7 @@ class RbacPermission(BasePermission):
         if is_superuser:
             return True
 
-        is_admin = RbacPermission.check_is_admin(request)
-        perms = self.get_permission_from_role(request)
+        is_admin, perms = RbacSnapshot.get(request.user)
         if not is_admin and not perms:
             logger.debug(f'用户 {request.user} 不是管理员 且 权限列表为空， 直接拒绝')
             return False
@@ -87,8 +179,8 @@ class RbacPermission(BasePermission):
         res = self._has_permission(request, view)
         # 记录权限异常的操作
         if not res:
-            AuditLog.objects.create(
-                user=request.user, type='', action='拒绝操作',
+            audit_sink.put(
+                user=str(request.user), type='', action='拒绝操作',
                 action_ip=user_ip(request),
                 content=f"请求方法：{request.method}，请求路径：{request.path}，UserAgent：{request.META['HTTP_USER_AGENT']}",
                 data='',
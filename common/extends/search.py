@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Author : Charles Lai
+@Contact : qqing_lai@hotmail.com
+@Time : 2023/05/20 上午11:08
+@FileName: search.py
+@Blog ：https://imaojia.com
+"""
+
+from functools import reduce
+
+from django.apps import apps
+
+from common.utils.RedisAPI import RedisManage
+from common.variables import SEARCH_INDEX_KEY, SEARCH_INDEX_MODELS, SEARCH_INDEX_MAX_CANDIDATES
+import logging
+
+logger = logging.getLogger('drf')
+
+
+class SearchBackend(object):
+    """
+    搜索后端, 供 CustomSearchFilter 在模糊查询前缩小范围
+    """
+
+    def candidates(self, model, search_fields, search_terms, search_condition):
+        """
+        :param search_condition: 1 多个关键字同时匹配, 0 任一匹配
+        :return: 候选主键集合, None表示无法处理, 回退为模糊查询
+        """
+        return None
+
+
+class NgramSearchIndex(object):
+    """
+    基于redis集合的bigram倒排索引
+    g:{gram} 记录包含该片段的主键, d:{pk} 记录文档的片段用于更新时清理
+    """
+    N = 2
+    BATCH_SIZE = 500
+
+    def __init__(self, name):
+        self.name = name
+        self.model = apps.get_model('dbapp', name)
+        self.fields = SEARCH_INDEX_MODELS[name]
+        self.prefix = f"{SEARCH_INDEX_KEY}{{{name}}}:"
+
+    @classmethod
+    def get(cls, name):
+        if name not in SEARCH_INDEX_MODELS:
+            return None
+        return cls(name)
+
+    @classmethod
+    def grams(cls, text):
+        text = str(text).lower()
+        return {text[i:i + cls.N] for i in range(len(text) - cls.N + 1)}
+
+    def document_grams(self, values):
+        return reduce(set.union, [self.grams(i) for i in values if i not in (None, '')], set())
+
+    def gram_key(self, gram):
+        return f"{self.prefix}g:{gram}"
+
+    def doc_key(self, pk):
+        return f"{self.prefix}d:{pk}"
+
+    def ready(self):
+        return RedisManage().conn().exists(f"{self.prefix}ready")
+
+    def index(self, pk):
+        values = self.model.objects.filter(
+            pk=pk).values_list(*self.fields).first()
+        if values is None:
+            return self.remove(pk)
+        conn = RedisManage().conn()
+        grams = self.document_grams(values)
+        old = conn.smembers(self.doc_key(pk))
+        pipe = conn.pipeline(transaction=False)
+        for gram in old - grams:
+            pipe.srem(self.gram_key(gram), pk)
+        for gram in grams - old:
+            pipe.sadd(self.gram_key(gram), pk)
+        pipe.delete(self.doc_key(pk))
+        if grams:
+            pipe.sadd(self.doc_key(pk), *grams)
+        pipe.execute()
+
+    def remove(self, pk):
+        conn = RedisManage().conn()
+        pipe = conn.pipeline(transaction=False)
+        for gram in conn.smembers(self.doc_key(pk)):
+            pipe.srem(self.gram_key(gram), pk)
+        pipe.delete(self.doc_key(pk))
+        pipe.execute()
+
+    def rebuild(self):
+        conn = RedisManage().conn()
+        for key in conn.scan_iter(match=f"{SEARCH_INDEX_KEY}{{{self.name}}}:*", count=self.BATCH_SIZE):
+            conn.delete(key)
+        count = 0
+        pipe = conn.pipeline(transaction=False)
+        for values in self.model.objects.values_list('pk', *self.fields).iterator(chunk_size=self.BATCH_SIZE):
+            grams = self.document_grams(values[1:])
+            for gram in grams:
+                pipe.sadd(self.gram_key(gram), values[0])
+            if grams:
+                pipe.sadd(self.doc_key(values[0]), *grams)
+            count += 1
+            if count % self.BATCH_SIZE == 0:
+                pipe.execute()
+        pipe.set(f"{self.prefix}ready", 1)
+        pipe.execute()
+        return count
+
+    def search(self, term):
+        grams = self.grams(term)
+        if not grams:
+            return None
+        return RedisManage().conn().sinter([self.gram_key(i) for i in grams])
+
+
+class NgramSearchBackend(SearchBackend):
+    """
+    n-gram索引搜索后端
+    仅处理已建索引且搜索字段均在索引中、关键字长度不小于N的普通模糊搜索
+    """
+
+    def candidates(self, model, search_fields, search_terms, search_condition):
+        index = NgramSearchIndex.get(model._meta.model_name)
+        if index is None or not set(search_fields).issubset(index.fields):
+            return None
+        try:
+            if not index.ready():
+                return None
+            results = []
+            for term in search_terms:
+                pks = index.search(term.strip())
+                if pks is None:
+                    return None
+                results.append(pks)
+        except BaseException as e:
+            logger.warning(f'搜索索引[{index.name}]查询失败，原因：{e}')
+            return None
+        pks = set.intersection(
+            *results) if search_condition == 1 else set.union(*results)
+        if len(pks) > SEARCH_INDEX_MAX_CANDIDATES:
+            return None
+        return [int(i) for i in pks]
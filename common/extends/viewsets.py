@@ -30,6 +30,7 @@ from common.utils.ElasticSearchAPI import Index
 from common.extends.filters import CustomSearchFilter, CustomFilter
 from common.extends.handler import log_audit
 from common.extends.permissions import RbacPermission
+from common.extends.pagination import CustomCursorPagination, drop_redundant_distinct
 import pytz
 import logging
 
@@ -42,6 +43,11 @@ class CustomModelViewSet(viewsets.ModelViewSet):
     `partial_update()`, `destroy()` and `list()` actions.
     """
 
+    # 大表列表使用估算总数
+    approximate_count = False
+    # 游标分页排序字段, 请求参数 pagination=keyset 时启用游标分页
+    keyset_ordering = None
+
     def get_permission_from_role(self, request):
         try:
             perms = request.user.roles.values(
@@ -51,6 +57,13 @@ class CustomModelViewSet(viewsets.ModelViewSet):
         except AttributeError:
             return []
 
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator') and self.request is not None and \
+                self.request.query_params.get('pagination') == 'keyset':
+            self._paginator = CustomCursorPagination()
+        return super().paginator
+
     def extend_filter(self, queryset):
         return queryset
 
@@ -105,7 +118,8 @@ class CustomModelViewSet(viewsets.ModelViewSet):
         return Response(data)
 
     def list(self, request, pk=None, *args, **kwargs):
-        queryset = self.filter_queryset(self.get_queryset())
+        queryset = drop_redundant_distinct(
+            self.filter_queryset(self.get_queryset()))
         page_size = request.query_params.get('page_size')
         pagination.PageNumberPagination.page_size = page_size
         page = self.paginate_queryset(queryset)
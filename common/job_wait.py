@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Author : Charles Lai
+@Contact : qqing_lai@hotmail.com
+@Time : 2023/05/15 上午10:42
+@FileName: job_wait.py
+@Blog ：https://imaojia.com
+"""
+
+import math
+import time
+import logging
+
+from common.utils.RedisAPI import RedisManage
+from common.variables import JOB_READY_KEY
+
+logger = logging.getLogger(__name__)
+
+
+def notify_job(name, job_id, expire=60):
+    """
+    通知任务记录已写入, 唤醒等待方
+    """
+    key = f"{JOB_READY_KEY}{name}:{job_id}"
+    try:
+        pipe = RedisManage().conn().pipeline(transaction=False)
+        pipe.rpush(key, 1)
+        pipe.expire(key, expire)
+        pipe.execute()
+    except BaseException as e:
+        logger.error(f'任务就绪通知 {key} 失败, 原因: {e}')
+
+
+def poll_backoff(check, timeout=15, interval=0.5, max_interval=5, factor=2):
+    """
+    指数退避轮询
+    :param check: 检查函数, 返回 (ok, data)
+    :return: 最后一次检查结果
+    """
+    deadline = time.time() + timeout
+    ok, data = check()
+    while not ok:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        time.sleep(min(interval, remaining))
+        interval = min(interval * factor, max_interval)
+        ok, data = check()
+    return ok, data
+
+
+def wait_job(name, job_id, check, timeout=15, interval=1, max_interval=4):
+    """
+    等待任务记录就绪
+    阻塞在 {JOB_READY_KEY}{name}:{job_id} 上, 记录提交后立即唤醒; 通知丢失时按指数退避重新检查
+    :param check: 检查函数, 返回 (ok, data)
+    """
+    key = f"{JOB_READY_KEY}{name}:{job_id}"
+    deadline = time.time() + timeout
+    ok, data = check()
+    while not ok:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        wait = min(interval, remaining)
+        try:
+            RedisManage().conn().blpop(key, timeout=max(1, math.ceil(wait)))
+        except BaseException as e:
+            logger.debug(f'等待任务 {key} 通知异常, 原因: {e}')
+            time.sleep(wait)
+        interval = min(interval * 2, max_interval)
+        ok, data = check()
+    return ok, data
@@ -9,20 +9,87 @@
 '''
 
 # here put the import lib
+import hashlib
 import json
+import queue
+import threading
 import time
 import logging
 
+from django.core.cache import cache
+
 from dbapp.models import AppInfo, KubernetesCluster
 
 from common.ext_fun import get_datadict
+from common.variables import K8S_RESOURCE_CACHE_KEY
 
 logger = logging.getLogger('drf')
 
 
+class K8sResourceCache(object):
+    """
+    集群命名空间及已下发资源缓存
+    命名空间列表由list接口填充; Service/Secret记录最近一次下发内容的指纹, 内容不变时跳过请求
+    """
+    TTL = 60 * 10
+
+    @staticmethod
+    def key(cluster_id, kind, namespace='', name=''):
+        return f"{K8S_RESOURCE_CACHE_KEY}{cluster_id}:{kind}:{namespace}:{name}"
+
+    @staticmethod
+    def fingerprint(data):
+        if not isinstance(data, str):
+            data = json.dumps(data, sort_keys=True)
+        return hashlib.md5(data.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def namespaces(cls, cluster_id, cli):
+        """
+        :return: 命名空间集合, 获取失败返回None
+        """
+        key = cls.key(cluster_id, 'namespace')
+        data = cache.get(key)
+        if data is None:
+            try:
+                ret = cli.get_namespaces()
+                data = {i['metadata']['name'] for i in ret['items']}
+            except BaseException as e:
+                logger.debug(f'获取集群[{cluster_id}]命名空间失败, 原因: {e}')
+                return None
+            cache.set(key, data, cls.TTL)
+        return data
+
+    @classmethod
+    def add_namespace(cls, cluster_id, namespace):
+        key = cls.key(cluster_id, 'namespace')
+        data = cache.get(key)
+        if data is not None:
+            data.add(namespace)
+            cache.set(key, data, cls.TTL)
+
+    @classmethod
+    def is_applied(cls, cluster_id, kind, namespace, name, data):
+        return cache.get(cls.key(cluster_id, kind, namespace, name)) == cls.fingerprint(data)
+
+    @classmethod
+    def set_applied(cls, cluster_id, kind, namespace, name, data):
+        cache.set(cls.key(cluster_id, kind, namespace, name),
+                  cls.fingerprint(data), cls.TTL)
+
+    @classmethod
+    def invalidate(cls, cluster_id, kind, namespace='', name=''):
+        cache.delete(cls.key(cluster_id, kind, namespace, name))
+
+
 class DeploymentCheck(object):
-    def __init__(self, cli, appinfo_obj: AppInfo, k8s: KubernetesCluster, tag=None, app_deploy_name=None):
+    def __init__(self, cli, appinfo_obj: AppInfo, k8s: KubernetesCluster, tag=None, app_deploy_name=None,
+                 cancel_event=None):
+        """
+        :param cancel_event: 取消信号, 如集群部署超时, 设置后尽快结束检测
+        """
         self.cli = cli
+        self.cancel_event = cancel_event or threading.Event()
         self.appinfo_obj = appinfo_obj
         self.k8s = k8s
         self.tag = tag
@@ -137,15 +204,170 @@ class DeploymentCheck(object):
                 logger.info(
                     f"Kubernetes集群[{self.k8s.name}]: 应用{self.appinfo_obj.app.alias}[{self.appinfo_obj.app.name}]检测成功\n")
                 return {'status': 1, 'message': desc, 'data': json.dumps(log)}
-            if self.count < 0:
+            if self.count < 0 or self.cancel_event.wait(self.wait):
                 break
-            time.sleep(self.wait)
         return {'status': 2, 'message': desc, 'data': json.dumps(log)}
 
 
-def deployment_check(cli, appinfo_obj: AppInfo, k8s: KubernetesCluster, tag=None, app_deploy_name=None):
+class DeploymentWatchCheck(DeploymentCheck):
+    """
+    基于watch事件的部署状态检测
+
+    监听Deployment/ReplicaSet/Pod事件, 部署就绪或失败时立即返回, 返回结构与DeploymentCheck一致;
+    监听不可用时回退到轮询检测.
+    """
+    REVISION_KEY = 'deployment.kubernetes.io/revision'
+    # Deployment Progressing条件中表示发布失败的原因
+    FAILED_REASONS = ('ProgressDeadlineExceeded',)
+    # 单次watch请求时长(秒), 到期后重新发起, 以便及时响应停止信号并释放连接
+    WATCH_SLICE = 5
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.timeout = self.count * self.wait
+        self.deployment = None
+        self.replicasets = {}
+        self.pods = {}
+        self.pod_status = None
+        self.events = queue.Queue()
+        self.stopped = threading.Event()
+
+    def feed(self, kind, event_type, obj):
+        """
+        处理单个事件, 返回检测结果, 未得出结论时返回None
+
+        :param kind: deployment/replica_set/pod
+        """
+        if kind == 'deployment':
+            self.deployment = None if event_type == 'DELETED' else obj
+        else:
+            store = self.replicasets if kind == 'replica_set' else self.pods
+            if event_type == 'DELETED':
+                store.pop(obj['metadata']['name'], None)
+            else:
+                store[obj['metadata']['name']] = obj
+        return self.evaluate()
+
+    def evaluate(self):
+        if not self.deployment:
+            return None
+        revision = (self.deployment['metadata'].get('annotations') or {}).get(self.REVISION_KEY)
+        if not revision:
+            return None
+        status = self.deployment.get('status') or {}
+        # 控制器尚未处理本次发布时, 条件仍是上一次发布的结果
+        observed = status.get('observedGeneration', 0) >= self.deployment['metadata'].get('generation', 0)
+        for condition in status.get('conditions') or []:
+            if observed and condition.get('type') == 'Progressing' and condition.get('reason') in self.FAILED_REASONS:
+                check_desc = f"Kubernetes集群[{self.k8s.name}]: 应用{self.appinfo_obj.app.alias}[{self.app_deploy_name}] 发布失败, 原因: {condition.get('message', condition['reason'])}\n请查看Kubernetes Pod日志\n"
+                return False, check_desc, self.pod_status or condition
+
+        rs_list = [i for i in self.replicasets.values() if
+                   (i['metadata'].get('annotations') or {}).get(self.REVISION_KEY) == revision]
+        if not rs_list:
+            return None
+        rs = rs_list[0]
+        if self.tag:
+            try:
+                image = rs['spec']['template']['spec']['containers'][0]['image']
+                if image.split(':')[-1] != self.tag:
+                    logger.debug('当前镜像版本和部署版本不一致')
+                    return False, '部署状态检测结果: 当前运行版本和部署版本不一致，请查看Kubernetes Pod日志', {
+                        '当前运行版本': image,
+                        '部署版本': self.tag
+                    }
+            except BaseException as e:
+                logger.exception(f"运行版本和部署版本检测发生异常 {e.__class__} {e} ")
+
+        rs_status = rs.get('status') or {}
+        rs_ready_conditions = [
+            rs_status.get('availableReplicas', 0),
+            rs_status.get('fullyLabeledReplicas', 0),
+            rs_status.get('readyReplicas', 0),
+        ]
+        rs_name = rs['metadata']['name']
+        for pod in self.pods.values():
+            if rs_name not in [i.get('name') for i in pod['metadata'].get('ownerReferences') or []]:
+                continue
+            pod_status = pod['status']
+            self.pod_status = pod_status
+            if all(rs_ready_conditions) and pod_status['phase'].lower() == 'running' and (
+                    'containerStatuses' in pod_status and
+                    pod_status['containerStatuses'][0]['ready'] is True and
+                    'running' in pod_status['containerStatuses'][0]['state']
+            ):
+                check_desc = f"{pod['metadata']['name']}\n 部署状态检测结果：当前Replica运行副本\n  - availableReplicas: {rs_status.get('availableReplicas', 0)}\n  - fullyLabeledReplicas: {rs_status.get('fullyLabeledReplicas', 0)}\n  - readyReplicas: {rs_status.get('readyReplicas', 0)}\n"
+                return True, check_desc, pod_status
+        return None
+
+    def watch(self, kind, deadline, **kwargs):
+        # 分段watch, 每段结束时检查停止信号; 重新发起时会重放当前资源(ADDED), feed按名称覆盖不影响结果
+        try:
+            while not self.stopped.is_set() and time.time() < deadline:
+                stream = self.cli.watch_resource(kind, self.namespace, self.api_version,
+                                                 timeout_seconds=self.WATCH_SLICE, **kwargs)
+                try:
+                    for event_type, obj in stream:
+                        if self.stopped.is_set():
+                            break
+                        self.events.put((kind, event_type, obj))
+                finally:
+                    # 关闭生成器, 释放watch连接
+                    stream.close()
+        except BaseException as e:
+            self.events.put((kind, 'ERROR', e))
+
+    def run(self):
+        labels = f"status-app-name-for-ops-platform={self.appinfo_obj.app.name}"
+        watchers = [
+            ('deployment', {'field_selector': f'metadata.name={self.app_deploy_name}'}),
+            ('replica_set', {'label_selector': labels}),
+            ('pod', {'label_selector': labels}),
+        ]
+        deadline = time.time() + self.timeout
+        for kind, kwargs in watchers:
+            threading.Thread(target=self.watch, args=(
+                kind, deadline), kwargs=kwargs, daemon=True).start()
+        try:
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0 or self.cancel_event.is_set():
+                    break
+                try:
+                    kind, event_type, obj = self.events.get(timeout=min(remaining, 1))
+                except queue.Empty:
+                    continue
+                if event_type == 'ERROR':
+                    logger.warning(
+                        f'Kubernetes集群[{self.k8s.name}]监听{kind}异常, 回退到轮询检测, 原因: {obj}')
+                    self.stopped.set()
+                    return super().run()
+                ret = self.feed(kind, event_type, obj)
+                if ret is None:
+                    continue
+                is_ok, desc, log = ret
+                if is_ok:
+                    logger.info(
+                        f"Kubernetes集群[{self.k8s.name}]: 应用{self.appinfo_obj.app.alias}[{self.appinfo_obj.app.name}]检测成功\n")
+                    return {'status': 1, 'message': desc, 'data': json.dumps(log)}
+                return {'status': 2, 'message': desc, 'data': json.dumps(log)}
+        finally:
+            self.stopped.set()
+
+        if not self.deployment:
+            check_desc = f"Kubernetes集群[{self.k8s.name}]: 应用{self.appinfo_obj.app.alias}[{self.app_deploy_name}]Deployment检测异常\n"
+            return {'status': 2, 'message': check_desc, 'data': check_desc}
+        check_desc = f"Kubernetes集群[{self.k8s.name}]: 应用{self.appinfo_obj.app.alias}[{self.app_deploy_name}] 未能在规定的时间内就绪，状态检测超时\n请查看Kubernetes Pod日志\n"
+        return {'status': 2, 'message': check_desc, 'data': json.dumps(self.pod_status)}
+
+
+def deployment_check(cli, appinfo_obj: AppInfo, k8s: KubernetesCluster, tag=None, app_deploy_name=None,
+                     cancel_event=None):
     if not app_deploy_name:
         app_deploy_name = appinfo_obj.app.name
-    dc = DeploymentCheck(cli, appinfo_obj, k8s, tag=tag,
-                         app_deploy_name=app_deploy_name)
+    check_class = DeploymentCheck
+    if (get_datadict('DEPLOY_CHECK', 1) or {}).get('watch', True):
+        check_class = DeploymentWatchCheck
+    dc = check_class(cli, appinfo_obj, k8s, tag=tag,
+                     app_deploy_name=app_deploy_name, cancel_event=cancel_event)
     return dc.run()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Author : Charles Lai
+@Contact : qqing_lai@hotmail.com
+@Time : 2023/05/18 下午2:36
+@FileName: notify_queue.py
+@Blog ：https://imaojia.com
+"""
+
+import time
+import logging
+
+from django.core.cache import cache
+
+from common.utils.RedisAPI import RedisManage
+from common.variables import MSG_QUEUE_KEY, NOTIFY_SCHEDULE_KEY
+
+logger = logging.getLogger(__name__)
+
+
+class NotifyQueue(object):
+    """
+    部署通知队列
+    消息体仍存放于缓存 {MSG_KEY}...:{ci|cd}:{job.id};
+    同一通知分组(MSG_KEY)的消息key记录在集合 {MSG_QUEUE_KEY}{MSG_KEY};
+    分组到期时间记录在有序集合 NOTIFY_SCHEDULE_KEY, 定时任务只取出到期分组
+    """
+    EXPIRE = 60 * 60 * 3
+
+    @classmethod
+    def enqueue(cls, msg_key, key, data, delay, expire=None):
+        """
+        加入通知队列, 分组到期时间以最后一条消息为准
+        """
+        expire = expire or cls.EXPIRE
+        cache.set(key, data, expire)
+        pipe = RedisManage().conn().pipeline(transaction=False)
+        pipe.sadd(f"{MSG_QUEUE_KEY}{msg_key}", key)
+        pipe.expire(f"{MSG_QUEUE_KEY}{msg_key}", expire)
+        pipe.zadd(NOTIFY_SCHEDULE_KEY, {msg_key: time.time() + delay})
+        pipe.execute()
+
+    @classmethod
+    def expedite(cls, msg_key):
+        """
+        已在队列中的分组标记为立即到期
+        """
+        RedisManage().conn().zadd(NOTIFY_SCHEDULE_KEY, {
+            msg_key: time.time()}, xx=True)
+
+    @classmethod
+    def pop_due(cls, now=None, limit=100):
+        """
+        取出到期分组, 多个定时任务并发时以zrem成功者为准
+        """
+        conn = RedisManage().conn()
+        due = conn.zrangebyscore(NOTIFY_SCHEDULE_KEY, '-inf',
+                                 now or time.time(), start=0, num=limit)
+        return [i for i in due if conn.zrem(NOTIFY_SCHEDULE_KEY, i)]
+
+    @classmethod
+    def drain(cls, msg_key):
+        """
+        取出分组内全部消息
+        :return: {消息key: 消息}
+        """
+        conn = RedisManage().conn()
+        pipe = conn.pipeline(transaction=False)
+        pipe.smembers(f"{MSG_QUEUE_KEY}{msg_key}")
+        pipe.delete(f"{MSG_QUEUE_KEY}{msg_key}")
+        pipe.zrem(NOTIFY_SCHEDULE_KEY, msg_key)
+        keys = sorted(pipe.execute()[0], reverse=True)
+        if not keys:
+            return {}
+        msg = cache.get_many(keys)
+        cache.delete_many(keys)
+        return {k: msg[k] for k in keys if k in msg}
@@ -13,14 +13,24 @@ from __future__ import unicode_literals
 from common.utils.AnsibleAPI import AnsibleApi as BaseAnsibleApi
 from common.utils.AnsibleAPI import PlayBookResultsCollector as BasePlayBookResultsCollector
 import json
+import threading
+import time
 import logging
 
 logger = logging.getLogger(__name__)
 
 
 class PlayBookResultsCollector(BasePlayBookResultsCollector):
-
-    def __init__(self, redis_conn, chan, jid, channel, *args, debug=False, on_any_callback=None, **kwargs):
+    """
+    执行结果先写入缓冲, 达到条数或时间阈值后通过pipeline批量按序写入redis
+    """
+    # 缓冲条数阈值
+    FLUSH_SIZE = 50
+    # 缓冲时间阈值(秒)
+    FLUSH_INTERVAL = 0.5
+
+    def __init__(self, redis_conn, chan, jid, channel, *args, debug=False, on_any_callback=None, flush_size=None,
+                 flush_interval=None, **kwargs):
         super(PlayBookResultsCollector, self).__init__(*args, **kwargs)
         self.channel = channel
         self.jid = jid
@@ -28,6 +38,61 @@ class PlayBookResultsCollector(BasePlayBookResultsCollector):
         self.redis_conn = redis_conn
         self.debug = debug
         self.on_any_callback = on_any_callback
+        self.flush_size = flush_size or self.FLUSH_SIZE
+        self.flush_interval = flush_interval or self.FLUSH_INTERVAL
+        self._buffer = []
+        self._buffer_time = None
+        self._lock = threading.Lock()
+        self._timer = None
+        # 已写入redis但未通知读取方
+        self._flushed = False
+
+    def push(self, res, status):
+        with self._lock:
+            if not self._buffer:
+                self._buffer_time = time.time()
+            self._buffer.append((json.dumps({res['task']: {res['host']: res}}),
+                                 '%s:%s:status' % (self.jid, res['task']), status))
+            full = len(self._buffer) >= self.flush_size
+            if not full and self._timer is None:
+                # 无后续事件时, 由定时器写入缓冲
+                self._timer = threading.Timer(
+                    self.flush_interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        批量写入缓冲结果
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            buffer, self._buffer = self._buffer, []
+            self._buffer_time = None
+            if not buffer:
+                return False
+            try:
+                pipe = self.redis_conn.pipeline(transaction=False)
+                pipe.rpush(self.jid, *[i[0] for i in buffer])
+                for _, key, status in buffer:
+                    pipe.rpush(key, status)
+                pipe.execute()
+            except BaseException as e:
+                logger.exception(f'写入执行结果 {self.jid} 异常, 原因: {e}')
+            self._flushed = True
+            return True
+
+    def notify(self):
+        """
+        在执行线程中通知读取方
+        """
+        if self._flushed and self.on_any_callback:
+            self._flushed = False
+            self.on_any_callback(self, None)
 
     @staticmethod
     def result_pop(result):
@@ -62,9 +127,7 @@ class PlayBookResultsCollector(BasePlayBookResultsCollector):
             'msg': result._result
         }
 
-        self.redis_conn.rpush(self.jid, json.dumps(
-            {res['task']: {res['host']: res}}))
-        self.redis_conn.rpush('%s:%s:status' % (self.jid, res['task']), 0)
+        self.push(res, 0)
         self.task_ok[result._host.get_name()] = result
         logger.debug(f'v2_runner_on_ok ======== {self.task_ok}')
 
@@ -80,9 +143,7 @@ class PlayBookResultsCollector(BasePlayBookResultsCollector):
             'task': result._task.get_name(),
             'msg': result._result
         }
-        self.redis_conn.rpush(self.jid, json.dumps(
-            {res['task']: {res['host']: res}}))
-        self.redis_conn.rpush('%s:%s:status' % (self.jid, res['task']), 1)
+        self.push(res, 1)
         self.task_failed[result._host.get_name()] = result
         logger.debug(f'v2_runner_on_failed ======== {self.task_failed}')
 
@@ -98,9 +159,7 @@ class PlayBookResultsCollector(BasePlayBookResultsCollector):
             'task': result._task.get_name(),
             'msg': result._result
         }
-        self.redis_conn.rpush(self.jid, json.dumps(
-            {res['task']: {res['host']: res}}))
-        self.redis_conn.rpush('%s:%s:status' % (self.jid, res['task']), 1)
+        self.push(res, 1)
         self.task_unreachable[result._host.get_name()] = result
         logger.debug(
             f'v2_runner_on_unreachable ======== {self.task_unreachable}')
@@ -117,9 +176,7 @@ class PlayBookResultsCollector(BasePlayBookResultsCollector):
             'task': result._task.get_name(),
             'msg': result._result
         }
-        self.redis_conn.rpush(self.jid, json.dumps(
-            {res['task']: {res['host']: res}}))
-        self.redis_conn.rpush('%s:%s:status' % (self.jid, res['task']), 0)
+        self.push(res, 0)
         self.task_skipped[result._host.get_name()] = result
         logger.debug(f'v2_runner_on_skipped ======== {self.task_skipped}')
 
@@ -135,9 +192,7 @@ class PlayBookResultsCollector(BasePlayBookResultsCollector):
             'task': result._task.get_name(),
             'msg': result._result
         }
-        self.redis_conn.rpush(self.jid, json.dumps(
-            {res['task']: {res['host']: res}}))
-        self.redis_conn.rpush('%s:%s:status' % (self.jid, res['task']), 0)
+        self.push(res, 0)
         self.task_changed[result._host.get_name()] = result
         logger.debug(f'v2_runner_on_changed ======== {self.task_changed}')
 
@@ -149,13 +204,17 @@ class PlayBookResultsCollector(BasePlayBookResultsCollector):
             'host': 'unmatched',
             'msg': {'result': 'Could not match supplied host'}
         }
-        self.redis_conn.rpush(self.jid, json.dumps(
-            {res['task']: {res['host']: res}}))
-        self.redis_conn.rpush('%s:%s:status' % (self.jid, res['task']), 0)
+        self.push(res, 0)
+
+    def v2_playbook_on_stats(self, stats):
+        super(PlayBookResultsCollector, self).v2_playbook_on_stats(stats)
+        self.flush()
+        self.notify()
 
     def v2_on_any(self, result, *args, **kwargs):
-        if self.on_any_callback:
-            self.on_any_callback(self, result, *args, **kwargs)
+        if self._buffer_time and time.time() - self._buffer_time >= self.flush_interval:
+            self.flush()
+        self.notify()
 
 
 class AnsibleApi(BaseAnsibleApi):
@@ -167,3 +226,10 @@ class AnsibleApi(BaseAnsibleApi):
         self.channel = channel
         self.redis_conn = redis_conn
         self.jid = jid
+
+    def playbookrun(self, playbook_path):
+        try:
+            return super(AnsibleApi, self).playbookrun(playbook_path)
+        finally:
+            self.playbook_callback.flush()
+            self.playbook_callback.notify()
@@ -113,9 +113,16 @@ class CustomDocument(Document):
             i['_index'] = index
             if pk:
                 i['instanceid'] = i[pk]
-            i['_id'] = i[pk]
+                i['_id'] = i[pk]
             yield i
 
+    @classmethod
+    def write_index(cls):
+        """
+        写入数据的索引名称, 按时间分索引的文档需重写
+        """
+        return cls._default_index()
+
     @classmethod
     def bulk_save(cls, data, using=None, index=None, pk=None, validate=True, skip_empty=True, return_doc_meta=False,
                   **kwargs):
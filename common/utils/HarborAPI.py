@@ -11,9 +11,13 @@
 from __future__ import unicode_literals
 
 import base64
+import os
 import ssl
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from requests.adapters import HTTPAdapter
 
 import logging
 
@@ -21,12 +25,61 @@ logger = logging.getLogger('drf')
 
 ssl._create_default_https_context = ssl._create_unverified_context
 
+# 批量接口默认并发数
+HARBOR_BATCH_WORKERS = 5
+
+
+class HarborSessionPool(object):
+    """
+    Harbor会话池, 按地址及用户复用requests.Session, 保持长连接
+    """
+
+    def __init__(self, pool_maxsize=10):
+        self.pool_maxsize = pool_maxsize
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _check_pid(self):
+        # fork后的子进程不能复用父进程的连接
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._sessions = {}
+                    self._pid = os.getpid()
+
+    def get(self, url, username):
+        self._check_pid()
+        key = (url, username)
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.pool_maxsize)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                session.verify = False
+                self._sessions[key] = session
+            return session
+
+    def clear(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions = {}
+
+
+harbor_session_pool = HarborSessionPool()
+
 
 class HarborAPI(object):
-    def __init__(self, url, username, password):
+    def __init__(self, url, username, password, session=None):
         self.__url = url.rstrip('/')
         self.__user = username
         self.__password = password
+        self.__session = session or harbor_session_pool.get(
+            self.__url, self.__user)
         self.__token = base64.b64encode(
             bytes('%s:%s' % (self.__user, self.__password), encoding='utf-8'))
         self.__headers = dict()
@@ -37,26 +90,26 @@ class HarborAPI(object):
     def request(self, method, obj=None, prefix='/'):
         try:
             if method == 'get':
-                req = requests.request(method, '%s%s' % (self.__url, prefix), params=obj, headers=self.__headers,
+                req = self.__session.request(method, '%s%s' % (self.__url, prefix), params=obj, headers=self.__headers,
                                        verify=False)
                 if req.status_code > 399:
                     return {'ecode': req.status_code, 'message': f'{req.content}\n{req.reason}'}
                 res = {'ecode': req.status_code, 'data': req.json(), 'count': req.headers.get('X-Total-Count', None),
                        'next': req.headers.get('Link', None)}
             if method == 'delete':
-                req = requests.request(method, '%s%s' % (
+                req = self.__session.request(method, '%s%s' % (
                     self.__url, prefix), headers=self.__headers, verify=False)
                 if req.status_code > 399:
                     return {'ecode': req.status_code, 'message': f'{req.content}\n{req.reason}'}
                 res = {'ecode': req.status_code, 'data': req.content}
             if method in ['put', 'post']:
-                req = requests.request(method, '%s%s' % (self.__url, prefix), json=obj, headers=self.__headers,
+                req = self.__session.request(method, '%s%s' % (self.__url, prefix), json=obj, headers=self.__headers,
                                        verify=False)
                 if req.status_code > 399:
                     return {'ecode': req.status_code, 'message': f'{req.content}\n{req.reason}'}
                 res = {'ecode': req.status_code, 'data': req.content}
             if method == 'head':
-                req = requests.request(method, '%s%s' % (
+                req = self.__session.request(method, '%s%s' % (
                     self.__url, prefix), headers=self.__headers, verify=False)
                 if req.status_code > 399:
                     return {'ecode': req.status_code, 'message': f'{req.content}\n{req.reason}'}
@@ -194,7 +247,7 @@ class HarborAPI(object):
                 'delete', prefix=f'/repositories/{repo}/tags/{tag}')
             return res
         except BaseException as e:
-            logger.ex
+            logger.exception(e)
             return {'ecode': 500, 'message': e}
 
     def search(self, query):
@@ -207,3 +260,43 @@ class HarborAPI(object):
         except BaseException as e:
             logger.exception(e)
             return {'ecode': 500, 'message': e}
+
+    def batch(self, calls, workers=HARBOR_BATCH_WORKERS):
+        """
+        并发调用
+        :param calls: [(方法名, 参数元组), ...]
+        :return: 与calls顺序一致的结果列表
+        """
+        if not calls:
+            return []
+        with ThreadPoolExecutor(max_workers=min(workers, len(calls))) as executor:
+            return list(executor.map(lambda i: getattr(self, i[0])(*i[1]), calls))
+
+    def get_tags_batch(self, repos, workers=HARBOR_BATCH_WORKERS):
+        """
+        批量获取镜像标签
+        """
+        return dict(zip(repos, self.batch([('get_tags', (repo,)) for repo in repos], workers)))
+
+    def delete_tags(self, repo, tags, workers=HARBOR_BATCH_WORKERS):
+        """
+        批量删除标签
+        """
+        return self.batch([('delete_tag', (repo, tag)) for tag in tags], workers)
+
+    def sync_tag(self, repo, src_image, tag):
+        """
+        镜像同步, 标签不存在时打标签
+        :return: (是否执行了同步, 结果)
+        """
+        res = self.fetch_tag(repo, tag)
+        if res.get('ecode', 500) <= 399:
+            return False, res
+        return True, self.patch_tag(repo, src_image, tag)
+
+    def sync_tags(self, images, workers=HARBOR_BATCH_WORKERS):
+        """
+        批量镜像同步
+        :param images: [(repo, src_image, tag), ...]
+        """
+        return self.batch([('sync_tag', i) for i in images], workers)
@@ -12,7 +12,11 @@ import jenkins
 import shortuuid
 import time
 import os
+import re
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TTLCache
 from django.conf import settings
 import tempfile
 import requests
@@ -45,6 +49,13 @@ CONFIG_VIEW = '%(folder_url)sview/%(short_name)s/config.xml'
 DELETE_VIEW = '%(folder_url)sview/%(short_name)s/doDelete'
 JOB_INFO = '%(folder_url)sjob/%(short_name)s/api/json?depth=%(depth)s'
 Q_ITEM = 'queue/item/%(number)d/api/json?depth=%(depth)s'
+# 移除href html信息，保留链接文字
+HREF_PATTERN = re.compile('<a href[^>]*>')
+# 已结束的stage状态, 结果不再变化可缓存
+STAGE_FINISHED_STATUS = ['SUCCESS', 'FAILED', 'ABORTED', 'UNSTABLE']
+# 获取stage详情的最大并发数
+STAGE_FETCH_WORKERS = 8
+BUILD_CONSOLE_PROGRESSIVE = '%(folder_url)sjob/%(short_name)s/%(number)d/logText/progressiveText?start=%(start)d'
 
 
 class EmptyResponseException(JenkinsException):
@@ -312,46 +323,89 @@ class GlueJenkins(Jenkins):
                 % (name, number)
             )
 
+    def get_build_console_progressive(self, name, number, start=0):
+        """
+        增量获取构建控制台输出
+
+        :param start: 日志偏移量, 首次为0, 之后使用上次返回的偏移量
+        :returns: (新增日志, 下次偏移量, 是否还有后续输出)
+        """
+        folder_url, short_name = self._get_job_folder(name)
+        try:
+            response = self.jenkins_request(requests.Request(
+                'GET', self._build_url(BUILD_CONSOLE_PROGRESSIVE, locals())
+            ))
+        except (req_exc.HTTPError, NotFoundException):
+            raise JenkinsException('job[%s] number[%d] does not exist'
+                                   % (name, number))
+        text_size = response.headers.get('X-Text-Size')
+        more_data = response.headers.get('X-More-Data', '').lower() == 'true'
+        return response.text, int(text_size) if text_size else start, more_data
+
+    # 已结束stage的日志缓存, key: (job名称, 构建号, stage节点ID)
+    _stage_cache = TTLCache(maxsize=2048, ttl=60 * 60)
+    _stage_cache_lock = threading.Lock()
+
+    def _get_wfapi(self, href, job_name, build_number):
+        try:
+            response = self.jenkins_open(requests.Request(
+                'GET', self._build_url(unquote(href))
+            ))
+            if response:
+                return json.loads(response)
+            raise JenkinsException('job[%s] number[%d] does not exist'
+                                   % (job_name, build_number))
+        except (req_exc.HTTPError, NotFoundException):
+            raise JenkinsException('job[%s] number[%d] does not exist'
+                                   % (job_name, build_number))
+        except ValueError:
+            raise JenkinsException(
+                'Could not parse JSON info for job[%s] number[%d]'
+                % (job_name, build_number)
+            )
+
     def get_flow_detail(self, job_name, build_number):
+        """
+        获取流水线各stage详情及日志
+
+        stage详情和节点日志并发获取, 已结束的stage从缓存读取
+        """
         stage_data = self.get_stage_info(name=job_name, number=build_number)
         stages = stage_data.get('stages')
+        pending = []
         for i in stages:
-            logs = ''
+            key = (job_name, build_number, i['id'])
+            with self._stage_cache_lock:
+                logs = self._stage_cache.get(key)
+            if logs is None:
+                pending.append(i)
+            else:
+                i['logs'] = logs
+        if not pending:
+            return stage_data
+
+        with ThreadPoolExecutor(max_workers=min(STAGE_FETCH_WORKERS, len(pending))) as executor:
+            # 获取stage返回信息
+            describes = list(executor.map(
+                lambda i: self._get_wfapi(i['_links']['self']['href'], job_name, build_number), pending))
+            nodes = [(index, j) for index, res in enumerate(describes)
+                     for j in res['stageFlowNodes']]
+            node_logs = list(executor.map(
+                lambda node: self._get_wfapi(node[1]['_links']['log']['href'], job_name, build_number), nodes))
+
+        logs = ['' for _ in pending]
+        for (index, _), res in zip(nodes, node_logs):
             try:
-                # 获取stage返回信息
-                response = self.jenkins_open(requests.Request(
-                    'GET', self._build_url(
-                        unquote(i['_links']['self']['href']), locals())
-                ))
-                if response:
-                    res = json.loads(response)
-                    for j in res['stageFlowNodes']:
-                        response = self.jenkins_open(requests.Request(
-                            'GET', self._build_url(
-                                unquote(j['_links']['log']['href']), locals())
-                        ))
-                        res = json.loads(response)
-                        try:
-                            # 移除href html信息，保留链接文字
-                            import re
-                            pat = re.compile('<a href[^>]*>')
-                            logs = logs + '\n' + \
-                                pat.sub('', res['text'].replace('</a>', ''))
-                        except:
-                            pass
-                else:
-                    raise JenkinsException('job[%s] number[%d] does not exist'
-                                           % (job_name, build_number))
-            except (req_exc.HTTPError, NotFoundException):
-                raise JenkinsException('job[%s] number[%d] does not exist'
-                                       % (job_name, build_number))
-            except ValueError:
-                raise JenkinsException(
-                    'Could not parse JSON info for job[%s] number[%d]'
-                    % (job_name, build_number)
-                )
-
-            stage_data["stages"][stages.index(i)]['logs'] = logs
+                logs[index] = logs[index] + '\n' + \
+                    HREF_PATTERN.sub('', res['text'].replace('</a>', ''))
+            except:
+                pass
+        for i, stage_logs in zip(pending, logs):
+            i['logs'] = stage_logs
+            if i.get('status') in STAGE_FINISHED_STATUS:
+                with self._stage_cache_lock:
+                    self._stage_cache[(job_name, build_number,
+                                       i['id'])] = stage_logs
         return stage_data
 
     def get_queue_item(self, number, depth=0):
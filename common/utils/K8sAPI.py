@@ -15,14 +15,25 @@ from kubernetes.stream import stream
 
 from urllib.parse import urlencode
 from ruamel import yaml
+import aiohttp
 from datetime import datetime
+import hashlib
 import json
 import operator
+import os
+import ssl
+import threading
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from typing import AnyStr, List, Dict, Type
 
 logger = logging.getLogger(__name__)
 
+# 多命名空间并发获取pod的线程数
+POD_FETCH_WORKERS = 10
+# 命名空间数不少于该值且未分页时, 改为全集群一次查询
+POD_CLUSTER_LIST_MIN = 20
+
 
 class K8sAPI(object):
     def __init__(self, host=None, username=None, password=None, api_key=None, api_key_prefix='Bearer', verify_ssl=False,
@@ -37,14 +48,18 @@ class K8sAPI(object):
         self.__api_key = api_key
         self.__api_key_prefix = api_key_prefix
         self.__verify_ssl = verify_ssl
+        # 每个实例使用独立的Configuration, 避免修改全局kubeconfig
+        configuration = client.Configuration()
         if k8s_config is not None:
-            config.kube_config.load_kube_config_from_dict(k8s_config)
-            self.__client0 = client.CoreApi()
-            self.__client = client.CoreV1Api()
+            config.kube_config.load_kube_config_from_dict(
+                k8s_config, client_configuration=configuration)
+            self.__client0 = client.CoreApi(ApiClient(configuration))
+            self.__client = client.CoreV1Api(self.__client0.api_client)
         elif config_file is not None:
-            config.kube_config.load_kube_config(config_file=config_file)
-            self.__client0 = client.CoreApi()
-            self.__client = client.CoreV1Api()
+            config.kube_config.load_kube_config(
+                config_file=config_file, client_configuration=configuration)
+            self.__client0 = client.CoreApi(ApiClient(configuration))
+            self.__client = client.CoreV1Api(self.__client0.api_client)
         elif self.__host:
             if self.__username and self.__password:
                 self.__client = self.get_api()
@@ -73,12 +88,32 @@ class K8sAPI(object):
         return self.__client
 
     def set_client(self, obj):
-        self.__client = getattr(client, obj)()
+        """
+        基于当前连接创建指定类型的API客户端, 不修改实例(实例在线程间共享)
+        """
+        return getattr(client, obj)(self.__client.api_client)
+
+    def get_version_api(self, api_version):
+        """
+        按apiVersion获取对应的API客户端, 如 apps/v1 -> AppsV1Api
+        """
+        return operator.methodcaller(''.join([i.capitalize() for i in api_version.split('/')]) + 'Api',
+                                     self.__client.api_client)(client)
+
+    def close(self):
+        """
+        释放连接池
+        """
+        try:
+            self.__client.api_client.close()
+            self.__client.api_client.rest_client.pool_manager.clear()
+        except BaseException as e:
+            logger.debug(f'关闭K8s连接池异常, {e}')
 
     def get_apis(self):
         print("Supported APIs (* is preferred version):")
-        self.__client2 = client.ApisApi(self.__client0.api_client)
-        for api in self.__client2.get_api_versions().groups:
+        apis = client.ApisApi(self.__client0.api_client)
+        for api in apis.get_api_versions().groups:
             versions = []
             for v in api.versions:
                 name = ""
@@ -91,7 +126,7 @@ class K8sAPI(object):
     def get_nodes(self, **kwargs):
         ret = self.__client.list_node(**kwargs)
         try:
-            rs = ApiClient().sanitize_for_serialization(ret)
+            rs = self.__client.api_client.sanitize_for_serialization(ret)
             return rs
         except BaseException as e:
             return {'err': str(e)}
@@ -99,7 +134,7 @@ class K8sAPI(object):
     def get_node_info(self, name):
         ret = self.__client.read_node_status(name)
         try:
-            rs = ApiClient().sanitize_for_serialization(ret)
+            rs = self.__client.api_client.sanitize_for_serialization(ret)
             return rs
         except BaseException as e:
             return {'err': str(e)}
@@ -107,7 +142,7 @@ class K8sAPI(object):
     def get_namespaces(self, **kwargs):
         ret = self.__client.list_namespace(**kwargs)
         try:
-            rs = ApiClient().sanitize_for_serialization(ret)
+            rs = self.__client.api_client.sanitize_for_serialization(ret)
             return rs
         except BaseException as e:
             return {'err': str(e)}
@@ -122,7 +157,7 @@ class K8sAPI(object):
         }
         ret = self.__client.create_namespace(body=payload)
         try:
-            rs = ApiClient().sanitize_for_serialization(ret)
+            rs = self.__client.api_client.sanitize_for_serialization(ret)
             print(rs)
             return rs
         except BaseException as e:
@@ -131,7 +166,7 @@ class K8sAPI(object):
     def get_services(self, namespace='default', **kwargs):
         ret = self.__client.list_namespaced_service(namespace, **kwargs)
         try:
-            rs = ApiClient().sanitize_for_serialization(ret)
+            rs = self.__client.api_client.sanitize_for_serialization(ret)
             return rs
         except BaseException as e:
             return {'err': str(e)}
@@ -140,7 +175,7 @@ class K8sAPI(object):
         try:
             ret = self.__client.read_namespaced_service(name, namespace)
             try:
-                rs = ApiClient().sanitize_for_serialization(ret)
+                rs = self.__client.api_client.sanitize_for_serialization(ret)
                 return {'ecode': 200, 'message': rs}
             except BaseException as e:
                 print('reason', e.reason)
@@ -189,7 +224,7 @@ class K8sAPI(object):
             ret = self.__client.create_namespaced_service(namespace=namespace, body=body,
                                                           **{'_return_http_data_only': False})
             try:
-                rs = ApiClient().sanitize_for_serialization(ret)
+                rs = self.__client.api_client.sanitize_for_serialization(ret)
                 return {'ecode': 200, 'message': rs}
             except BaseException as e:
                 logger.error('reason', e)
@@ -237,7 +272,7 @@ class K8sAPI(object):
                 **{'_return_http_data_only': False}
             )
             try:
-                rs = ApiClient().sanitize_for_serialization(ret)
+                rs = self.__client.api_client.sanitize_for_serialization(ret)
                 return {'ecode': 200, 'message': rs}
             except BaseException as e:
                 logger.error(f'ApiClient sanitize_for_serialization 异常： {e}', )
@@ -253,7 +288,7 @@ class K8sAPI(object):
     def delete_namespace_service(self, name, namespace='default', api_version='apps/v1'):
         try:
             ret = self.__client.delete_namespaced_service(name, namespace)
-            rs = ApiClient().sanitize_for_serialization(ret)
+            rs = self.__client.api_client.sanitize_for_serialization(ret)
             return {'ecode': 200, 'message': rs}
         except BaseException as e:
             return {'error': True, 'message': str(e)}
@@ -261,7 +296,7 @@ class K8sAPI(object):
     def get_configmaps(self, namespace='default', **kwargs):
         ret = self.__client.list_namespaced_config_map(namespace, **kwargs)
         try:
-            rs = ApiClient().sanitize_for_serialization(ret)
+            rs = self.__client.api_client.sanitize_for_serialization(ret)
             return rs
         except BaseException as e:
             return {'error': True, 'message': str(e)}
@@ -273,7 +308,7 @@ class K8sAPI(object):
         try:
             ret = self.__client.read_namespaced_config_map(
                 name, namespace, **kwargs)
-            rs = ApiClient().sanitize_for_serialization(ret)
+            rs = self.__client.api_client.sanitize_for_serialization(ret)
             return rs
         except BaseException as e:
             return {'error': True, 'message': str(e)}
@@ -286,7 +321,7 @@ class K8sAPI(object):
         try:
             ret = self.__client.create_namespaced_config_map(
                 namespace, body, **kwargs)
-            rs = ApiClient().sanitize_for_serialization(ret)
+            rs = self.__client.api_client.sanitize_for_serialization(ret)
             return {'ecode': 200, 'message': rs}
         except BaseException as e:
             return {'error': True, 'message': str(e)}
@@ -299,7 +334,7 @@ class K8sAPI(object):
         try:
             ret = self.__client.patch_namespaced_config_map(
                 name, namespace, body, **kwargs)
-            rs = ApiClient().sanitize_for_serialization(ret)
+            rs = self.__client.api_client.sanitize_for_serialization(ret)
             return {'ecode': 200, 'message': rs}
         except BaseException as e:
             return {'error': True, 'message': str(e)}
@@ -307,17 +342,16 @@ class K8sAPI(object):
     def delete_namespace_configmap(self, name, namespace='default', api_version='apps/v1'):
         try:
             ret = self.__client.delete_namespaced_config_map(name, namespace)
-            rs = ApiClient().sanitize_for_serialization(ret)
+            rs = self.__client.api_client.sanitize_for_serialization(ret)
             return {'ecode': 200, 'message': rs}
         except BaseException as e:
             return {'error': True, 'message': str(e)}
 
     def get_namespace_deployment(self, namespace='default', api_version='apps/v1', **kwargs):
-        self.__client2 = operator.methodcaller(''.join([i.capitalize() for i in api_version.split('/')]) + 'Api',
-                                               self.__client.api_client)(client)
-        ret = self.__client2.list_namespaced_deployment(namespace, **kwargs)
+        api = self.get_version_api(api_version)
+        ret = api.list_namespaced_deployment(namespace, **kwargs)
         try:
-            rs = ApiClient().sanitize_for_serialization(ret)
+            rs = self.__client.api_client.sanitize_for_serialization(ret)
             return rs
         except BaseException as e:
             return {'err': str(e)}
@@ -344,15 +378,12 @@ class K8sAPI(object):
         if deploy_yaml is not None:
             payload = yaml.safe_load(deploy_yaml)
             payload['metadata'].pop('resourceVersion', None)
-        self.__client2 = operator.methodcaller(
-            ''.join([i.capitalize() for i in payload.get(
-                'apiVersion', 'apps/v1beta2').split('/')]) + 'Api',
-            self.__client.api_client)(client)
+        api = self.get_version_api(payload.get('apiVersion', 'apps/v1beta2'))
         try:
-            ret = self.__client2.create_namespaced_deployment(
+            ret = api.create_namespaced_deployment(
                 namespace=namespace, body=payload)
             try:
-                rs = ApiClient().sanitize_for_serialization(ret)
+                rs = self.__client.api_client.sanitize_for_serialization(ret)
                 return {'ecode': 200, 'message': rs}
             except BaseException as e:
                 return {'ecode': e.status, 'message': e.body}
@@ -360,13 +391,12 @@ class K8sAPI(object):
             return {'ecode': e.status, 'message': e.body}
 
     def delete_namespace_deployment(self, name, namespace='default', api_version='apps/v1'):
-        self.__client2 = operator.methodcaller(''.join([i.capitalize() for i in api_version.split('/')]) + 'Api',
-                                               self.__client.api_client)(client)
-        ret = self.__client2.delete_namespaced_deployment(name, namespace,
-                                                          body=client.V1DeleteOptions(grace_period_seconds=0,
-                                                                                      propagation_policy='Foreground'))
+        api = self.get_version_api(api_version)
+        ret = api.delete_namespaced_deployment(name, namespace,
+                                               body=client.V1DeleteOptions(grace_period_seconds=0,
+                                                                           propagation_policy='Foreground'))
         try:
-            rs = ApiClient().sanitize_for_serialization(ret)
+            rs = self.__client.api_client.sanitize_for_serialization(ret)
             return rs
         except BaseException as e:
             return {'err': str(e)}
@@ -376,8 +406,7 @@ class K8sAPI(object):
         """
         force: 强制更新
         """
-        self.__client2 = operator.methodcaller(''.join([i.capitalize() for i in api_version.split('/')]) + 'Api',
-                                               self.__client.api_client)(client)
+        api = self.get_version_api(api_version)
         payload = {'spec': {'replicas': replicas, 'template': {}}}
         if replicas is None and image is None and deploy_yaml is None:
             return {'err': '缺少参数'}
@@ -396,13 +425,13 @@ class K8sAPI(object):
             payload['metadata'].pop('resourceVersion', None)
         try:
             if force:
-                ret = self.__client2.replace_namespaced_deployment(
+                ret = api.replace_namespaced_deployment(
                     name, namespace, body=payload)
             else:
-                ret = self.__client2.patch_namespaced_deployment(
+                ret = api.patch_namespaced_deployment(
                     name, namespace, body=payload)
             try:
-                rs = ApiClient().sanitize_for_serialization(ret)
+                rs = self.__client.api_client.sanitize_for_serialization(ret)
                 return {'ecode': 200, 'message': rs}
             except BaseException as e:
                 return {'ecode': e.status, 'message': e.body}
@@ -410,13 +439,12 @@ class K8sAPI(object):
             return {'ecode': e.status, 'message': e.body}
 
     def update_deployment_replica(self, name, replicas, namespace='default', api_version='apps/v1'):
-        self.__client2 = operator.methodcaller(''.join([i.capitalize() for i in api_version.split('/')]) + 'Api',
-                                               self.__client.api_client)(client)
+        api = self.get_version_api(api_version)
         payload = {'spec': {'replicas': replicas}}
-        ret = self.__client2.patch_namespaced_deployment_scale(
+        ret = api.patch_namespaced_deployment_scale(
             name, namespace, body=payload)
         try:
-            rs = ApiClient().sanitize_for_serialization(ret)
+            rs = self.__client.api_client.sanitize_for_serialization(ret)
             return rs
         except BaseException as e:
             return {'err': str(e)}
@@ -427,15 +455,14 @@ class K8sAPI(object):
             return deploy
         payload = {'spec': deploy['message']['spec']}
         payload['spec']['template']['spec']['containers'][0]['image'] = image
-        self.__client2 = operator.methodcaller(''.join([i.capitalize() for i in api_version.split('/')]) + 'Api',
-                                               self.__client.api_client)(client)
+        api = self.get_version_api(api_version)
         try:
-            ret = self.__client2.patch_namespaced_deployment(name, namespace, body=payload,
-                                                             **{'_return_http_data_only': False})
+            ret = api.patch_namespaced_deployment(name, namespace, body=payload,
+                                                  **{'_return_http_data_only': False})
         except ApiException as e:
             return {'ecode': e.status, 'message': e.body}
         try:
-            rs = ApiClient().sanitize_for_serialization(ret)
+            rs = self.__client.api_client.sanitize_for_serialization(ret)
             return {'ecode': 200, 'message': rs}
         except BaseException as e:
             return {'ecode': e.status, 'message': e.body}
@@ -444,19 +471,17 @@ class K8sAPI(object):
                                    **kwargs):
         payload = {'spec': {'template': {'spec': {'containers': [
             {'name': name, 'env': envs, 'imagePullPolicy': image_policy, 'resources': kwargs['resources']}]}}}}
-        self.__client2 = operator.methodcaller(''.join([i.capitalize() for i in api_version.split('/')]) + 'Api',
-                                               self.__client.api_client)(client)
-        ret = self.__client2.patch_namespaced_deployment(
+        api = self.get_version_api(api_version)
+        ret = api.patch_namespaced_deployment(
             name, namespace, body=payload)
         try:
-            rs = ApiClient().sanitize_for_serialization(ret)
+            rs = self.__client.api_client.sanitize_for_serialization(ret)
             return rs
         except BaseException as e:
             return {'err': str(e)}
 
     def restart_deployment(self, name, namespace='default', api_version='apps/v1'):
-        self.__client2 = operator.methodcaller(''.join([i.capitalize() for i in api_version.split('/')]) + 'Api',
-                                               self.__client.api_client)(client)
+        api = self.get_version_api(api_version)
         payload = {
             'spec': {
                 'template': {
@@ -477,21 +502,20 @@ class K8sAPI(object):
             }
         }
 
-        ret = self.__client2.patch_namespaced_deployment(
+        ret = api.patch_namespaced_deployment(
             name, namespace, body=payload)
         try:
-            rs = ApiClient().sanitize_for_serialization(ret)
+            rs = self.__client.api_client.sanitize_for_serialization(ret)
             return rs
         except BaseException as e:
             return {'err': str(e)}
 
     def fetch_deployment(self, name, namespace='default', api_version='apps/v1'):
-        self.__client2 = operator.methodcaller(''.join([i.capitalize() for i in api_version.split('/')]) + 'Api',
-                                               self.__client.api_client)(client)
+        api = self.get_version_api(api_version)
         try:
-            ret = self.__client2.read_namespaced_deployment(name, namespace)
+            ret = api.read_namespaced_deployment(name, namespace)
             try:
-                rs = ApiClient().sanitize_for_serialization(ret)
+                rs = self.__client.api_client.sanitize_for_serialization(ret)
                 return {'ecode': 200, 'message': rs}
             except ApiException as e:
                 return {'ecode': e.status, 'message': e.body}
@@ -499,48 +523,152 @@ class K8sAPI(object):
             return {'ecode': e.status, 'message': e.body}
 
     def get_replica(self, namespace='default', api_version='apps/v1', **kwargs):
-        self.__client2 = operator.methodcaller(''.join([i.capitalize() for i in api_version.split('/')]) + 'Api',
-                                               self.__client.api_client)(client)
+        api = self.get_version_api(api_version)
         try:
-            ret = self.__client2.list_namespaced_replica_set(
+            ret = api.list_namespaced_replica_set(
                 namespace=namespace, **kwargs)
             try:
-                rs = ApiClient().sanitize_for_serialization(ret)
+                rs = self.__client.api_client.sanitize_for_serialization(ret)
                 return {'ecode': 200, 'message': rs}
             except ApiException as e:
                 return {'ecode': e.status, 'message': e.body}
         except ApiException as e:
             return {'ecode': e.status, 'message': e.body}
 
+    def watch_resource(self, kind, namespace='default', api_version='apps/v1', timeout_seconds=60, **kwargs):
+        """
+        监听资源事件
+
+        :param kind: 资源类型, 如 deployment/replica_set/pod
+        :return: 生成器, (事件类型, 资源)
+        """
+        if kind == 'pod':
+            func = self.__client.list_namespaced_pod
+        else:
+            api = self.get_version_api(api_version)
+            func = getattr(api, f'list_namespaced_{kind}')
+        w = watch.Watch()
+        try:
+            for event in w.stream(func, namespace, timeout_seconds=timeout_seconds, **kwargs):
+                yield event['type'], self.__client.api_client.sanitize_for_serialization(event['object'])
+        finally:
+            w.stop()
+
     def get_pods(self, namespace=None, **kwargs):
         if namespace is None:
             return {}
         try:
             ret = self.__client.list_namespaced_pod(namespace, **kwargs)
             try:
-                rs = ApiClient().sanitize_for_serialization(ret)
+                rs = self.__client.api_client.sanitize_for_serialization(ret)
                 return {'ecode': 200, 'message': rs}
             except BaseException as e:
                 return {'ecode': e.status, 'message': e.body}
         except ApiException as e:
             return {'ecode': e.status, 'message': e.body}
 
+    def get_all_pods(self, **kwargs):
+        try:
+            ret = self.__client.list_pod_for_all_namespaces(**kwargs)
+            rs = self.__client.api_client.sanitize_for_serialization(ret)
+            return {'ecode': 200, 'message': rs}
+        except ApiException as e:
+            return {'ecode': e.status, 'message': e.body}
+
+    def get_pods_batch(self, namespaces, workers=POD_FETCH_WORKERS, **kwargs):
+        """
+        获取多个命名空间的pod
+        未分页且命名空间较多时使用全集群查询再按命名空间过滤, 无权限时回退为并发逐个查询
+        :return: {'items': [], 'metadata': {}}
+        """
+        ret = {'items': [], 'metadata': {}}
+        namespaces = list(dict.fromkeys(namespaces or []))
+        if not namespaces:
+            return ret
+        if len(namespaces) >= POD_CLUSTER_LIST_MIN and not kwargs.get('limit') and not kwargs.get('_continue'):
+            r = self.get_all_pods(**kwargs)
+            if r['ecode'] == 200:
+                ns_set = set(namespaces)
+                ret['items'] = [i for i in r['message'].get('items') or []
+                                if i['metadata'].get('namespace') in ns_set]
+                return ret
+            logger.info(f'全集群获取pod失败, 改为逐个命名空间获取: {r["ecode"]}')
+
+        with ThreadPoolExecutor(max_workers=min(workers, len(namespaces))) as executor:
+            results = list(executor.map(
+                lambda ns: self.get_pods(ns, **kwargs), namespaces))
+        ns_continue = []
+        for ns, r in zip(namespaces, results):
+            r = r['message']
+            try:
+                if r['metadata'].get('continue', None):
+                    ns_continue.append(r['metadata']['continue'])
+                ret['items'].extend(r['items'])
+            except BaseException as e:
+                logger.warning(f'获取命名空间{ns}的pod失败: {r}, {e}')
+        if ns_continue:
+            ret['metadata']['continue'] = ns_continue[0]
+        return ret
+
     def fetch_pod(self, name, namespace='default'):
         try:
             ret = self.__client.read_namespaced_pod(
                 name=name, namespace=namespace)
             try:
-                rs = ApiClient().sanitize_for_serialization(ret)
+                rs = self.__client.api_client.sanitize_for_serialization(ret)
                 return {'ecode': 200, 'message': rs}
             except BaseException as e:
                 return {'ecode': e.status, 'message': e.body}
         except BaseException as e:
             return {'ecode': e.status, 'message': e.body}
 
+    def get_ssl_context(self):
+        configuration = self.__client.api_client.configuration
+        if configuration.verify_ssl:
+            context = ssl.create_default_context(
+                cafile=configuration.ssl_ca_cert)
+        else:
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        if configuration.cert_file:
+            context.load_cert_chain(
+                configuration.cert_file, configuration.key_file)
+        return context
+
+    async def stream_pod_log(self, name, namespace='default', tail_lines=100, container=None, session=None):
+        """
+        异步读取Pod日志, 逐行返回
+        使用aiohttp直接请求apiserver, 调用方停止消费时不再读取响应, 由TCP反压至apiserver
+        """
+        api_client = self.__client.api_client
+        configuration = api_client.configuration
+        headers = dict(api_client.default_headers)
+        token = configuration.get_api_key_with_prefix('authorization')
+        if token:
+            headers['authorization'] = token
+        params = {'follow': 'true', 'tailLines': tail_lines}
+        if container:
+            params['container'] = container
+        url = f"{configuration.host}/api/v1/namespaces/{namespace}/pods/{name}/log"
+        close_session = session is None
+        if session is None:
+            session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=None, sock_read=None))
+        try:
+            async with session.get(url, params=params, headers=headers, ssl=self.get_ssl_context()) as resp:
+                if resp.status != 200:
+                    raise ApiException(status=resp.status, reason=await resp.text())
+                async for line in resp.content:
+                    yield line.decode('utf-8', errors='replace').rstrip('\n')
+        finally:
+            if close_session:
+                await session.close()
+
     def get_secrets(self, namespace='default', **kwargs):
         ret = self.__client.list_namespaced_secret(namespace, **kwargs)
         try:
-            rs = ApiClient().sanitize_for_serialization(ret)
+            rs = self.__client.api_client.sanitize_for_serialization(ret)
             return rs
         except BaseException as e:
             return {'error': True, 'message': str(e)}
@@ -553,7 +681,7 @@ class K8sAPI(object):
         try:
             ret = self.__client.read_namespaced_secret(
                 name, namespace, **kwargs)
-            rs = ApiClient().sanitize_for_serialization(ret)
+            rs = self.__client.api_client.sanitize_for_serialization(ret)
             return rs
         except BaseException as e:
             return {'error': True, 'message': str(e)}
@@ -561,15 +689,76 @@ class K8sAPI(object):
     def manage_secret(self, name, namespace='default', api_version='v1', **kwargs):
         payload = kwargs.pop('payload', {})
         body = kubernetes.client.V1Secret(api_version=api_version, **payload)
-        ret = {}
         try:
             ret = self.__client.replace_namespaced_secret(
                 name, namespace, body, **kwargs)
         except ApiException as e:
-            if e.status == 404:
-                ret = self.__client.create_namespaced_secret(namespace, body)
+            if e.status != 404:
+                return {'error': True, 'ecode': e.status, 'message': e.body}
+            ret = self.__client.create_namespaced_secret(namespace, body)
         try:
-            rs = ApiClient().sanitize_for_serialization(ret)
+            rs = self.__client.api_client.sanitize_for_serialization(ret)
             return rs
         except BaseException as e:
             return {'error': True, 'message': str(e)}
+
+
+class K8sClientPool(object):
+    """
+    进程级K8sAPI实例池
+
+    每个集群保留一个K8sAPI实例以复用HTTP连接, 集群配置摘要变化时重建实例;
+    fork后的子进程不复用父进程的连接.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._clients = {}
+        self._pid = os.getpid()
+
+    @staticmethod
+    def fingerprint(k8s_config):
+        return hashlib.md5(json.dumps(k8s_config, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._clients = {}
+                    self._key_locks = {}
+                    self._pid = os.getpid()
+
+    def get(self, key, k8s_config, factory):
+        """
+        获取集群K8sAPI实例
+
+        :param key: 集群标识, 一般为集群ID
+        :param k8s_config: 集群配置, 用于计算摘要
+        :param factory: 无参函数, 返回新的K8sAPI实例
+        """
+        self._check_pid()
+        fingerprint = self.fingerprint(k8s_config)
+        item = self._clients.get(key)
+        if item and item[0] == fingerprint:
+            return item[1]
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            item = self._clients.get(key)
+            if item and item[0] == fingerprint:
+                return item[1]
+            cli = factory()
+            self._clients[key] = (fingerprint, cli)
+        # 旧实例可能仍被其它线程使用, 不主动关闭, 无引用后由垃圾回收释放连接
+        return cli
+
+    def evict(self, key):
+        self._clients.pop(key, None)
+
+    def clear(self):
+        for key in list(self._clients.keys()):
+            self.evict(key)
+
+
+k8s_client_pool = K8sClientPool()
@@ -8,6 +8,10 @@
 @Blog    : https://blog.imaojia.com
 """
 
+import json
+import os
+import threading
+
 import redis
 from django_redis.client import DefaultClient
 from rediscluster import ClusterConnectionPool, RedisCluster
@@ -28,23 +32,103 @@ class CustomRedisCluster(DefaultClient):
                             nodemanager_follow_cluster=True)
 
 
+class RedisPoolRegistry(object):
+    """
+    进程级redis连接池注册表, 按连接参数复用连接池
+    fork后(django-q/celery worker)自动重建, 不复用父进程的连接
+    """
+
+    def __init__(self):
+        self._pools = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pools = {}
+                    self._pid = os.getpid()
+
+    def get(self, key, factory):
+        self._check_pid()
+        pool = self._pools.get(key)
+        if pool is None:
+            with self._lock:
+                pool = self._pools.get(key)
+                if pool is None:
+                    pool = self._pools[key] = factory()
+        return pool
+
+    def clear(self):
+        with self._lock:
+            for pool in self._pools.values():
+                try:
+                    pool.disconnect()
+                except BaseException:
+                    pass
+            self._pools = {}
+
+
+redis_pool_registry = RedisPoolRegistry()
+
+
 class RedisManage(object):
 
+    @staticmethod
+    def connection_kwargs(config):
+        kwargs = {}
+        # 可选: 空闲连接健康检查间隔(秒)
+        if config.get('health_check_interval', None):
+            kwargs['health_check_interval'] = config['health_check_interval']
+        return kwargs
+
+    @classmethod
+    def get_pool(cls, decode_responses=True):
+        if REDIS_CLUSTER_CONFIG.get('startup_nodes', None):
+            key = ('cluster', json.dumps(
+                REDIS_CLUSTER_CONFIG['startup_nodes'], sort_keys=True), decode_responses)
+            return redis_pool_registry.get(key, lambda: ClusterConnectionPool(
+                startup_nodes=REDIS_CLUSTER_CONFIG['startup_nodes'],
+                password=REDIS_CLUSTER_CONFIG.get('password', ''),
+                nodemanager_follow_cluster=True,
+                decode_responses=decode_responses,
+                **cls.connection_kwargs(REDIS_CLUSTER_CONFIG)))
+        key = (REDIS_CONFIG['host'], REDIS_CONFIG['port'],
+               REDIS_CONFIG['db'], decode_responses)
+        return redis_pool_registry.get(key, lambda: redis.ConnectionPool(
+            host=REDIS_CONFIG['host'], port=REDIS_CONFIG['port'], db=REDIS_CONFIG['db'],
+            password=REDIS_CONFIG.get('password', ''), decode_responses=decode_responses,
+            **cls.connection_kwargs(REDIS_CONFIG)))
+
     @classmethod
     def conn(cls):
+        pool = cls.get_pool()
         if REDIS_CLUSTER_CONFIG.get('startup_nodes', None):
-            pool = ClusterConnectionPool(startup_nodes=REDIS_CLUSTER_CONFIG['startup_nodes'],
-                                         password=REDIS_CLUSTER_CONFIG.get(
-                                             'password', ''),
-                                         nodemanager_follow_cluster=True,
-                                         decode_responses=True, )
             return RedisCluster(connection_pool=pool, nodemanager_follow_cluster=True)
-        pool = redis.ConnectionPool(host=REDIS_CONFIG['host'], port=REDIS_CONFIG['port'], db=REDIS_CONFIG['db'],
-                                    password=REDIS_CONFIG.get('password', ''), decode_responses=True)
         return redis.Redis(connection_pool=pool)
 
+    @staticmethod
+    def pubsub_node():
+        """
+        订阅使用的节点, 与conn()发布的Redis一致
+        集群模式下PUBLISH会广播到所有节点, 订阅任一启动节点即可
+        :return: {host, port, db, password}
+        """
+        if REDIS_CLUSTER_CONFIG.get('startup_nodes', None):
+            node = REDIS_CLUSTER_CONFIG['startup_nodes'][0]
+            return {'host': node['host'], 'port': int(node['port']), 'db': 0,
+                    'password': REDIS_CLUSTER_CONFIG.get('password', '')}
+        return {'host': REDIS_CONFIG['host'], 'port': REDIS_CONFIG['port'], 'db': REDIS_CONFIG['db'],
+                'password': REDIS_CONFIG.get('password', '')}
+
     @staticmethod
     def get_pubsub():
-        r = redis.StrictRedis(host=REDIS_CONFIG['host'], port=REDIS_CONFIG['port'], db=REDIS_CONFIG['db'],
-                              password=REDIS_CONFIG.get('password', ''))
+        node = RedisManage.pubsub_node()
+        config = REDIS_CLUSTER_CONFIG if REDIS_CLUSTER_CONFIG.get(
+            'startup_nodes', None) else REDIS_CONFIG
+        key = (node['host'], node['port'], node['db'], False)
+        pool = redis_pool_registry.get(key, lambda: redis.ConnectionPool(
+            **node, **RedisManage.connection_kwargs(config)))
+        r = redis.StrictRedis(connection_pool=pool)
         return r.pubsub(ignore_subscribe_messages=True)
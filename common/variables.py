@@ -331,12 +331,24 @@ MSG_KEY = 'cicd:notify::'
 MSG_QUEUE_KEY = 'queue:notify::'  # {MSG_QUEUE_KEY}{MSG_KEY}
 # 延时通知key
 DELAY_NOTIFY_KEY = 'delay:notify::'  # {DELAY_NOTIFY_KEY}{MSG_KEY}
+# 通知发送计划, 有序集合, 成员为MSG_KEY, 分值为到期时间戳
+NOTIFY_SCHEDULE_KEY = 'schedule:notify'
 
 # CD构建结果key
 CI_RESULT_KEY = 'ci:result:'
 CD_RESULT_KEY = 'cd:result:'  # {CD_RESULT_KEY}{job.id}
 # 部署阶段日志
 CD_STAGE_RESULT_KEY = 'cd:result:stage:'
+# 部署进度哈希
+CD_STAGE_HASH_KEY = 'cd:result:progress::'  # {CD_STAGE_HASH_KEY}{job.id}
+# K8S集群命名空间/Service缓存
+K8S_RESOURCE_CACHE_KEY = 'k8s:resource::'  # {K8S_RESOURCE_CACHE_KEY}{cluster.id}:{kind}:{namespace}:{name}
+# 任务记录就绪通知
+JOB_READY_KEY = 'job:ready::'  # {JOB_READY_KEY}{name}:{job.id}
+# 部署进度增量推送频道
+CD_STAGE_CHANNEL = 'cd:result:progress:channel::'  # {CD_STAGE_CHANNEL}{job.id}
+# 部署任务排队时, 等待进度写入的检查间隔(秒)
+CD_STAGE_WAIT_INTERVAL = 5
 # 最新发布记录
 CD_LATEST_KEY = 'cd:deploy:latest::'  # {CD_LATEST_KEY}{appinfo.id}
 # WEB构建结果key
@@ -411,6 +423,16 @@ DASHBOARD_CONFIG = {
         {"key": "应用模块", "value": "cmdb.appinfo", "type": "rds"}
     ]
 }
+# 报表缓存key
+DASHBOARD_CACHE_KEY = 'dashboard:chart::'  # {DASHBOARD_CACHE_KEY}{chart}:{user}:{query}
+# 报表缓存时间(秒)
+DASHBOARD_CACHE_TTL = 60
+# 资产日汇总计数, redis hash, 字段为 {区域}|{日期} 及 {区域}|total, 区域为空表示全部
+DASHBOARD_ROLLUP_KEY = 'dashboard:rollup::'  # {DASHBOARD_ROLLUP_KEY}{model}
+# 参与日汇总的模型及其区域字段
+DASHBOARD_ROLLUP_MODELS = {'product': 'region__name', 'project': 'product__region__name',
+                           'microapp': 'project__product__region__name',
+                           'appinfo': 'app__project__product__region__name'}
 # 报表时间格式
 DASHBOARD_TIME_FORMAT = {'year_only': '%Y', 'years': '%Y-%m', 'months': '%Y-%m-%d', 'days': '%Y-%m-%d %H:00:00',
                          'hours': '%Y-%m-%d %H:%M:00', 'minutes': '%Y-%m-%d %H:%M:%S'}
@@ -438,11 +460,56 @@ DEV_LANGUAGE_FILE_MAP = {
     'template_k8s': 'deployment.yaml'
 }
 DEV_LANGUAGE_KEY = 'devlanguage:'
+# Deployment模板编译缓存
+TEMPLATE_CACHE_KEY = 'template:deployment::'  # {TEMPLATE_CACHE_KEY}{appinfo.id}:{version}
+TEMPLATE_CACHE_TTL = 60 * 60
 
 # 运算符
 OPERATOR_MAP = {'/': 'truediv', '*': 'mul', '**': 'pow',
                 '+': 'add', '-': 'sub', '%': 'mod', '//': 'floordiv'}
 
+# 权限版本号, 角色/权限/用户角色变更时递增
+RBAC_VERSION_KEY = 'ucenter:rbac:version'
+# 用户权限快照本地缓存
+RBAC_SNAPSHOT_CACHE = {'maxsize': 4096, 'ttl': 600}
+# 权限版本号及平台白名单本地缓存时长(秒), 其他进程的变更最迟在此时长后生效
+RBAC_SHARED_TTL = 5
+
+# 审计日志批量写入条数
+AUDIT_LOG_BATCH_SIZE = 100
+# 审计日志写入间隔(秒)
+AUDIT_LOG_FLUSH_INTERVAL = 1
+
+# 批量处理队列(redis列表), 处理中的批次: {DURABLE_QUEUE_KEY}{name}:processing:{token}
+DURABLE_QUEUE_KEY = 'queue:durable:'  # {DURABLE_QUEUE_KEY}{name}
+# 处理中批次的租约时长(秒), 过期后放回队列
+DURABLE_QUEUE_LEASE = 60
+
+# 列表分页计数缓存
+PAGINATION_COUNT_KEY = 'pagination:count::'  # {PAGINATION_COUNT_KEY}{md5(sql)}
+PAGINATION_COUNT_TTL = 60
+# 无过滤条件时, 表统计行数不少于该值则使用估算总数
+PAGINATION_APPROXIMATE_MIN = 100000
+
+# 搜索n-gram索引, {model}为redis cluster hash tag
+SEARCH_INDEX_KEY = 'search:ngram::'  # {SEARCH_INDEX_KEY}{{{model}}}:g:{gram} / :d:{pk} / :ready
+# 建立搜索索引的模型及字段, 关联字段在保存时取值, 关联数据变更需重建索引
+SEARCH_INDEX_MODELS = {
+    'microapp': ('category', 'name', 'alias', 'language', 'appid'),
+    'deployjob': ('uniq_id', 'image'),
+    'publishorder': ('order_id', 'dingtalk_tid', 'title', 'content', 'effect', 'creator__first_name'),
+}
+# 候选结果超过该数量时回退为模糊查询
+SEARCH_INDEX_MAX_CANDIDATES = 5000
+
+# 数据字典缓存
+DATADICT_CACHE_KEY = 'ucenter:datadict::'  # {DATADICT_CACHE_KEY}{key}
+DATADICT_CACHE_TTL = 60 * 10
+# 数据字典失效通知频道, 消息内容为字典key
+DATADICT_CHANNEL = 'ucenter:datadict:invalidate'
+# 进程内数据字典缓存
+DATADICT_LOCAL_CACHE = {'maxsize': 1024, 'ttl': 300}
+
 # 同步AD用户任务KEY
 LDAP_SYNC_USER_JOB_CACHE_KEY = 'celery_job:ldap_user_sync'
 # 同步飞书组织架构任务key
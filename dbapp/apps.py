@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class DbappConfig(AppConfig):
     name = 'dbapp'
+
+    def ready(self):
+        import dbapp.signals  # noqa: F401
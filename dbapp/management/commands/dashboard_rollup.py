@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+'''
+@author  :   Charles Lai
+@file    :   dashboard_rollup.py
+@time    :   2023/05/19 16:05
+@contact :   qqing_lai@hotmail.com
+@company :   IMAOJIA Co,Ltd
+'''
+
+# here put the import lib
+from django.core.management.base import BaseCommand
+
+from dashboard.rollup import DashboardRollup
+from common.variables import DASHBOARD_ROLLUP_MODELS
+
+
+class Command(BaseCommand):
+    help = "回填或检查仪表盘资产日汇总计数"
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*',
+                            help=f"模型, 默认全部: {', '.join(DASHBOARD_ROLLUP_MODELS)}")
+        parser.add_argument(
+            "--check",
+            action="store_true",
+            dest="check",
+            default=False,
+            help="只检查汇总计数与数据库是否一致",
+        )
+        parser.add_argument(
+            "--fix",
+            action="store_true",
+            dest="fix",
+            default=False,
+            help="检查时对不一致的模型重新回填",
+        )
+
+    def handle(self, *args, **options):
+        models = options['models'] or list(DASHBOARD_ROLLUP_MODELS)
+        for name in models:
+            rollup = DashboardRollup.get(name)
+            if rollup is None:
+                self.stderr.write(f'[{name}] 不支持汇总')
+                continue
+            if not options['check']:
+                data = rollup.backfill()
+                self.stdout.write(self.style.SUCCESS(
+                    f"[{name}] 回填完成, 共{data.get('|total', 0)}条"))
+                continue
+            diff = rollup.check()
+            if diff is None:
+                self.stdout.write(self.style.WARNING(f'[{name}] 未回填'))
+            elif not diff:
+                self.stdout.write(self.style.SUCCESS(f'[{name}] 一致'))
+            else:
+                for field, (expected, current) in sorted(diff.items()):
+                    self.stdout.write(self.style.ERROR(
+                        f'[{name}] {field}: 数据库 {expected}, 汇总 {current}'))
+            if options['fix'] and diff != {}:
+                rollup.backfill()
+                self.stdout.write(self.style.SUCCESS(f'[{name}] 已重新回填'))
@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+'''
+@author  :   Charles Lai
+@file    :   search_index.py
+@time    :   2023/05/20 11:52
+@contact :   qqing_lai@hotmail.com
+@company :   IMAOJIA Co,Ltd
+'''
+
+# here put the import lib
+from django.core.management.base import BaseCommand
+
+from common.extends.search import NgramSearchIndex
+from common.variables import SEARCH_INDEX_MODELS
+
+
+class Command(BaseCommand):
+    help = "重建搜索n-gram索引"
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*',
+                            help=f"模型, 默认全部: {', '.join(SEARCH_INDEX_MODELS)}")
+
+    def handle(self, *args, **options):
+        for name in options['models'] or list(SEARCH_INDEX_MODELS):
+            index = NgramSearchIndex.get(name)
+            if index is None:
+                self.stderr.write(f'[{name}] 未配置搜索索引')
+                continue
+            count = index.rebuild()
+            self.stdout.write(self.style.SUCCESS(
+                f'[{name}] 索引重建完成, 共{count}条'))
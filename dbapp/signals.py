@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+'''
+@author  :   Charles Lai
+@file    :   signals.py
+@time    :   2023/05/20 11:40
+@contact :   qqing_lai@hotmail.com
+'''
+
+# here put the import lib
+from django.apps import apps
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
+
+from common.extends.search import NgramSearchIndex
+from common.variables import SEARCH_INDEX_MODELS
+
+import logging
+
+logger = logging.getLogger('drf')
+
+
+def search_index_changed(sender, instance, **kwargs):
+    index = NgramSearchIndex(sender._meta.model_name)
+    pk = instance.pk
+    deleted = 'created' not in kwargs
+
+    def update():
+        try:
+            index.remove(pk) if deleted else index.index(pk)
+        except BaseException as e:
+            logger.error(f'更新搜索索引[{index.name}:{pk}]失败，原因：{e}')
+    # 事务提交后更新索引
+    transaction.on_commit(update)
+
+
+def reindex(index, pks):
+    """
+    事务提交后重建指定文档的索引
+    """
+    pks = list(pks)
+
+    def update():
+        pk = None
+        try:
+            for pk in pks:
+                index.index(pk)
+        except BaseException as e:
+            logger.error(f'更新搜索索引[{index.name}:{pk}]失败，原因：{e}')
+    if pks:
+        transaction.on_commit(update)
+
+
+def related_indexes(sender):
+    """
+    :return: 跨关联引用sender的索引及关联字段, [(索引, 关联字段名, 关联对象上的字段)]
+    """
+    for name, fields in SEARCH_INDEX_MODELS.items():
+        index = NgramSearchIndex(name)
+        for field in fields:
+            if '__' not in field:
+                continue
+            relation, related_field = field.split('__', 1)
+            if index.model._meta.get_field(relation).related_model is sender:
+                yield index, relation, related_field
+
+
+def search_index_related_changed(sender, instance, update_fields=None, **kwargs):
+    """
+    跨关联的索引字段(如 creator__first_name)所在对象变更时, 更新引用它的文档索引
+    """
+    for index, relation, related_field in related_indexes(sender):
+        if update_fields and related_field.split('__')[0] not in update_fields:
+            # 如登录仅更新last_login, 无需更新索引
+            continue
+        reindex(index, index.model.objects.filter(
+            **{relation: instance.pk}).values_list('pk', flat=True))
+
+
+def search_index_related_deleted(sender, instance, **kwargs):
+    """
+    关联对象删除前记录引用它的文档, 删除(置空或级联)提交后更新索引; 级联删除的文档由post_delete移除
+    """
+    for index, relation, _ in related_indexes(sender):
+        reindex(index, index.model.objects.filter(
+            **{relation: instance.pk}).values_list('pk', flat=True))
+
+
+def search_index_m2m_changed(sender, instance, action, reverse, model, pk_set, **kwargs):
+    """
+    多对多关联变更时更新文档索引
+    """
+    if action not in ['post_add', 'post_remove', 'pre_clear']:
+        return
+    for index, relation, _ in related_indexes(model if not reverse else type(instance)):
+        if index.model._meta.get_field(relation).remote_field.through is not sender:
+            continue
+        if not reverse:
+            reindex(index, [instance.pk])
+        elif action == 'pre_clear':
+            reindex(index, index.model.objects.filter(
+                **{relation: instance.pk}).values_list('pk', flat=True))
+        else:
+            reindex(index, pk_set or [])
+
+
+for name, fields in SEARCH_INDEX_MODELS.items():
+    model = apps.get_model('dbapp', name)
+    post_save.connect(search_index_changed, sender=model,
+                      dispatch_uid=f'search_index_save_{name}')
+    post_delete.connect(search_index_changed, sender=model,
+                        dispatch_uid=f'search_index_delete_{name}')
+    for relation in {i.split('__')[0] for i in fields if '__' in i}:
+        field = model._meta.get_field(relation)
+        related_model = field.related_model
+        post_save.connect(search_index_related_changed, sender=related_model,
+                          dispatch_uid=f'search_index_related_{related_model._meta.model_name}')
+        pre_delete.connect(search_index_related_deleted, sender=related_model,
+                           dispatch_uid=f'search_index_related_delete_{related_model._meta.model_name}')
+        if field.many_to_many:
+            m2m_changed.connect(search_index_m2m_changed, sender=field.remote_field.through,
+                                dispatch_uid=f'search_index_m2m_{name}_{relation}')
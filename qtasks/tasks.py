@@ -26,7 +26,7 @@ from channels.db import database_sync_to_async
 from dbapp.model.model_cmdb import KubernetesDeploy, MicroApp, Project
 from dbapp.models import KubernetesCluster, Idc, AppInfo, Environment
 from common.utils.GitLabAPI import GitLabAPI
-from dbapp.model.model_deploy import BuildJob, DeployJob, PublishApp, PublishOrder, BuildJobResult
+from dbapp.model.model_deploy import BuildJob, DeployJob, PublishApp, BuildJobResult
 from dbapp.model.model_ucenter import UserProfile, SystemConfig, Organization, DataDict
 from dbapp.model.model_workflow import Workflow, WorkflowNodeHistory, WorkflowNodeHistoryCallback, WorkflowTemplateRevisionHistory
 from workflow.callback_common import callback_work
@@ -42,13 +42,16 @@ from common.MailSend import OmsMail
 from common.ext_fun import get_datadict, get_datadict, get_redis_data, k8s_cli, set_redis_data, template_svc_generate, \
     get_project_mergerequest
 from common.custom_format import convert_xml_to_str_with_pipeline
+from common.deploy_stage import get_deploy_result
+from common.kubernetes_utils import K8sResourceCache
+from common.notify_queue import NotifyQueue
 from common.variables import *
+from common.variables import CD_STAGE_HASH_KEY
 
 from config import FEISHU_URL, MEDIA_ROOT, SOCIAL_AUTH_FEISHU_KEY, SOCIAL_AUTH_FEISHU_SECRET, SOCIAL_AUTH_GITLAB_API_URL
 
 from ruamel import yaml
 import asyncio
-import datetime
 import json
 import time
 import pytz
@@ -69,12 +72,12 @@ def clean_image_task(*args):
     # 获取镜像保留份数
     image_retain = get_datadict('IMAGE_RETAIN', config=1)
     repo = image.split(':')[0]
-    # 获取app的k8s集合
-    k8s_cluster = appinfo_obj.kubernetes.all()
-    for k8s in k8s_cluster:
+    # 获取app的k8s集群关联的harbor仓库, 相同仓库只清理一次
+    harbor_ids = set(appinfo_obj.kubernetes.values_list(
+        'idc__repo', flat=True))
+    for harbor_id in harbor_ids:
         try:
-            # 获取idc关联的harbor仓库
-            harbor = SystemConfig.objects.get(id=k8s.idc.repo)
+            harbor = SystemConfig.objects.get(id=harbor_id)
             # 获取harbor配置
             harbor_config = json.loads(harbor.config)
             logger.info(f'开始清理仓库{harbor.name}镜像{repo}')
@@ -87,9 +90,9 @@ def clean_image_task(*args):
             _retain = (image_retain.get(appinfo_obj.environment.name.split('_')[-1].lower(),
                                         None) if image_retain else 10) or 10
             if res['count'] > _retain:
-                # 清理历史版本
-                for _t in res['data'][_retain:]:
-                    cli.delete_tag(repo, _t['name'])
+                # 并发清理历史版本
+                cli.delete_tags(
+                    repo, [_t['name'] for _t in res['data'][_retain:]])
         except BaseException as e:
             logger.warning(f'清理Harbor[{repo}]标签异常, 原因: {e}')
 
@@ -100,6 +103,8 @@ def docker_image_sync(*args, **kwargs):
     """
     # 待发版的app数组
     apps = kwargs['apps']
+    # 按harbor仓库汇总待同步镜像
+    harbor_images = {}
     for app in apps:
         appinfo_obj = AppInfo.objects.get(id=app['id'])
         namespace = appinfo_obj.namespace
@@ -108,30 +113,26 @@ def docker_image_sync(*args, **kwargs):
         image = f"{namespace}/{_image[0]}"
         tag = _image[1]
 
-        # 获取app的k8s集合
-        k8s_cluster = appinfo_obj.kubernetes.all()
-        for k8s in k8s_cluster:
-            # 获取idc关联的harbor仓库
-            harbor = SystemConfig.objects.get(id=k8s.idc.repo)
-            # 获取harbor配置
-            harbor_config = json.loads(harbor.config)
-            # 调用Harbor api推送
-            cli = HarborAPI(url=harbor_config['ip'], username=harbor_config['user'],
-                            password=harbor_config['password'])
-            # 检测镜像标签是否存在
-            res = cli.fetch_tag(image, tag)
-            if res.get('ecode', 500) > 399:
-                # 镜像标签不存在
-                res = cli.patch_tag(image, src_image, tag)
-                if res.get('ecode', 500) > 399:
-                    # 打标签异常
-                    sync_stat = 1
-                else:
-                    if isinstance(res['data'], bytes):
-                        res['data'] = res['data'].decode('utf-8')
-                logger.info(f'{image}:{tag}镜像同步结果: {res}')
-            else:
+        # 获取app的k8s集群关联的harbor仓库
+        for harbor_id in set(appinfo_obj.kubernetes.values_list('idc__repo', flat=True)):
+            harbor_images.setdefault(harbor_id, set()).add(
+                (image, src_image, tag))
+
+    for harbor_id, images in harbor_images.items():
+        # 获取harbor配置
+        harbor = SystemConfig.objects.get(id=harbor_id)
+        harbor_config = json.loads(harbor.config)
+        # 调用Harbor api并发推送
+        cli = HarborAPI(url=harbor_config['ip'], username=harbor_config['user'],
+                        password=harbor_config['password'])
+        images = list(images)
+        for (image, src_image, tag), (synced, res) in zip(images, cli.sync_tags(images)):
+            if not synced:
                 logger.info(f'{image}:{tag}镜像存在, 不需要同步.')
+                continue
+            if res.get('ecode', 500) <= 399 and isinstance(res.get('data'), bytes):
+                res['data'] = res['data'].decode('utf-8')
+            logger.info(f'{image}:{tag}镜像同步结果: {res}')
 
 
 @app.task
@@ -139,37 +140,13 @@ def deploy_notify_cron():
     """
     部署消息通知定时任务
     """
-    _keys = [v for k, v in cache.get_many(cache.keys(f'{MSG_KEY}*')).items() if
-             isinstance(v, (dict,)) and v.get('msg_key', None)]
-    _keys = list(set([i['msg_key'] for i in _keys]))
-    for _key in _keys:
-        _send = False
-        try:
-            # 判断是否工单, 工单状态是否完成
-            _check_order = _key.split(MSG_KEY)[1].split(':')[0]
-            if _check_order.isdigit():
-                # 查询工单状态
-                if PublishOrder.objects.get(order_id=_check_order).status in [1, 2, 4]:
-                    # 标记立即发送
-                    _send = True
-        except BaseException as e:
-            pass
-        _delay = 0.1
-        delay = cache.get(f"{DELAY_NOTIFY_KEY}{_key}")
-        if delay:
-            _time_diff = (datetime.datetime.now() - delay['curr_time']).seconds
-            # 时间差大于延时则发送消息
-            if _time_diff >= delay['delay']:
-                _send = True
-        if _send:
-            _qkeys = cache.keys(f"{_key}:*")
-            if _qkeys:
-                msg = cache.get(_qkeys[0])
-                robot = msg['robot']
-                title = msg['title']
-                order_id = msg.get('order_id', None)
-                deploy_notify_queue.apply_async([_key], {'cron': True, 'order_id': order_id, 'robot': robot,
-                                                         'title': title}, countdown=_delay)
+    # 只取出已到期的通知分组, 工单完成时分组会被提前标记为到期
+    for _key in NotifyQueue.pop_due():
+        msg = NotifyQueue.drain(_key)
+        if msg:
+            _msg = next(iter(msg.values()))
+            async_task(deploy_notify_send, _msg.get('order_id', None),
+                       _msg['title'], msg, _msg['robot'])
 
 
 def deploy_notify_queue(*args, **kwargs):
@@ -182,9 +159,7 @@ def deploy_notify_queue(*args, **kwargs):
     title = kwargs['title']
     robot = kwargs['robot']
     order_id = kwargs.pop('order_id', None)
-    _keys = sorted(cache.keys(f"{msg_key}:*"), reverse=True)
-    msg = cache.get_many(_keys)
-    cache.delete_many(_keys)
+    msg = NotifyQueue.drain(msg_key)
     if msg:
         async_task(deploy_notify_send, order_id, title, msg, robot)
 
@@ -289,6 +264,9 @@ def k8s_resource_delete(*args, **kwargs):
     except BaseException as e:
         return None
     ret = []
+    if resource in ['deployment', 'service', 'services']:
+        K8sResourceCache.invalidate(
+            cluster_id, 'service', kwargs['namespace'], kwargs['app_name'])
     if resource == 'deployment':
         ret.append(cli.delete_namespace_deployment(
             kwargs['app_name'], kwargs['namespace'], api_version))
@@ -312,6 +290,7 @@ def k8s_service_create(cluster_id, k8s_config, name, targets, namespace='default
     if not cli[0]:
         return {'job': '创建Service', 'msg': 'Kubernetes配置异常，请联系运维！'}
     cli = cli[1]
+    K8sResourceCache.invalidate(cluster_id, 'service', namespace, name)
     ret = cli.create_namespace_service(name, targets, namespace, service_type)
     return {'job': '创建Deployment', 'msg': ret}
 
@@ -353,7 +332,7 @@ def watch_k8s_deployment(*args):
     count = 0
     while _flag:
         app_deploy_stat = cache.get(f'appdeploy:stat:{job.id}')
-        msg = cache.get(f'appdeploy:{job.id}')
+        msg = get_deploy_result(job.id)
         if not app_deploy_stat:
             async_to_sync(channel_layer.send)(
                 channel_name,
@@ -387,6 +366,7 @@ def watch_k8s_deployment(*args):
             if DeployJob.objects.get(id=job_id).status != 3:
                 cache.delete(f'appdeploy:{job.id}')
                 redis_conn.delete(job.id)
+                redis_conn.delete(f"{CD_STAGE_HASH_KEY}{job.id}")
 
 
 @app.task
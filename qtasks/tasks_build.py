@@ -26,8 +26,11 @@ from common.MailSend import OmsMail
 from common.custom_format import convert_xml_to_str_with_pipeline
 
 from common.ext_fun import get_datadict, get_redis_data
+from common.job_wait import poll_backoff
+from common.notify_queue import NotifyQueue
 from common.utils.JenkinsAPI import GlueJenkins
 from common.variables import *
+from common.variables import CI_LATEST_KEY
 from dbapp.model.model_deploy import BuildJob, BuildJobResult
 from dbapp.model.model_ucenter import DataDict
 
@@ -88,22 +91,24 @@ def jenkins_log_console(channel_name, job_id, appinfo_id=0, job_type='app'):
     jbuild = JenkinsBuild(JENKINS_CONFIG['url'], username=JENKINS_CONFIG['user'],
                           password=JENKINS_CONFIG['password'], job_id=job_id, appinfo_id=appinfo_id, job_type=job_type)
     count = 0
+    offset = 0
     _flag = True
     while _flag:
         time.sleep(0.1)
         count += 1
         try:
-            job_name, job, _ = jbuild.job_info()
-            ok, message = jbuild.log_console()
+            # 基于progressiveText偏移量只获取新增日志
+            ok, message, offset = jbuild.log_console_progressive(offset)
             if ok:
                 _flag = False
-            async_to_sync(channel_layer.send)(
-                channel_name,
-                {
-                    "type": "send.message",
-                    "message": message
-                }
-            )
+            if message['data'] or ok:
+                async_to_sync(channel_layer.send)(
+                    channel_name,
+                    {
+                        "type": "send.console",
+                        "message": message
+                    }
+                )
             if count > 600 or _flag is False:
                 async_to_sync(channel_layer.send)(
                     channel_name,
@@ -226,19 +231,29 @@ class JenkinsBuild(object):
             return True, {'status': flow_info['result'], 'data': flow_json}
         return False, {'status': flow_info['result'], 'data': flow_json}
 
-    def queue(self, queue_number):
-        count = 0
-        _flag = True
-        while _flag:
+    def log_console_progressive(self, start=0):
+        """
+        增量获取控制台日志
+
+        :param start: 日志偏移量
+        :return: (是否结束, {'status': 构建结果, 'data': 新增日志, 'offset': 新增日志起始偏移量}, 下次偏移量)
+        """
+        job_name, job, _ = self.job_info()
+        text, offset, more_data = self.jenkins_cli.get_build_console_progressive(
+            job_name, job.build_number, start=start)
+        status = None
+        if not more_data:
+            status = self.jenkins_cli.get_build_info(
+                job_name, job.build_number)['result']
+        return not more_data, {'status': status, 'data': text, 'offset': start}, offset
+
+    def queue(self, queue_number, timeout=300):
+        def check():
             queue_item = self.jenkins_cli.get_queue_item(queue_number)
-            if 'executable' in queue_item:
-                if queue_item['executable'].get('number', None):
-                    return True, queue_item['executable']['number']
-            count += 1
-            if count > 600:
-                _flag = False
-            time.sleep(0.5)
-        return False, 0
+            number = (queue_item.get('executable') or {}).get('number', None)
+            return bool(number), number or 0
+        # Jenkins队列无事件通知, 按指数退避轮询
+        return poll_backoff(check, timeout=timeout, interval=0.5, max_interval=5)
 
     def create(self, jenkinsfile='jardependency/Jenkinsfile', desc='Jar依赖包构建上传任务'):
         JENKINS_CONFIG = get_redis_data('cicd-jenkins')
@@ -430,13 +445,11 @@ class JenkinsBuild(object):
                     robot = notify['robot']
                     recv_phone = job.deployer.mobile
                     recv_openid = job.deployer.feishu_openid
-                    cache.set(f"{msg_key}:ci:{job.id}",
-                              {'appid': appinfo_obj.app.appid, 'robot': robot, 'recv_phone': recv_phone,
-                               'recv_openid': recv_openid, 'msg_key': msg_key,
-                               'msg': msg,
-                               'title': title}, 60 * 60 * 3)
-                    cache.set(f"{DELAY_NOTIFY_KEY}{msg_key}", {'curr_time': datetime.datetime.now(), 'delay': delay},
-                              60 * 60 * 3)
+                    NotifyQueue.enqueue(msg_key, f"{msg_key}:ci:{job.id}",
+                                        {'appid': appinfo_obj.app.appid, 'robot': robot, 'recv_phone': recv_phone,
+                                         'recv_openid': recv_openid, 'msg_key': msg_key,
+                                         'msg': msg,
+                                         'title': title}, delay)
                     taskid = schedule('qtasks.tasks.deploy_notify_queue', *[msg_key],
                                       **{'appid': appinfo_obj.app.appid, 'robot': robot,
                                          'recv_phone': recv_phone, 'recv_openid': recv_openid,
@@ -1,25 +1,31 @@
 import base64
+import copy
 import json
 import socket
+import threading
 import time
 import datetime
 import logging
 import pytz
 from django_q.tasks import async_task, schedule
 from django_q.models import Schedule
-from django.db import transaction
+from django.db import transaction, connection
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from django.core.cache import cache
 from dbapp.models import KubernetesCluster, AppInfo, KubernetesDeploy, Environment
 from dbapp.models import Project
 from common.MailSend import OmsMail
+from common.deploy_stage import DeployStageWriter
+from common.job_wait import wait_job
+from common.notify_queue import NotifyQueue
 from common.ext_fun import get_datadict, k8s_cli, template_generate, template_svc_generate, get_datadict, time_convert
-from common.kubernetes_utils import deployment_check
+from common.kubernetes_utils import deployment_check, K8sResourceCache
 from common.utils.AnsibleCallback import AnsibleApi, PlayBookResultsCollector
 from common.utils.HarborAPI import HarborAPI
 from common.utils.RedisAPI import RedisManage
 from common.variables import HARBOR_SECRET, MSG_KEY, CD_LATEST_KEY, DEPLOY_NUM_MAP, APP_COLOR_MAP, APP_STATUS_MAP, \
     G_CD_TYPE, \
-    DELAY_NOTIFY_KEY, CD_WEB_RESULT_KEY, ANSIBLE_STATUS, DEPLOY_MAP, CD_RESULT_KEY
+    CD_WEB_RESULT_KEY, ANSIBLE_STATUS, DEPLOY_MAP, CD_RESULT_KEY
 from config import WORKFLOW_TEMPLATE_IDS
 from deploy.documents import DeployJobDocument
 from dbapp.model.model_deploy import DeployJob, CD_STAGE_RESULT_KEY, PublishApp, PublishOrder, DeployJobResult
@@ -49,6 +55,10 @@ def get_job(job_id):
 
 class K8sDeploys(object):
     CACHE_EXPIRE_SECOND = 60 * 30
+    # 默认最大并发部署集群数
+    DEPLOY_WORKERS = 5
+    # 默认单个集群部署超时时间
+    DEPLOY_TIMEOUT = 60 * 10
 
     def __init__(
             self,
@@ -96,8 +106,8 @@ class K8sDeploys(object):
         self.cd_result = {}
         self.init_result()
         self.stage_list = []
-        self.cur_k8s_deploy = None
-        self.cur_k8s_deploy_cache_key_prefix = None
+        self.stage_writer = DeployStageWriter(
+            self.job_obj.id, self.CACHE_EXPIRE_SECOND)
 
     def init_result(self):
         self.cd_result = {
@@ -138,13 +148,14 @@ class K8sDeploys(object):
 
     def update_deploy_job_status(self):
         # 更新部署结果缓存
+        self.stage_writer.reset(self.cd_result)
         cache.set(f'appdeploy:{self.job_obj.id}',
                   self.cd_result, self.CACHE_EXPIRE_SECOND)
 
-        # 保存最终的集群部署状态
+        # 保存最终的集群部署状态, 部署结果由DeployJobResult记录
         self.job_obj.status = self.cd_result['status']
         self.job_obj.result = self.cd_result
-        self.job_obj.save()
+        self.job_obj.save(update_fields=['status', 'update_time'])
 
         # 同步设置发布工单的状态
         if self.job_obj.order_id:
@@ -228,22 +239,15 @@ class K8sDeploys(object):
                 robot = notify['robot']
                 recv_phone = self.job_obj.deployer.mobile
                 recv_openid = self.job_obj.deployer.feishu_openid
-                cache.set(
+                NotifyQueue.enqueue(
+                    self.msg_key,
                     f"{self.msg_key}:cd:{self.job_obj.id}",
                     {
                         'appid': self.appinfo_obj.app.appid, 'order_id': self.job_obj.order_id,
                         'robot': robot, 'recv_phone': recv_phone, 'recv_openid': recv_openid,
                         'msg_key': self.msg_key, 'msg': msg, 'title': title
                     },
-                    60 * 60 * 3
-                )
-                cache.set(
-                    f"{DELAY_NOTIFY_KEY}{self.msg_key}",
-                    {
-                        'curr_time': datetime.datetime.now(),
-                        'delay': self.notice_delay
-                    },
-                    60 * 60 * 3
+                    self.notice_delay
                 )
                 taskid = schedule('qtasks.tasks.deploy_notify_queue', *[self.msg_key],
                                   **{
@@ -254,17 +258,88 @@ class K8sDeploys(object):
                     next_run=datetime.datetime.now() + datetime.timedelta(seconds=self.notice_delay)
                 )
 
+    def deploy_cluster(self, k8s_deploy):
+        """
+        单个集群部署, 在线程池中执行
+        """
+        k8s = k8s_deploy.k8s_obj
+        try:
+            with k8s_deploy.lock:
+                if k8s_deploy.cancelled:
+                    return
+                k8s_deploy.started = time.time()
+                # 更新当前集群标记
+                self.cd_result['col_active'] = k8s.name
+                self.stage_writer.set_meta(self.cd_result)
+            try:
+                # 连接K8S集群
+                k8s_deploy.stage_get_k8s_client()
+                k8s_deploy.deploy_flow_standard()
+            except Exception as e:
+                logger.exception(
+                    f'集群 {k8s} 任务步骤 {k8s_deploy.cur_stage} 出现问题，直接跳到执行下一个集群, 异常原因： {e.__class__} {e}')
+            with k8s_deploy.lock:
+                if k8s_deploy.cancelled:
+                    return
+                # 生成单个集群的部署状态
+                k8s_deploy.generate_deploy_status()
+                success = self.cd_result[k8s.name]['status'] == 1
+            # 发布成功， 更新应用在当前集群最新的镜像标签
+            if success:
+                KubernetesDeploy.objects.filter(
+                    appinfo=self.appinfo_obj, kubernetes=k8s).update(version=self.image_tag)
+        finally:
+            connection.close()
+
+    def deploy_clusters(self, k8s_deploys, workers, timeout):
+        """
+        并发部署多个集群
+        :param workers: 最大并发集群数
+        :param timeout: 单个集群部署超时时间(秒), 超时集群标记为超时后不再等待
+        """
+        workers = max(1, min(workers, len(k8s_deploys)))
+        executor = ThreadPoolExecutor(max_workers=workers)
+        futures = {executor.submit(self.deploy_cluster, i): i for i in k8s_deploys}
+        # 超出并发数的集群需排队, 整体等待时间按批次放宽
+        batches = -(-len(k8s_deploys) // workers)
+        deadline = time.time() + timeout * batches
+        pending = set(futures)
+        timed_out = False
+        while pending:
+            now = time.time()
+            for future in list(pending):
+                k8s_deploy = futures[future]
+                if future.done():
+                    continue
+                if (k8s_deploy.started and now - k8s_deploy.started > timeout) or now > deadline:
+                    # 超时集群标记为检测超时, 后台线程的后续结果将被忽略
+                    logger.warning(
+                        f'应用[{self.appinfo_obj.uniq_tag}]发布到集群 {k8s_deploy.k8s_obj} 超时')
+                    k8s_deploy.mark_timeout(timeout)
+                    pending.discard(future)
+                    timed_out = True
+            if not pending:
+                break
+            _, pending = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+        # 未开始的集群直接取消
+        for future in futures:
+            future.cancel()
+        # 超时集群的线程可能仍阻塞在Harbor/K8S请求上, 其结果已被忽略, 不再等待
+        executor.shutdown(wait=not timed_out)
+
     def run(self):
         # 初始化应用和工单数据 & 状态
         self.init_deploy_job_status()
+        self.stage_writer.reset(self.cd_result)
 
-        all_status = []
+        # 并发配置: workers 最大并发集群数, timeout 单个集群部署超时时间(秒)
+        concurrency = get_datadict('DEPLOY_CONCURRENCY', config=1) or {}
+        workers = concurrency.get('workers', self.DEPLOY_WORKERS)
+        timeout = concurrency.get('timeout', self.DEPLOY_TIMEOUT)
 
-        # 遍历应用绑定的K8S集群， 挨个集群都执行部署
-        for index, k8s in enumerate(self.k8s_clusters):
-            k8s_deploy_obj = KubernetesDeploy.objects.filter(
-                appinfo=self.appinfo_obj, kubernetes=k8s)
-            self.cur_k8s_deploy = K8sDeploy(
+        lock = threading.RLock()
+        k8s_deploys = [
+            K8sDeploy(
                 k8s,
                 self.job_obj,
                 self.appinfo_obj,
@@ -276,24 +351,15 @@ class K8sDeploys(object):
                 self.image_repo,
                 self.image_tag,
                 force=self.force,
+                lock=lock,
+                stage_writer=self.stage_writer,
             )
-            is_update_image_tag = True
-            try:
-                # 连接K8S集群
-                self.cur_k8s_deploy.stage_get_k8s_client()
-                self.cur_k8s_deploy.deploy_flow_standard()
-            except Exception as e:
-                logger.exception(
-                    f'集群 {k8s} 任务步骤 {self.cur_k8s_deploy.cur_stage} 出现问题，直接跳到执行下一个集群, 异常原因： {e.__class__} {e}')
-
-            # 生成单个集群的部署状态
-            self.cur_k8s_deploy.generate_deploy_status()
+            for k8s in self.k8s_clusters
+        ]
+        self.deploy_clusters(k8s_deploys, workers, timeout)
 
-            # 发布成功， 更新应用在当前集群最新的镜像标签
-            if is_update_image_tag is True and self.cd_result[k8s.name]['status'] == 1:
-                k8s_deploy_obj.update(version=self.image_tag)
-
-            all_status.append(self.cd_result[k8s.name]['status'])
+        all_status = [self.cd_result[k8s.name]['status']
+                      for k8s in self.k8s_clusters]
         if len(set(all_status)) == 1 and all_status[0] == 1:
             # 所有集群状态值为1, 则判定应用部署成功
             self.cd_result['status'] = 1
@@ -319,7 +385,7 @@ class K8sDeploys(object):
 
         # 发送结束标志
         cache.set(f'appdeploy:stat:{self.job_obj.id}', 1)
-        time.sleep(5)
+        self.stage_writer.finish()
 
         self.notify_deploy_result()
 
@@ -341,20 +407,31 @@ class K8sDeploy(object):
             image_repo,
             image_tag,
             force=False,
+            lock=None,
+            stage_writer=None,
     ):
         """
         :param k8s_obj:
         :param deploy_job_obj:
         :param appinfo_obj:
         :param namespace: deploy namespace
+        :param lock: 多集群并发部署时共享的锁, 保护cd_result的修改和保存
+        :param stage_writer: 部署进度写入, 步骤进度只写Redis, 步骤结束才写数据库
         """
         self.k8s_obj = k8s_obj
+        self.lock = lock or threading.RLock()
+        self.stage_writer = stage_writer or DeployStageWriter(
+            deploy_job_obj.id, self.CACHE_EXPIRE_SECOND)
+        self.started = None
+        self.cancelled = False
+        self.cancel_event = threading.Event()
         self.k8s_cli = None
         self.deploy_job_obj = deploy_job_obj
         self.appinfo_obj = appinfo_obj
         self.namespace = namespace
-        self.deploy_yaml_src = deploy_yaml_src
-        self.deploy_yaml = deploy_yaml_src['yaml']
+        # 多集群并发部署, 每个集群使用独立的模板副本
+        self.deploy_yaml_src = copy.deepcopy(deploy_yaml_src)
+        self.deploy_yaml = self.deploy_yaml_src['yaml']
         self.deployment_name = self.deploy_yaml['metadata']['name']
         self.api_version = self.k8s_obj.version.get('apiversion', 'apps/v1')
 
@@ -368,8 +445,6 @@ class K8sDeploy(object):
         self.cur_stage = None
         self.msg_key = f"{MSG_KEY}{self.deploy_job_obj.order_id}"
         self.cache_key_prefix = f"{CD_STAGE_RESULT_KEY}{self.msg_key}:{self.deploy_job_obj.id}::{self.k8s_obj.name}"
-        # 更新当前集群标记
-        self.cd_result['col_active'] = self.k8s_obj.name
 
     def get_k8s_client(self):
         try:
@@ -450,29 +525,45 @@ class K8sDeploy(object):
         self.validate_stat(stat)
 
     def init_status(self):
-        self.cd_result[self.k8s_obj.name]['status'] = 3
-        cache.set(f'appdeploy:{self.deploy_job_obj.id}',
-                  self.cd_result, self.CACHE_EXPIRE_SECOND)
-        self.deploy_job_obj.result = self.cd_result
-        self.deploy_job_obj.save()
+        with self.lock:
+            self.cd_result[self.k8s_obj.name]['status'] = 3
+            self.stage_writer.set_status(self.k8s_obj.name, 3)
+
+    def mark_timeout(self, timeout):
+        """
+        标记集群部署超时
+        """
+        with self.lock:
+            self.cancelled = True
+            self.cancel_event.set()
+            self.cd_result[self.k8s_obj.name]['stages'].append({
+                'name': '部署超时',
+                'status': 4,
+                'msg': f'Kubernetes集群[{self.k8s_obj.name}]部署超过{timeout}秒未完成',
+                'logs': ''
+            })
+        self.generate_deploy_status()
 
     def validate_stat(self, stat: int):
         if stat != 1:
             raise AssertionError('步骤执行失败了， 状态不等于1')
 
     def init_stage(self, stage_name):
-        self.stage_list.append(stage_name)
-        self.cur_stage = stage_name
-        self.cd_result[self.k8s_obj.name]['stages'].append({
-            'name': stage_name,
-            'status': 0,  # 状态0 初始， 1 成功 2失败
-            'msg': '',
-            'logs': ''
-        })
-        cache.set(f'appdeploy:{self.deploy_job_obj.id}',
-                  self.cd_result, self.CACHE_EXPIRE_SECOND)
-        self.deploy_job_obj.result = self.cd_result
-        self.deploy_job_obj.save()
+        with self.lock:
+            if self.cancelled:
+                raise AssertionError('集群部署已超时')
+            self.stage_list.append(stage_name)
+            self.cur_stage = stage_name
+            stage = {
+                'name': stage_name,
+                'status': 0,  # 状态0 初始， 1 成功 2失败
+                'msg': '',
+                'logs': ''
+            }
+            self.cd_result[self.k8s_obj.name]['stages'].append(stage)
+            # 步骤开始只更新进度, 不写数据库
+            self.stage_writer.set_stage(
+                self.k8s_obj.name, len(self.cd_result[self.k8s_obj.name]['stages']) - 1, stage, self.cd_result)
 
     def save_stage_result(self, stat, msg, ret):
         if isinstance(ret, str):
@@ -484,13 +575,17 @@ class K8sDeploy(object):
             'msg': msg,
             'logs': json.dumps('message' in ret and ret['message'] or ret)
         }
-        self.cd_result[self.k8s_obj.name]['stages'][deploy_stage_index] = deploy_content
-        stage_cache_key = f"{self.cache_key_prefix}::::{deploy_stage_index}"
-        cache.set(stage_cache_key, deploy_content, self.CACHE_EXPIRE_SECOND)
-        cache.set(f'appdeploy:{self.deploy_job_obj.id}',
-                  self.cd_result, self.CACHE_EXPIRE_SECOND)
-        self.deploy_job_obj.result = self.cd_result
-        self.deploy_job_obj.save()
+        with self.lock:
+            if self.cancelled:
+                return
+            self.cd_result[self.k8s_obj.name]['stages'][deploy_stage_index] = deploy_content
+            stage_cache_key = f"{self.cache_key_prefix}::::{deploy_stage_index}"
+            cache.set(stage_cache_key, deploy_content, self.CACHE_EXPIRE_SECOND)
+            self.stage_writer.set_stage(
+                self.k8s_obj.name, deploy_stage_index, deploy_content)
+            self.deploy_job_obj.result = self.cd_result
+            # 步骤结束刷新任务更新时间
+            self.deploy_job_obj.save(update_fields=['update_time'])
 
     def image_sync(self, repo, image, tag):
         """
@@ -507,13 +602,11 @@ class K8sDeploy(object):
                 username=harbor_config['user'],
                 password=harbor_config['password']
             )
-            # 检测镜像标签是否存在
-            res = cli.fetch_tag(repo, tag)
-            if res.get('ecode', 500) <= 399:
+            # 检测镜像标签是否存在, 不存在执行打标签逻辑
+            synced, res = cli.sync_tag(repo, image, tag)
+            if not synced:
                 return 1, "镜像已存在，跳过同步步骤", json.dumps(res)
 
-            # 镜像标签不存在, 执行打标签逻辑
-            res = cli.patch_tag(repo, image, tag)
             if res.get('ecode', 500) > 399:
                 return 2, "镜像标签不存在, 执行打标签逻辑失败", json.dumps(res)
             if isinstance(res['data'], bytes):
@@ -578,15 +671,19 @@ class K8sDeploy(object):
 
     def check_app_deploy(self, deployment_name, tag=None):
         check_ret = deployment_check(
-            self.k8s_cli, self.appinfo_obj, self.k8s_obj, tag, app_deploy_name=deployment_name)
+            self.k8s_cli, self.appinfo_obj, self.k8s_obj, tag, app_deploy_name=deployment_name,
+            cancel_event=self.cancel_event)
         return check_ret['status'], check_ret['message'], check_ret['data']
 
     def check_namespace(self):
-        try:
-            # 创建命名空间
-            r = self.k8s_cli.create_namespace(self.namespace)
-        except BaseException as e:
-            pass
+        namespaces = K8sResourceCache.namespaces(self.k8s_obj.id, self.k8s_cli)
+        if namespaces is None or self.namespace not in namespaces:
+            try:
+                # 创建命名空间
+                r = self.k8s_cli.create_namespace(self.namespace)
+            except BaseException as e:
+                pass
+            K8sResourceCache.add_namespace(self.k8s_obj.id, self.namespace)
 
         try:
             # 创建harbor secret
@@ -599,8 +696,12 @@ class K8sDeploy(object):
             payload = {'data': {'.dockerconfigjson': login_auth}, 'kind': 'Secret',
                        'metadata': {'name': HARBOR_SECRET, 'namespace': self.namespace},
                        'type': 'kubernetes.io/dockerconfigjson'}
-            r = self.k8s_cli.manage_secret(
-                HARBOR_SECRET, self.namespace, **{'payload': payload})
+            if not K8sResourceCache.is_applied(self.k8s_obj.id, 'secret', self.namespace, HARBOR_SECRET, payload):
+                r = self.k8s_cli.manage_secret(
+                    HARBOR_SECRET, self.namespace, **{'payload': payload})
+                if r and not r.get('error'):
+                    K8sResourceCache.set_applied(
+                        self.k8s_obj.id, 'secret', self.namespace, HARBOR_SECRET, payload)
         except BaseException as e:
             logger.exception(
                 f'检测应用 [{self.appinfo_obj.uniq_tag}] harbor登录密钥 异常', e)
@@ -610,6 +711,10 @@ class K8sDeploy(object):
         # 获取svc模板
         try:
             ok, svc_yaml = template_svc_generate(self.appinfo_obj)
+            if ok and K8sResourceCache.is_applied(self.k8s_obj.id, 'service', self.namespace,
+                                                  self.appinfo_obj.app.name, svc_yaml):
+                # svc内容未变更
+                return
             if ok:
                 # 获取svc
                 r = self.k8s_cli.fetch_service(
@@ -628,6 +733,9 @@ class K8sDeploy(object):
                         namespace=self.namespace,
                         svc_yaml=svc_yaml
                     )
+                if not r.get('error'):
+                    K8sResourceCache.set_applied(
+                        self.k8s_obj.id, 'service', self.namespace, self.appinfo_obj.app.name, svc_yaml)
         except BaseException as e:
             pass
 
@@ -636,25 +744,26 @@ class K8sDeploy(object):
         生成单个集群的部署状态
         :return:
         """
-        k8s_status = [i['status']
-                      for i in self.cd_result[self.k8s_obj.name]['stages']]
-        if len(set(k8s_status)) == 1 and k8s_status[0] == 1:
-            # 所有状态值为1,则判定该集群应用部署成功
-            self.cd_result[self.k8s_obj.name]['status'] = 1
-        elif 4 in k8s_status:
-            # 状态值为4, 检测超时
-            self.cd_result[self.k8s_obj.name]['status'] = 4
-        else:
-            # 其它情况判定失败
-            self.cd_result[self.k8s_obj.name]['status'] = 2
+        with self.lock:
+            k8s_status = [i['status']
+                          for i in self.cd_result[self.k8s_obj.name]['stages']]
+            if len(set(k8s_status)) == 1 and k8s_status[0] == 1:
+                # 所有状态值为1,则判定该集群应用部署成功
+                self.cd_result[self.k8s_obj.name]['status'] = 1
+            elif 4 in k8s_status:
+                # 状态值为4, 检测超时
+                self.cd_result[self.k8s_obj.name]['status'] = 4
+            else:
+                # 其它情况判定失败
+                self.cd_result[self.k8s_obj.name]['status'] = 2
 
-        try:
-            self.deploy_job_obj.result = self.cd_result
-            self.deploy_job_obj.save()
-            cache.set(f'appdeploy:{self.deploy_job_obj.id}',
-                      self.cd_result, self.CACHE_EXPIRE_SECOND)
-        except Exception as e:
-            logger.exception(f'保存单个集群的部署情况失败, 原因 {e}')
+            try:
+                self.deploy_job_obj.result = self.cd_result
+                self.deploy_job_obj.save(update_fields=['update_time'])
+                self.stage_writer.write(
+                    self.stage_writer.flatten({self.k8s_obj.name: self.cd_result[self.k8s_obj.name]}, meta=False))
+            except Exception as e:
+                logger.exception(f'保存单个集群的部署情况失败, 原因 {e}')
 
 
 def app_deployment_handle(
@@ -666,14 +775,7 @@ def app_deployment_handle(
         partial_deploy_acceptance=None,
 ):
 
-    _get_job_flag = True
-    count = 0
-    while _get_job_flag:
-        count += 1
-        ok, job = get_job(job_id)
-        if ok or count > 30:
-            _get_job_flag = False
-        time.sleep(0.5)
+    ok, job = wait_job('deployjob', job_id, lambda: get_job(job_id))
     appinfo_objs = AppInfo.objects.filter(id=job.appinfo_id)
     if len(appinfo_objs) == 0:
         logger.error(f'获取不到应用[ID: {job.appinfo_id}], 部署失败!')
@@ -729,14 +831,8 @@ class JarDeploy(object):
         self.inventory = inventory
         self.hosts = hosts
 
-        _get_job_flag = True
-        count = 0
-        while _get_job_flag:
-            count += 1
-            ok, self.job_obj = get_job(job_id)
-            if ok or count > 30:
-                _get_job_flag = False
-            time.sleep(0.5)
+        ok, self.job_obj = wait_job(
+            'deployjob', job_id, lambda: get_job(job_id))
         try:
             self.job_result_obj = DeployJobResult.objects.get(
                 job_id=self.job_id)
@@ -926,14 +1022,10 @@ class JarDeploy(object):
                 robot = notify['robot']
                 recv_phone = self.job_obj.deployer.mobile
                 recv_openid = self.job_obj.deployer.feishu_openid
-                cache.set(f"{self.msg_key}:cd:{self.job_obj.id}",
-                          {'appid': self.appinfo_obj.app.appid, 'order_id': self.job_obj.order_id, 'robot': robot,
-                           'recv_phone': recv_phone, 'recv_openid': recv_openid,
-                           'msg_key': self.msg_key, 'msg': msg, 'title': title}, 60 * 60 * 3)
-                cache.set(f"{DELAY_NOTIFY_KEY}{self.msg_key}",
-                          {'curr_time': datetime.datetime.now(
-                          ), 'delay': self.notice_delay},
-                          60 * 60 * 3)
+                NotifyQueue.enqueue(self.msg_key, f"{self.msg_key}:cd:{self.job_obj.id}",
+                                    {'appid': self.appinfo_obj.app.appid, 'order_id': self.job_obj.order_id,
+                                     'robot': robot, 'recv_phone': recv_phone, 'recv_openid': recv_openid,
+                                     'msg_key': self.msg_key, 'msg': msg, 'title': title}, self.notice_delay)
                 taskid = schedule('qtasks.tasks.deploy_notify_queue', *[self.msg_key],
                                   **{'appid': self.appinfo_obj.app.appid, 'order_id': self.job_obj.order_id,
                                      'robot': robot,